@@ -0,0 +1,71 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Benchmark the application of a block diagonal (DDK like) filter with sparse products (COO and the automatically selected backend) and with batched dense blocks
+usage: PYTHONPATH=. python benchmarks/bench_ddk.py [--nworkers=N] [nmax [nepochs]]"""
+
+import sys
+import time
+import numpy as np
+import xarray as xr
+from frommle2.core import LinearSparseFwd,BlockDiagonalFwd
+import frommle2.sh.xarraysh
+
+
+def ddklike(nmax,nmin=2):
+    """Returns random blocks per order and trigonometric type, and the corresponding index"""
+    rng=np.random.default_rng(1)
+    nmt=[]
+    blocks=[]
+    for m in range(nmax+1):
+        for t in (0,1) if m > 0 else (0,):
+            degrees=range(max(nmin,m),nmax+1)
+            nmt.extend([(n,m,t) for n in degrees])
+            blocks.append(rng.standard_normal([len(degrees),len(degrees)]))
+    return blocks,xr.DataArray.sh.mi_fromtuples(nmt)
+
+def main(argv):
+    nworkers=None
+    for arg in argv:
+        if arg.startswith("--nworkers="):
+            nworkers=int(arg.split("=")[1])
+    args=[int(x) for x in argv if not x.startswith("--")]
+    nmax=args[0] if len(args) > 0 else 120
+    nepochs=args[1] if len(args) > 1 else 240
+
+    blocks,mi=ddklike(nmax)
+    bdfwd=BlockDiagonalFwd(blocks,mi,"shg",nworkers=nworkers)
+    dasparse=xr.DataArray(bdfwd.tosparse(),coords={"shg":("shg",mi)},dims=["shg_t","shg"])
+    spfwds={"coo":LinearSparseFwd(dasparse,"shg",backend="coo")}
+    spfwds["auto"]=LinearSparseFwd(dasparse,"shg")
+    da=xr.DataArray(np.random.default_rng(2).standard_normal([len(mi),nepochs]),coords={"shg":("shg",mi),"time":np.arange(nepochs)},dims=["shg","time"])
+
+    print(f"nmax={nmax} nsh={len(mi)} nblocks={len(blocks)} nepochs={nepochs}")
+    timings={}
+    for name,spfwd in spfwds.items():
+        t0=time.perf_counter()
+        dasp=spfwd(da).compute()
+        timings[name]=time.perf_counter()-t0
+        print(f"{'sparse '+name:>16} {timings[name]:10.4f} s ({spfwd.backend.name})")
+    t0=time.perf_counter()
+    dabd=bdfwd(da)
+    tbd=time.perf_counter()-t0
+    speedup=", ".join(f"{tsp/tbd:.1f} vs {name}" for name,tsp in timings.items())
+    print(f"{'blockdiag':>16} {tbd:10.4f} s (speedup {speedup}, max difference {np.abs(dasp.values-dabd.values).max():.2e})")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
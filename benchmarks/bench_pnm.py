@@ -0,0 +1,66 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Benchmark the computation time of high degree associated Legendre functions
+usage: PYTHONPATH=. python benchmarks/bench_pnm.py [--nlat=N] [--shtools] [nmax ...]
+The maximum deviation from the addition theorem sum_m Pnm^2 = 2n+1 is reported as an accuracy measure"""
+
+import sys
+import time
+import numpy as np
+from frommle2.sh.pnm import iter_pnm,pnm
+
+def stream(nmax,lat,dtype):
+    """Stream the functions degree by degree and accumulate the addition theorem"""
+    sumsq=np.zeros([nmax+1,len(lat)])
+    for n,pn in iter_pnm(nmax,lat,dtype=dtype):
+        sumsq[n]=np.sum(pn.astype(np.float64)**2,axis=0)
+    return sumsq
+
+def shtools(nmax,lat):
+    import pyshtools as sht
+    sumsq=np.zeros([nmax+1,len(lat)])
+    n=np.repeat(np.arange(nmax+1),np.arange(1,nmax+2))
+    for i,x in enumerate(np.sin(np.deg2rad(lat))):
+        sumsq[:,i]=np.bincount(n,sht.legendre.PlmBar(nmax,x,csphase=1)**2)
+    return sumsq
+
+def main(argv):
+    nlat=180
+    for arg in argv:
+        if arg.startswith("--nlat="):
+            nlat=int(arg.split("=")[1])
+    nmaxes=[int(x) for x in argv if not x.startswith("--")] or [360,2190,2700]
+    #latitudes include points close to the poles
+    lat=np.linspace(-89.99,89.99,nlat)
+    methods=[("float64",lambda nmax:stream(nmax,lat,np.float64)),("float32",lambda nmax:stream(nmax,lat,np.float32))]
+    if "--shtools" in argv:
+        methods.append(("shtools",lambda nmax:shtools(nmax,lat)))
+    print(f"{'nmax':>6} {'method':>8} {'nlat':>6} {'time [s]':>10} {'max rel. error':>15}")
+    for nmax in nmaxes:
+        for name,func in methods:
+            t0=time.perf_counter()
+            sumsq=func(nmax)
+            dt=time.perf_counter()-t0
+            err=np.max(np.abs(sumsq/(2*np.arange(nmax+1)+1.0)[:,np.newaxis]-1))
+            print(f"{nmax:6d} {name:>8} {nlat:6d} {dt:10.3f} {err:15.2e}")
+        t0=time.perf_counter()
+        tab=pnm(nmax,lat[0:10])
+        print(f"{nmax:6d} {'table':>8} {10:6d} {time.perf_counter()-t0:10.3f} {'':>15}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
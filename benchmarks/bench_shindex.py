@@ -0,0 +1,60 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Benchmark the construction time and memory of spherical harmonic MultiIndexes
+usage: PYTHONPATH=. python benchmarks/bench_shindex.py [--legacy] [nmax ...]"""
+
+import sys
+import time
+import tracemalloc
+import pandas as pd
+from frommle2.sh import shindex
+from frommle2.sh.xarraysh import trig
+
+
+def legacy_nmt_mi(nmax,nmin=0,squeeze=False):
+    """Tuple based construction as used previously"""
+    if squeeze:
+        nmt=[(n,m,t) for t in [trig.c,trig.s] for n in range(nmin,nmax+1) for m in range(n+1) if not (m == 0 and t == trig.s) ]
+    else:
+        nmt=[(n,m,t) for t in [trig.c,trig.s] for n in range(nmin,nmax+1) for m in range(n+1)]
+    return pd.MultiIndex.from_tuples(nmt,names=["n","m","t"])
+
+def measure(func,*args):
+    tracemalloc.start()
+    t0=time.perf_counter()
+    mi=func(*args)
+    dt=time.perf_counter()-t0
+    current,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return mi,dt,peak/2**20,mi.nbytes/2**20
+
+def main(argv):
+    legacy="--legacy" in argv
+    nmaxes=[int(x) for x in argv if not x.startswith("--")] or [60,180,720,2190]
+    print(f"{'nmax':>6} {'method':>8} {'nsh':>10} {'time [s]':>10} {'peak [MiB]':>11} {'index [MiB]':>12}")
+    for nmax in nmaxes:
+        shindex.clear_cache()
+        methods=[("arrays",shindex.nmt_mi),("cached",shindex.nmt_mi)]
+        if legacy:
+            methods.insert(0,("tuples",legacy_nmt_mi))
+        for name,func in methods:
+            mi,dt,peak,sz=measure(func,nmax)
+            print(f"{nmax:6d} {name:>8} {len(mi):10d} {dt:10.4f} {peak:11.1f} {sz:12.1f}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
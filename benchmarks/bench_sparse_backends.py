@@ -0,0 +1,75 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Micro-benchmark of the sparse storage backends of LinearSparseFwd on a DDK like filter and the EquivalentWater conversion
+usage: PYTHONPATH=. python benchmarks/bench_sparse_backends.py [--dense] [nmax [nepochs]]
+(the dense backend is only included with --dense, as it requires nsh**2 doubles of memory)"""
+
+import sys
+import time
+import numpy as np
+import xarray as xr
+from frommle2.core import LinearSparseFwd,BlockDiagonalFwd
+from frommle2.core.sparse_backends import select_backend
+from frommle2.sh.grav import EquivalentWater
+from bench_ddk import ddklike
+
+BACKENDS=["coo","csr","csc","bsr","diagonal"]
+
+def timeit(func,*args,repeat=3):
+    best=np.inf
+    for _ in range(repeat):
+        t0=time.perf_counter()
+        res=func(*args)
+        best=min(best,time.perf_counter()-t0)
+    return res,best
+
+def bench(label,opsp,rhs,reference):
+    print(f"{label}: auto selects {select_backend(opsp.data)[0]}")
+    for backend in BACKENDS:
+        if backend == "diagonal" and select_backend(opsp.data)[0] != "diagonal":
+            continue
+        fwd=LinearSparseFwd(opsp,"shg",backend=backend)
+        res,dt=timeit(fwd,rhs)
+        print(f"{backend:>12} {dt:10.4f} s (max difference {np.abs(res.values-reference.values).max():.2e})")
+
+def main(argv):
+    if "--dense" in argv:
+        BACKENDS.insert(-1,"dense")
+    args=[int(x) for x in argv if not x.startswith("--")]
+    nmax=args[0] if len(args) > 0 else 120
+    nepochs=args[1] if len(args) > 1 else 240
+
+    blocks,mi=ddklike(nmax)
+    da=xr.DataArray(np.random.default_rng(2).standard_normal([len(mi),nepochs]),coords={"shg":("shg",mi),"time":np.arange(nepochs)},dims=["shg","time"])
+    print(f"nmax={nmax} nsh={len(mi)} nepochs={nepochs}")
+
+    bdfwd=BlockDiagonalFwd(blocks,mi,"shg")
+    reference,dt=timeit(bdfwd,da)
+    print(f"{'blockdiag':>12} {dt:10.4f} s (BlockDiagonalFwd)")
+    bench("DDK like filter",bdfwd.tolinearsparse().dasparse.compute(),da,reference)
+
+    knlove=xr.DataArray(-0.3/(1+np.arange(nmax+1)),coords={"degree":np.arange(nmax+1)},dims=["degree"])
+    ewh=EquivalentWater(knlove,nmax)
+    miewh=ewh.index()
+    daewh=xr.DataArray(np.random.default_rng(3).standard_normal([len(miewh),nepochs]),coords={"shg":("shg",miewh),"time":np.arange(nepochs)},dims=["shg","time"])
+    reference,dt=timeit(ewh,daewh)
+    print(f"{'isotropic':>12} {dt:10.4f} s (IsotropicFwd)")
+    bench("EquivalentWater",ewh.tolinearsparse().dasparse.compute(),daewh,reference)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -21,5 +21,6 @@ rho_water=1.e3 # average density of water
 rho_earth=5517.0 #average density of the Earth
 rho_ice=931.0 #density of ice kg/m^3 taken from G. Spada and friends
 g=9.80665e0 # mean gravity m/s^2
+GM_earth=0.3986004415e+15 #gravitational constant times the mass of the Earth m^3/s^2
 
 
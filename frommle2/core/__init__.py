@@ -1,3 +1,5 @@
 
 from .xforward import BaseFwd
 from .linear_sparse_fwd import LinearSparseFwd 
+from .block_diagonal_fwd import BlockDiagonalFwd
+from .diagonal_fwd import DiagonalFwd
@@ -0,0 +1,151 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Precomputed plans which align the index of an input with the index of a forward operator"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def index_key(index:pd.Index):
+    """Returns a hash which identifies the entries (and their order) of a (multi)index"""
+    hsh=hashlib.sha1()
+    if isinstance(index,pd.MultiIndex):
+        for level,codes in zip(index.levels,index.codes):
+            hsh.update(np.ascontiguousarray(level.values).tobytes())
+            hsh.update(np.ascontiguousarray(codes).tobytes())
+            hsh.update(b"|")
+    else:
+        hsh.update(np.ascontiguousarray(index.values).tobytes() if index.dtype != object else str(list(index)).encode())
+    hsh.update(str(len(index)).encode())
+    return hsh.hexdigest()
+
+
+def has_dim_index(obj,dim):
+    """Returns whether a dimension of a xarray object carries an index"""
+    return dim in obj.indexes or any(obj[name].dims == (dim,) for name in obj.xindexes)
+
+
+def dim_index(obj,dim):
+    """Returns the pandas index along a dimension of a xarray object, custom indexes (e.g. a SHIndex on the coordinates n,m,t)
+    are converted with their to_pandas_index method"""
+    if dim in obj.indexes:
+        return obj.get_index(dim)
+    for name,idx in obj.xindexes.items():
+        if obj[name].dims == (dim,):
+            return idx.to_pandas_index()
+    return obj.get_index(dim)
+
+
+class AlignmentPlan:
+    """Integer gather/scatter arrays which map an input on the input index of an operator, and the output of the operator
+    (plus entries which pass through unchanged) on the output index"""
+    def __init__(self,opindex,inindex,keep=None,passthrough=None,outindex=None):
+        """
+        parameters:
+            opindex: input index of the operator
+            inindex: index of the input, entries of opindex which are missing in the input are treated as zero
+            keep: optional positions of the operator output which are kept (default all)
+            passthrough: optional positions in the input which are copied to the output, before the kept operator output
+            outindex: index of the output (only stored for the convenience of the caller)
+        """
+        pos=inindex.get_indexer(opindex)
+        valid=pos >= 0
+        self.identity=bool(valid.all()) and len(pos) == len(inindex) and np.all(pos == np.arange(len(pos)))
+        self.gather=np.maximum(pos,0)
+        self.valid=None if valid.all() else valid
+        self.keep=keep
+        self.passthrough=passthrough
+        self.outindex=outindex
+
+    def nout(self,nopout):
+        """Returns the size of the output for an operator with nopout output entries"""
+        nout=nopout if self.keep is None else len(self.keep)
+        if self.passthrough is not None:
+            nout+=len(self.passthrough)
+        return nout
+
+    def apply(self,matmul,x):
+        """Gathers x (of shape [nin,...]), applies the operator product matmul and scatters its output (of shape [nout,...])"""
+        if self.identity:
+            xop=x
+        else:
+            xop=x[self.gather]
+            if self.valid is not None:
+                xop[~self.valid]=0.0
+        y=matmul(xop)
+        if self.keep is not None:
+            y=y[self.keep]
+        if self.passthrough is not None:
+            y=np.concatenate([x[self.passthrough],y],axis=0)
+        return y
+
+
+class PlanCache:
+    """Least recently used cache of alignment plans per distinct input index"""
+    def __init__(self,maxsize=8):
+        self.maxsize=maxsize
+        self.plans=OrderedDict()
+        self.lock=threading.Lock()
+
+    def __call__(self,index,build):
+        """Returns the plan for index, and creates it with build(index) when it is not cached yet"""
+        key=index_key(index)
+        with self.lock:
+            if key in self.plans:
+                self.plans.move_to_end(key)
+                return self.plans[key]
+        plan=build(index)
+        with self.lock:
+            self.plans[key]=plan
+            while len(self.plans) > self.maxsize:
+                self.plans.popitem(last=False)
+        return plan
+
+
+def apply_aligned(rhs,dim,plan,matmul,nopout,outdim=None,outindex=None):
+    """Applies an operator product to the dimension dim of rhs, using an alignment plan
+    parameters:
+        rhs: right hand side (xr.DataArray), dask backed inputs are processed lazily per chunk of their other dimensions
+        dim: dimension of rhs which is multiplied
+        plan: AlignmentPlan for the index of rhs (None when rhs is already in the order of the operator)
+        matmul: function which applies the operator to an array of shape [nin,...]
+        nopout: number of output entries of the operator
+        outdim: name of the output dimension (defaults to dim)
+        outindex: optional index which is assigned to the output dimension
+    returns: xr.DataArray with dimensions (outdim,...)"""
+    rhs=rhs.transpose(dim,...)
+    auxdims=rhs.dims[1:]
+    coords={ky:val for ky,val in rhs.coords.items() if dim not in val.dims}
+    func=matmul if plan is None else lambda x:plan.apply(matmul,x)
+    nout=nopout if plan is None else plan.nout(nopout)
+    if rhs.chunks is not None:
+        #the multiplied dimension is kept in a single chunk, so every output chunk is one product
+        x=rhs.chunk({dim:-1}).data
+        data=x.map_blocks(func,chunks=((nout,),)+x.chunks[1:],dtype=x.dtype)
+    else:
+        data=func(rhs.values)
+    if outdim is None:
+        outdim=dim
+    daout=xr.DataArray(data,coords=coords,dims=(outdim,)+auxdims,name=rhs.name)
+    if outindex is not None:
+        daout=daout.assign_coords({outdim:(outdim,outindex)})
+    return daout
@@ -0,0 +1,109 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+import numpy as np
+import xarray as xr
+import sparse
+from concurrent.futures import ThreadPoolExecutor
+from frommle2.core import BaseFwd
+from frommle2.core.linear_sparse_fwd import LinearSparseFwd
+from frommle2.core.alignment import AlignmentPlan,PlanCache,apply_aligned,dim_index
+
+class BlockDiagonalFwd(BaseFwd):
+    isLinear=True
+    def __init__(self,blocks,index,dim,transpose=False,nworkers=None):
+        """Linear forward operator described by a block diagonal matrix, whose blocks are kept as dense arrays
+        Blocks of the same size are stacked, so that they are applied to the input with batched dense matrix products
+        parameters:
+            blocks: list of square dense blocks (in the order of the diagonal)
+            index: (multi)index of the rows/columns of the operator
+            dim: Dimension name over which will be multiplied (str)
+            transpose: apply the transpose of the blocks
+            nworkers: number of threads which apply the blocks (default applies them in the calling thread)"""
+        self.index=index
+        self.dim=dim
+        self.nworkers=nworkers
+        self._plans=PlanCache()
+        sizes=np.array([blk.shape[0] for blk in blocks])
+        if sizes.sum() != len(index):
+            raise ValueError("Size of the blocks is not consistent with the index")
+        starts=np.concatenate([[0],np.cumsum(sizes)[:-1]])
+        #groups of equally sized blocks: (rows of shape [nblk,sz],stacked blocks of shape [nblk,sz,sz])
+        self.groups=[]
+        for sz in np.unique(sizes):
+            iblk=np.nonzero(sizes == sz)[0]
+            rows=starts[iblk][:,np.newaxis]+np.arange(sz)
+            mats=np.stack([blocks[i] for i in iblk])
+            if transpose:
+                mats=mats.transpose(0,2,1)
+            self.groups.append((rows,np.ascontiguousarray(mats)))
+
+    def __call__(self,rhs:xr.DataArray,chunks=None):
+        """Executes the forward operator
+        parameters:
+            rhs: right hand side (xarray dataArray), coefficients which are missing in the rhs are treated as zero.
+                 Dask backed inputs are processed lazily per chunk of their other dimensions
+            chunks: optional dictionary with chunk sizes of the other dimensions (e.g. {"time":12}) to apply to rhs
+        returns: xr.DataArray with dimensions (dim,...) and the index of the operator"""
+        if chunks is not None:
+            rhs=rhs.chunk(chunks)
+        plan=self._plans(dim_index(rhs,self.dim),lambda index:AlignmentPlan(self.index,index))
+        return apply_aligned(rhs,self.dim,plan,self._applyblocks,len(self.index),outindex=self.index)
+
+    def _applyblocks(self,x):
+        """Applies the blocks to an array of shape [nsh,...]"""
+        return self._apply(x.reshape((x.shape[0],-1))).reshape(x.shape)
+
+    def _apply(self,x):
+        """Applies the blocks to an array of shape [nsh,ncol]"""
+        out=np.empty_like(x)
+
+        def apply(task):
+            rows,mats=task
+            out[rows]=mats@x[rows]
+
+        if self.nworkers is None or self.nworkers < 2:
+            for task in self.groups:
+                apply(task)
+        else:
+            with ThreadPoolExecutor(max_workers=self.nworkers) as executor:
+                #the largest groups are split so that the workers get a similar load
+                list(executor.map(apply,self._tasks()))
+        return out
+
+    def _tasks(self):
+        """Splits the groups of blocks in chunks for the thread pool"""
+        nel=sum(mats.size for _,mats in self.groups)
+        target=max(1,nel//(4*self.nworkers))
+        for rows,mats in self.groups:
+            nchunk=max(1,mats.size//target)
+            for sel in np.array_split(np.arange(len(rows)),min(nchunk,len(rows))):
+                yield rows[sel],mats[sel]
+
+    def tosparse(self):
+        """Returns the operator as a sparse.COO matrix"""
+        coords=[]
+        data=[]
+        for rows,mats in self.groups:
+            sz=rows.shape[1]
+            coords.append(np.stack([np.repeat(rows,sz,axis=1).ravel(),np.tile(rows,(1,sz)).ravel()]))
+            data.append(mats.ravel())
+        return sparse.COO(np.concatenate(coords,axis=1),np.concatenate(data),shape=(len(self.index),len(self.index)))
+
+    def tolinearsparse(self):
+        """Returns the operator as a LinearSparseFwd"""
+        return LinearSparseFwd(xr.DataArray(self.tosparse(),coords={self.dim:(self.dim,self.index)},dims=[f"{self.dim}_t",self.dim]),self.dim)
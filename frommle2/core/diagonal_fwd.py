@@ -0,0 +1,65 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+import numpy as np
+import xarray as xr
+import sparse
+from frommle2.core import BaseFwd
+from frommle2.core.linear_sparse_fwd import LinearSparseFwd
+from frommle2.core.alignment import PlanCache,dim_index
+
+class DiagonalFwd(BaseFwd):
+    isLinear=True
+    def __init__(self,diag:xr.DataArray,dim):
+        """Linear forward operator described by a diagonal matrix, which is applied as a broadcasted multiplication
+        parameters:
+            diag: diagonal elements of the operator as a 1D xr.DataArray along dim (with an index)
+            dim: Dimension name of the diagonal (str)"""
+        if not isinstance(diag,xr.DataArray):
+            raise TypeError("DiagonalFwd expects a xr.DataArray")
+        self.diag=diag
+        self.dim=dim
+        self._plans=PlanCache()
+
+    def index(self):
+        """Returns the index of the diagonal"""
+        return self.diag.get_index(self.dim)
+
+    def diagonal(self,index):
+        """Returns the diagonal elements for the entries of index (zero for entries which are not part of the operator)"""
+        pos=self.index().get_indexer(index)
+        return np.where(pos >= 0,self.diag.values[pos],0.0)
+
+    def __call__(self,rhs:xr.DataArray):
+        """Executes the forward operator
+        parameters:
+            rhs: right hand side (xarray dataArray), the output keeps the coordinates of the rhs"""
+        #the diagonal elements are looked up once per distinct input index
+        return rhs*xr.DataArray(self._plans(dim_index(rhs,self.dim),self.diagonal),dims=self.dim)
+
+    def tolinearsparse(self):
+        """Returns the operator as a LinearSparseFwd"""
+        index=self.index()
+        return LinearSparseFwd(xr.DataArray(sparse.diagonalize(self.diagonal(index)),coords={self.dim:(self.dim,index)},dims=[f"{self.dim}_t",self.dim]),self.dim)
+
+    def dot(self,otherfwd):
+        """Chain another operator as the right hand side and return a new forward operator, so that fused(x) == self(otherfwd(x))
+        The product of two diagonal operators is again diagonal (on the index of otherfwd), other operators result in a LinearSparseFwd"""
+        if isinstance(otherfwd,DiagonalFwd):
+            index=otherfwd.index()
+            return DiagonalFwd(xr.DataArray(self.diagonal(index)*otherfwd.diagonal(index),coords={self.dim:(self.dim,index)},dims=[self.dim]),self.dim)
+        return self.tolinearsparse().dot(otherfwd)
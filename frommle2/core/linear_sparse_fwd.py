@@ -18,51 +18,117 @@
 import xarray as xr
 from dask.array.core import einsum_lookup
 import sparse
+import numpy as np
+import scipy.sparse
 from frommle2.core import BaseFwd
+from frommle2.core.sparse_backends import make_backend
+from frommle2.core.alignment import AlignmentPlan,PlanCache,apply_aligned,dim_index,has_dim_index
 class LinearSparseFwd(BaseFwd):
     isLinear=True #linear operator so their is no need to linearize relative to a apriori state
-    def __init__(self,dasparse:xr.DataArray,dim):
+    def __init__(self,dasparse:xr.DataArray,dim,outindex=None,backend="auto"):
         """Base class which contains a linear forward operator which is described by a sparse matrix
         parameter: 
-            dasparse: matrix containing the observation equations (xr.DataArray)
-            dim: Dimension name over which will be multiplied (str)"""
+            dasparse: matrix containing the observation equations (xr.DataArray with sparse.COO, scipy.sparse or dense data)
+            dim: Dimension name over which will be multiplied (str)
+            outindex: optional (multi)index of the output, which is assigned to the output under the name of dim
+            backend: storage used for the products: 'auto' (chosen from the sparsity and block structure), 'coo', 'csr', 'csc', 'bsr', 'dense' or 'diagonal'"""
         
         if not isinstance(dasparse,xr.DataArray):
             raise TypeError("LinearSparseFwd expects a xr.DataArray")
+        if scipy.sparse.issparse(dasparse.data):
+            dasparse=dasparse.copy(data=sparse.COO.from_scipy_sparse(dasparse.data))
+        elif isinstance(dasparse.data,np.ndarray):
+            dasparse=dasparse.copy(data=sparse.COO.from_numpy(dasparse.data))
         elif type(dasparse.data) != sparse.COO:
-            raise TypeError("LinearSparseFwd expects a xr.DataArray with sparse.COO data")
-        #possibly allow dask dataArrays? (before being chunked)
-        self.dasparse=dasparse
+            raise TypeError("LinearSparseFwd expects a xr.DataArray with sparse.COO, scipy.sparse or numpy data")
         self.dim=dim
+        self.outindex=outindex
+        #matrix oriented as (output,input)
+        self.dasparse=dasparse
+        self.mat=dasparse.transpose(self.outdim(),self.dim).data
+        self.backend=make_backend(self.mat,backend)
+        self._plans=PlanCache()
         
         #do explicit chunking (set this matrix as a single chunk dask array)
-        self.dasparse=self.dasparse.chunk(self.dasparse.shape)
+        self.dasparse=self.dasparse.chunk({dim:-1 for dim in self.dasparse.dims})
 
         #also register the einsum functions which are needed to do the sparse dot functions
         einsum_lookup.register(sparse.COO,LinearSparseFwd.einsumReplace)
         
-    def __call__(self,rhs:xr.DataArray):
+    def __call__(self,rhs:xr.DataArray,chunks=None):
         """Executes the forward operator
         parameters:
-            rhs: right hand side (xarray dataArray)"""        
-        #compute the dot product 
-        return self.dasparse.dot(rhs,dims=self.dim) 
-        
+            rhs: right hand side (xarray dataArray), dask backed inputs are processed lazily per chunk of their other dimensions.
+                 The rhs is aligned with the input coordinates of the operator, where missing entries are treated as zero
+            chunks: optional dictionary with chunk sizes of the other dimensions (e.g. {"time":12}) to apply to rhs
+        returns: xr.DataArray with dimensions (output dimension,...)"""        
+        if chunks is not None:
+            rhs=rhs.chunk(chunks)
+        plan=None
+        if self.dim in self.dasparse.indexes and has_dim_index(rhs,self.dim):
+            #the positions of the operator columns in the input are computed once per distinct input index
+            plan=self._plans(dim_index(rhs,self.dim),lambda index:AlignmentPlan(self.dasparse.get_index(self.dim),index))
+        daout=apply_aligned(rhs,self.dim,plan,self._matmul,self.mat.shape[0],outdim=self.outdim())
+        if self.outindex is not None:
+            daout=daout.rename({self.outdim():self.dim}).assign_coords({self.dim:(self.dim,self.outindex)})
+        return daout
+
+    def _matmul(self,x):
+        """Applies the matrix to an array of shape [nin,...]"""
+        return self.backend.matmul(x.reshape((x.shape[0],-1))).reshape((self.mat.shape[0],)+x.shape[1:])
         
+    def outdim(self):
+        """Returns the name of the output dimension of the operator"""
+        return [dim for dim in self.dasparse.dims if dim != self.dim][0]
+
+    def output_index(self):
+        """Returns the index of the output coordinates (when not set explicitly, the output is assumed to be ordered as the input)"""
+        if self.outindex is not None:
+            return self.outindex
+        return self.dasparse.get_index(self.dim)
+
     def dot(self,otherfwd):
-        # chain another operator as the right hand side and return a new forward operator
-        pass
+        """Chain another operator as the right hand side and return a new forward operator, so that fused(x) == self(otherfwd(x))
+        The sparse product and the alignment of the output of otherfwd with the input of this operator are computed once,
+        so applying the fused operator costs a single sparse matrix product
+        parameters:
+            otherfwd: LinearSparseFwd (or an operator which can be converted to one with tolinearsparse) which is applied first
+        returns: LinearSparseFwd with the input coordinates of otherfwd and the output coordinates of this operator"""
+        if hasattr(otherfwd,"tolinearsparse"):
+            otherfwd=otherfwd.tolinearsparse()
+        if not isinstance(otherfwd,LinearSparseFwd):
+            raise TypeError("Can only fuse with another LinearSparseFwd")
+        #positions of the output of the other operator in the input of this operator
+        idx=self.dasparse.get_index(self.dim).get_indexer(otherfwd.output_index())
+        valid=np.nonzero(idx >= 0)[0]
+        if len(valid) == 0:
+            raise ValueError("The output of the operator to be fused does not overlap with the input of this operator")
+        
+        matself=self.mat.tocsr()
+        matother=otherfwd.mat.tocsr()
+        fused=sparse.COO.from_scipy_sparse(matself[:,idx[valid]]@matother[valid,:])
+
+        dafused=xr.DataArray(fused,coords={otherfwd.dim:(otherfwd.dim,otherfwd.dasparse.get_index(otherfwd.dim))},dims=[self.outdim(),otherfwd.dim],name=self.dasparse.name)
+        return LinearSparseFwd(dafused,otherfwd.dim,outindex=self.output_index())
 
     @staticmethod
     def einsumReplace(subscripts, *operands, out=None, dtype=None, order='K', casting='safe', optimize=False):
-        """Mimics the interface of https://numpy.org/doc/stable/reference/generated/numpy.einsum.html, but uses the sparse.COO dot function"""
-        if subscripts == "ab,cb->ac":
-            return operands[0].dot(operands[1].T)
-        elif subscripts == "ab,ca->bc":
-            return operands[0].T.dot(operands[1].T)
-        elif subscripts == "ab,bc->ac":
-            return operands[0].dot(operands[1])
-        elif subscripts == "ab,b->a":
-            return operands[0].dot(operands[1])
-        else:
-            raise NotImplementedError(f"Don't know (yet) how to handle this einsum: {subscripts} with sparse.dot operations")
+        """Mimics the interface of https://numpy.org/doc/stable/reference/generated/numpy.einsum.html, but uses sparse products
+        Two operands which share a single contracted index are multiplied with sparse.tensordot (batched over all other indices),
+        other expressions fall back to a dense numpy.einsum"""
+        inputs,output=subscripts.replace(" ","").split("->")
+        inputs=inputs.split(",")
+        if len(inputs) == 2:
+            shared=[c for c in inputs[0] if c in inputs[1]]
+            if len(shared) == 1 and shared[0] not in output and len(set(inputs[0])) == len(inputs[0]) and len(set(inputs[1])) == len(inputs[1]):
+                c=shared[0]
+                res=sparse.tensordot(operands[0],operands[1],axes=(inputs[0].index(c),inputs[1].index(c)))
+                labels=inputs[0].replace(c,"")+inputs[1].replace(c,"")
+                #indices which only appear in the input are summed
+                summed=tuple(i for i,lbl in enumerate(labels) if lbl not in output)
+                if summed:
+                    res=res.sum(axis=summed)
+                    labels="".join(lbl for lbl in labels if lbl in output)
+                return res.transpose([labels.index(c) for c in output])
+        dense=[op.todense() if isinstance(op,sparse.SparseArray) else op for op in operands]
+        return np.einsum(subscripts,*dense,dtype=dtype,order=order,casting=casting,optimize=optimize)
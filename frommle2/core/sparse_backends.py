@@ -0,0 +1,124 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Storage backends which multiply a (sparse) operator matrix with a dense array of right hand sides"""
+
+import numpy as np
+import sparse
+
+#density above which the matrix is stored as a dense array
+DENSE_DENSITY=0.25
+#minimum fraction of nonzero elements in the occupied blocks for block sparse (BSR) storage
+BSR_FILL=0.8
+
+
+class CooBackend:
+    """Products with the sparse.COO matrix itself"""
+    name="coo"
+    def __init__(self,mat:sparse.COO):
+        self.mat=mat
+        self.shape=mat.shape
+
+    def matmul(self,x):
+        """Multiplies the matrix with an array of shape [ncol,nrhs] and returns a dense array of shape [nrow,nrhs]"""
+        res=self.mat.dot(x)
+        return res.todense() if isinstance(res,sparse.SparseArray) else res
+
+
+class ScipyBackend(CooBackend):
+    """Products with scipy compressed sparse row/column or block sparse row storage"""
+    def __init__(self,mat:sparse.COO,fmt="csr",blocksize=None):
+        self.name=fmt
+        self.shape=mat.shape
+        spmat=mat.tocsr()
+        if fmt == "csc":
+            self.mat=spmat.tocsc()
+        elif fmt == "bsr":
+            self.mat=spmat.tobsr(blocksize=blocksize)
+        else:
+            self.mat=spmat
+
+    def matmul(self,x):
+        return np.asarray(self.mat@x)
+
+
+class DenseBackend(CooBackend):
+    """Products with a dense copy of the matrix"""
+    name="dense"
+    def __init__(self,mat:sparse.COO):
+        self.shape=mat.shape
+        self.mat=mat.todense()
+
+    def matmul(self,x):
+        return self.mat@x
+
+
+class DiagonalBackend(CooBackend):
+    """Broadcasted multiplication with the diagonal of a (square) diagonal matrix"""
+    name="diagonal"
+    def __init__(self,mat:sparse.COO):
+        self.shape=mat.shape
+        self.diag=np.zeros(mat.shape[0],dtype=mat.dtype)
+        self.diag[mat.coords[0]]=mat.data
+
+    def matmul(self,x):
+        return self.diag[:,np.newaxis]*x
+
+
+def blockfill(mat:sparse.COO,blocksize):
+    """Returns the fraction of nonzero elements in the occupied (blocksize x blocksize) blocks of the matrix"""
+    if mat.nnz == 0:
+        return 0.0
+    nbcol=-(-mat.shape[1]//blocksize)
+    nblocks=len(np.unique((mat.coords[0]//blocksize)*nbcol+mat.coords[1]//blocksize))
+    return mat.nnz/(nblocks*blocksize**2)
+
+
+def select_backend(mat:sparse.COO):
+    """Chooses a storage backend from the sparsity and block structure of the matrix
+    returns: (name of the backend,keyword arguments of the backend)"""
+    nrow,ncol=mat.shape
+    if nrow == ncol and mat.nnz <= nrow and np.all(mat.coords[0] == mat.coords[1]):
+        return "diagonal",{}
+    if mat.nnz > DENSE_DENSITY*nrow*ncol:
+        return "dense",{}
+    #scipy's block sparse products only outperform csr for fairly large blocks
+    for blocksize in (16,8):
+        if nrow%blocksize == 0 and ncol%blocksize == 0 and blockfill(mat,blocksize) >= BSR_FILL:
+            return "bsr",{"blocksize":(blocksize,blocksize)}
+    return "csr",{}
+
+
+def make_backend(mat:sparse.COO,backend="auto"):
+    """Returns a storage backend of the matrix
+    parameters:
+        mat: matrix of shape [nrow,ncol]
+        backend: one of 'auto','coo','csr','csc','bsr','dense','diagonal'
+    """
+    kwargs={}
+    if backend == "auto":
+        backend,kwargs=select_backend(mat)
+    if backend == "coo":
+        return CooBackend(mat)
+    elif backend in ("csr","csc","bsr"):
+        return ScipyBackend(mat,backend,**kwargs)
+    elif backend == "dense":
+        return DenseBackend(mat)
+    elif backend == "diagonal":
+        return DiagonalBackend(mat)
+    else:
+        raise ValueError(f"Unknown sparse backend {backend}")
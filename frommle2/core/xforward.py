@@ -28,3 +28,26 @@ class BaseFwd:
         """Takes an xarray dataset and compute the forward propagated values"""
         raise NotImplementedError("__call__ should be implemented")
         pass
+
+    def to_store(self,rhs:xr.DataArray,store,chunks=None,scheduler=None,name=None):
+        """Applies the operator chunk by chunk and writes the output incrementally to a NetCDF file or Zarr store,
+        so that the peak memory is bounded by the size of the chunks which are processed in parallel
+        parameters:
+            rhs: right hand side (xarray dataArray, possibly dask backed or lazily loaded from file)
+            store: output filename, a name ending with .zarr is written as a Zarr store, otherwise as NetCDF
+            chunks: dictionary with chunk sizes of the (non-operator) dimensions of rhs, e.g. {"time":12,"ensemble":1}
+            scheduler: dask scheduler which processes the chunks (e.g. "threads", "processes", "synchronous" or a distributed Client)
+            name: name of the output variable (defaults to the name of the output or "out")"""
+        if chunks is not None:
+            rhs=rhs.chunk(chunks)
+        daout=self(rhs)
+        dsout=daout.to_dataset(name=name or daout.name or "out")
+        #multi-indices can not be serialized, so store their levels as ordinary coordinates
+        multidims=[dim for dim,idx in dsout.indexes.items() if idx.nlevels > 1]
+        if multidims:
+            dsout=dsout.reset_index(multidims)
+        if str(store).endswith(".zarr"):
+            delayed=dsout.to_zarr(store,mode="w",compute=False)
+        else:
+            delayed=dsout.to_netcdf(store,compute=False)
+        delayed.compute(scheduler=scheduler)
@@ -0,0 +1,171 @@
+# This file is part of Frommle2
+# Frommle is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# Frommle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Catalogs of the headers of BINV files (e.g. daily or monthly normal equations), which are stored in a compact NetCDF index"""
+
+import os
+import glob
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import xarray as xr
+from frommle2.io.binv_legacy import readBINVheader
+from frommle2.core.logger import logger
+
+#scalar header entries which are stored per file
+_headerfields={"type":str,"version":str,"description":str,"endianness":str,"nval1":np.int64,"nval2":np.int64,"pval1":np.int64,"pval2":np.int64,
+        "nvec":np.int64,"nblocks":np.int64,"offset_vec":np.int64,"offset_pack":np.int64,"size":np.int64,"mtime":np.float64}
+
+
+def _scanfile(filename):
+    """Returns the header of a single file with its size and modification time (or None when it can't be read)"""
+    try:
+        stat=os.stat(filename)
+        hdr=readBINVheader(filename)
+    except Exception as exc:
+        logger.warning(f"Skipping {filename}, not a readable BINV file: {exc}")
+        return None
+    hdr["size"]=stat.st_size
+    hdr["mtime"]=stat.st_mtime
+    return hdr
+
+
+def scanBINV(files,nworkers=None):
+    """Reads the headers of BINV files in parallel
+    parameters:
+        files: list of filenames
+        nworkers: number of threads which read the headers (default as chosen by concurrent.futures)
+    returns: dictionary with the header (see readBINVheader) per filename, unreadable files are left out"""
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        headers=executor.map(_scanfile,files)
+        return {fname:hdr for fname,hdr in zip(files,headers) if hdr is not None}
+
+
+def _headers2catalog(headers):
+    """Creates a catalog dataset from a dictionary of headers"""
+    files=list(headers.keys())
+    hdrs=list(headers.values())
+    dsvars={}
+    for ky,dtype in _headerfields.items():
+        dsvars[ky]=("file",np.array([dtype(hdr.get(ky,"" if dtype is str else 0)) for hdr in hdrs],dtype=object if dtype is str else dtype))
+
+    #meta data, missing values are set to NaN
+    metakeys=list(dict.fromkeys(ky for hdr in hdrs for ky in hdr.get("meta",{})))
+    for ky in metakeys:
+        dsvars["meta_"+ky]=("file",np.array([hdr.get("meta",{}).get(ky,np.nan) for hdr in hdrs],dtype=np.float64))
+
+    #store identical side descriptions only once
+    sidesets={}
+    sideids={1:[],2:[]}
+    for hdr in hdrs:
+        for iside in (1,2):
+            side=hdr.get(f"side{iside}_d")
+            if side is None:
+                sideids[iside].append(-1)
+                continue
+            key=hashlib.sha1("|".join(str(name).strip() for name in side).encode()).hexdigest()
+            if key not in sidesets:
+                sidesets[key]=(len(sidesets),side)
+            sideids[iside].append(sidesets[key][0])
+    dsvars["side1"]=("file",np.array(sideids[1],dtype=np.int64))
+    dsvars["side2"]=("file",np.array(sideids[2],dtype=np.int64))
+    sides=[side for _,side in sidesets.values()]
+    sidelen=np.array([len(side) for side in sides],dtype=np.int64)
+    dsvars["sidestart"]=("sideset",np.cumsum(sidelen)-sidelen)
+    dsvars["sidelen"]=("sideset",sidelen)
+    dsvars["param"]=("param",np.array([str(name).strip() for side in sides for name in side],dtype=object))
+    return xr.Dataset(dsvars,coords={"file":np.array(files,dtype=object)})
+
+
+def _catalog2headers(catalog):
+    """Returns the headers which are stored in a catalog as a dictionary per filename"""
+    headers={}
+    metakeys=[ky for ky in catalog.data_vars if ky.startswith("meta_")]
+    for i,fname in enumerate(catalog.file.values):
+        hdr={ky:catalog[ky].values[i] for ky in _headerfields}
+        meta={ky[5:]:catalog[ky].values[i] for ky in metakeys if not np.isnan(catalog[ky].values[i])}
+        if meta:
+            hdr["meta"]=meta
+        for iside in (1,2):
+            side=catalogsides(catalog,i,iside)
+            if side is not None:
+                hdr[f"side{iside}_d"]=side
+        headers[fname]=hdr
+    return headers
+
+
+def catalogsides(catalog,ifile,side=1):
+    """Returns the side description (parameter names) of a file in a catalog
+    parameters:
+        catalog: catalog dataset as returned by BINVcatalog
+        ifile: position or name of the file in the catalog
+        side: 1 or 2
+    returns: array with the (stripped) parameter names, or None when the file has no such side description"""
+    if isinstance(ifile,str):
+        ifile=catalog.get_index("file").get_loc(ifile)
+    iset=int(catalog[f"side{side}"].values[ifile])
+    if iset < 0:
+        return None
+    start=int(catalog.sidestart.values[iset])
+    return catalog.param.values[start:start+int(catalog.sidelen.values[iset])]
+
+
+def BINVcatalog(path,pattern="*",index=None,nworkers=None,recursive=False):
+    """Builds a catalog of the headers of the BINV files in a directory, without reading their data
+    parameters:
+        path: directory to scan (or a list of filenames)
+        pattern: glob pattern of the files in the directory
+        index: optional NetCDF file which stores the catalog, only new or modified files are scanned when it already exists
+        nworkers: number of threads which read the headers
+        recursive: also scan subdirectories
+    returns: xr.Dataset with the header entries ('type','nval1','pval1','offset_pack',...) and meta data ('meta_<name>') along the dimension 'file',
+             the side descriptions can be retrieved with catalogsides"""
+    if isinstance(path,(list,tuple)):
+        files=[os.path.abspath(fname) for fname in path]
+    else:
+        globpattern=os.path.join(path,"**",pattern) if recursive else os.path.join(path,pattern)
+        files=sorted(os.path.abspath(fname) for fname in glob.glob(globpattern,recursive=recursive) if os.path.isfile(fname))
+        if index is not None:
+            files=[fname for fname in files if fname != os.path.abspath(index)]
+
+    known={}
+    if index is not None and os.path.exists(index):
+        known=_catalog2headers(loadBINVcatalog(index))
+
+    headers={}
+    toscan=[]
+    for fname in files:
+        hdr=known.get(fname)
+        if hdr is not None:
+            stat=os.stat(fname)
+            if hdr["size"] == stat.st_size and hdr["mtime"] == stat.st_mtime:
+                headers[fname]=hdr
+                continue
+        toscan.append(fname)
+    if toscan:
+        logger.info(f"Scanning the headers of {len(toscan)} BINV files")
+    headers.update(scanBINV(toscan,nworkers=nworkers))
+    catalog=_headers2catalog({fname:headers[fname] for fname in files if fname in headers})
+    if index is not None:
+        catalog.to_netcdf(index)
+    return catalog
+
+
+def loadBINVcatalog(index):
+    """Loads a catalog which was stored by BINVcatalog"""
+    with xr.open_dataset(index) as ds:
+        return ds.load()
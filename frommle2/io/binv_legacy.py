@@ -14,161 +14,455 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 # Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2021
+import os
 import struct
 import numpy as np
+import pandas as pd
+import xarray as xr
 import sparse
+import scipy.sparse
+from frommle2.neqs.sympacked import SymPacked,npacked
+
+BDFULLTYPES=["BDFULLV0","BDFULLVN"]
+BDSYMTYPES=["BDSYMV0_","BDSYMVN_"]
+SYMTYPES=["SYMV0___","SYMV1___","SYMV2___","SYMVN___"]
+FULLTYPES=["FULLSQV0","FULLSQVN","FULL2DVN"]
+
+
+def _checkBDtype(ddict,types=BDFULLTYPES+BDSYMTYPES):
+    if not ddict['type'] in types:
+        raise RuntimeError("cannot get blocks or coordinates for this type of matrix (yet)")
 
-def getBDcoords(ddict):
 
-    if not ddict['type'] in ["BDFULLV0","BDFULLVN"]:
-        raise RuntimeError("cannot get coordinates for this type of matrix (yet)")
-
-    mxblk=np.max(np.diff(ddict['blockind']))
-    mshx,mshy=np.meshgrid([x for x in range(mxblk)],[y for y in range(mxblk)])
-    # mshx=mshx.reshape([mshx.size])
-    # mshy=mshy.reshape([mshy.size])
-
-    #initialize coords array
-    coords=np.full([2,ddict['pval1']*ddict['pval2']],np.nan,dtype=np.int32)
-
-    blkstrt=0
-    nshift=0
-    for blkend in ddict['blockind']:
-        blklen=(blkend-blkstrt)
-        sz=blklen**2
-        coords[0,nshift:nshift+sz]=mshx[0:blklen,0:blklen].reshape([sz])+blkstrt
-        coords[1,nshift:nshift+sz]=mshy[0:blklen,0:blklen].reshape([sz])+blkstrt
-        # import pdb;pdb.set_trace()
-        #update blockstart
-        blkstrt=blkend
-        nshift+=sz
+def getBDoffsets(ddict):
+    """Returns the start and size of the diagonal blocks along the side, and the start of each block in the packed data"""
+    blockind=np.asarray(ddict['blockind'],dtype=np.int64)
+    blkstrt=np.concatenate(([0],blockind[:-1]))
+    blklen=blockind-blkstrt
+    #symmetric blocks only store their upper triangle
+    nel=npacked(blklen) if ddict['type'] in BDSYMTYPES else blklen**2
+    packstrt=np.concatenate(([0],np.cumsum(nel)[:-1]))
+    return blkstrt,blklen,packstrt
+
+
+def getBDcoords(ddict):
+    """Returns the (row,column) coordinates of the packed (column major) elements of a full block diagonal matrix"""
+    _checkBDtype(ddict,BDFULLTYPES)
+    blkstrt,blklen,packstrt=getBDoffsets(ddict)
+    nel=blklen**2
+    iblk=np.repeat(np.arange(len(blklen)),nel)
+    #position within the block
+    local=np.arange(nel.sum())-packstrt[iblk]
+    coords=np.empty([2,len(local)],dtype=np.int32)
+    coords[0]=local%blklen[iblk]+blkstrt[iblk]
+    coords[1]=local//blklen[iblk]+blkstrt[iblk]
     return coords
 
 
-def readBINV(filename,unpack=False):
-    """Reads in a binary file written using the fortran RLFTlbx.
-    Pretty slow currenlty so a cpp version is foreseen"""
+def getBDblocks(ddict,packed=False):
+    """Returns the diagonal blocks of a block diagonal matrix as a list of dense (column major) views of the packed data
+    parameters:
+        ddict: dictionary as returned by readBINV
+        packed: return the blocks of symmetric block diagonal types as SymPacked matrices instead of dense copies
+    """
+    _checkBDtype(ddict)
+    blkstrt,blklen,packstrt=getBDoffsets(ddict)
+    if ddict['type'] in BDSYMTYPES:
+        blocks=[SymPacked(ddict['pack'][pstrt:pstrt+npacked(blen)]) for blen,pstrt in zip(blklen,packstrt)]
+        return blocks if packed else [blk.todense() for blk in blocks]
+    return [ddict['pack'][pstrt:pstrt+blen**2].reshape((blen,blen),order='F') for blen,pstrt in zip(blklen,packstrt)]
+
+
+def getBDsparse(ddict,format="coo"):
+    """Returns a block diagonal matrix as a sparse matrix, with the coordinates generated on demand
+    parameters:
+        ddict: dictionary as returned by readBINV
+        format: 'coo' (sparse.COO) or a scipy.sparse format such as 'csr' or 'csc'
+    """
+    if format == "coo":
+        if ddict['type'] in BDSYMTYPES:
+            return sparse.COO.from_scipy_sparse(scipy.sparse.block_diag(getBDblocks(ddict),format="coo"))
+        return sparse.COO(getBDcoords(ddict),np.asarray(ddict['pack']),shape=(ddict['nval1'],ddict['nval1']))
+    return scipy.sparse.block_diag(getBDblocks(ddict),format=format)
+
+
+def unpackBINV(ddict,packed=False):
+    """Unpacks the matrix of a BINV dictionary
+    parameters:
+        ddict: dictionary as returned by readBINV
+        packed: keep symmetric matrices (and blocks) in packed storage as SymPacked objects, which support matvec and solve
+    returns: dictionary with the entry 'blocks' (block diagonal types) or 'mat'
+    """
+    btype=ddict['type']
+    if btype in BDFULLTYPES+BDSYMTYPES:
+        return {"blocks":getBDblocks(ddict,packed=packed)}
+    elif btype in SYMTYPES:
+        mat=SymPacked(ddict['pack'])
+        return {"mat":mat if packed else mat.todense()}
+    elif btype in FULLTYPES:
+        #full matrices are stored column major, so this is a view of the packed data
+        return {"mat":ddict['pack'].reshape((ddict['nval1'],ddict['nval2']),order='F')}
+    else:
+        raise RuntimeError(f"Unpacking of type {btype} is not supported")
+
+
+def _readBINVheader(fid):
+    """Parses the header of a BINV file up to the start of the vectors"""
     dictout={}
     #default to assuming the file is in little endian
     endianness='<'
-    #open filename in binary mode
-    with open(filename,'rb') as fid:
-        #read the endianess checker
-        (endian,)=struct.unpack(endianness+"H", fid.read(2))
-        #compare the magic number (should be 18754 on a system with the same endiannes of the file)
-        if endian != 18754:
-            #switch to big endian
-            endianness='>'
+    #read the endianess checker
+    (endian,)=struct.unpack(endianness+"H", fid.read(2))
+    #compare the magic number (should be 18754 on a system with the same endiannes of the file)
+    if endian != 18754:
+        #switch to big endian
+        endianness='>'
 
-        dictout['version']='BI'+fid.read(6).decode('utf-8')
-        vnum=float(dictout['version'][4:7])
+    dictout['version']='BI'+fid.read(6).decode('utf-8')
+    vnum=float(dictout['version'][4:7])
 
-        #read type, description etc
+    #read type, description etc
 
-        dictout['type']=fid.read(8).decode('utf-8')
-        dictout['description']=fid.read(80).decode('utf-8')
+    dictout['type']=fid.read(8).decode('utf-8')
+    dictout['description']=fid.read(80).decode('utf-8')
 
-        #read integer meta information
-        (nints,ndbls,nval1,nval2)=struct.unpack(endianness+'IIII',fid.read(4*4))
+    #read integer meta information
+    (nints,ndbls,nval1,nval2)=struct.unpack(endianness+'IIII',fid.read(4*4))
 
-        if vnum < 2.4:
-            (pval1,pval2)=struct.unpack(endianness+'II',fid.read(4*2))
+    if vnum < 2.4:
+        (pval1,pval2)=struct.unpack(endianness+'II',fid.read(4*2))
+    else:
+        (pval1,pval2)=struct.unpack(endianness+'QQ',fid.read(8*2))
+
+
+    if vnum <= 2.1:
+        if dictout["type"] in ['SYMV0___','BDFULLV0','BDSYMV0_','BDFULLVN']:
+            nvec=0
+            pval2=1
+        elif dictout["type"] == "SYMV1___":
+            nvec=1
+            pval2=1
+        elif dictout["type"] == "SYMV2___":
+            nvec=2
+            pval2=1
+        elif dictout["type"] == "FULLSQV0":
+            nvec=0
+            pval2=pval1
         else:
-            (pval1,pval2)=struct.unpack(endianness+'LL',fid.read(8*2))
-
-
-        if vnum <= 2.1:
-            if dictout["type"] in ['SYMV0___','BDFULLV0','BDSYMV0','BDFULLVN']:
-                nvec=0
-                pval2=1
-            elif dictout["type"] == "SYMV1___":
-                nvec=1
-                pval2=1
-            elif dictout["type"] == "SYMV2___":
-                nvec=2
-                pval2=1
-            elif dictout["type"] == "FULLSQV0":
-                nvec=0
-                pval2=pval1
-
-            nread=0
-            nval2=nval1
+            nvec=0
+
+        nread=0
+        nval2=nval1
+    else:
+        (nvec,nread)=struct.unpack(endianness+"II",fid.read(4*2))
+
+    dictout["nval1"]=nval1
+    dictout["nval2"]=nval2
+    dictout["pval1"]=pval1
+    dictout["pval2"]=pval2
+
+    #read type dependent index data
+    if dictout['type'] in ["BDSYMV0_","BDSYMVN_","BDFULLV0","BDFULLVN"]:
+        (nblocks,)=struct.unpack(endianness+'I',fid.read(4))
+        dictout["nblocks"]=nblocks
+
+    if nread >0:
+        dictout["readme"]=fid.read(nread*80).decode('utf-8')
+
+    names=[]
+    vals=[]
+    if nints > 0:
+        inames=np.fromfile(fid,dtype='|S24',count=nints).astype('|U24')
+        names.extend(list(inames))
+        if vnum <= 2.4:
+            ivals=np.fromfile(fid,dtype=endianness+'I',count=nints)
         else:
-            (nvec,nread)=struct.unpack(endianness+"II",fid.read(4*2))
-
-        dictout["nval1"]=nval1
-        dictout["nval2"]=nval2
-        dictout["pval1"]=pval1
-        dictout["pval2"]=pval2
-
-        #read type dependent index data
-        if dictout['type'] in ["BDSYMV0_","BDSYMVN_","BDFULLV0","BDFULLVN"]:
-            (nblocks,)=struct.unpack(endianness+'I',fid.read(4))
-            dictout["nblocks"]=nblocks
-
-        if nread >0:
-            dictout["readme"]=fid.read(nread*80).decode('utf-8')
-
-        names=[]
-        vals=[]
-        if nints > 0:
-            inames=np.fromfile(fid,dtype='|S24',count=nints).astype('|U24')
-            names.extend(list(inames))
-            if vnum <= 2.4:
-                ivals=np.fromfile(fid,dtype=endianness+'I',count=nints)
-            else:
-                ivals=np.fromfile(fid,dtype=endianness+'L',count=nints)
-            vals.extend(ivals)
-        if ndbls >0:
-            dnames=np.fromfile(fid,dtype='|S24',count=ndbls).astype('|U24')
-            names.extend(list(dnames))
-            dvals=np.fromfile(fid,dtype=endianness+'d',count=ndbls)
-            vals.extend(dvals)
-
-        if names:
-            dictout["meta"]={ky.strip():val for ky,val in zip(names,vals)}
-
-        #read side description data
-        dictout["side1_d"]=np.fromfile(fid,dtype='|S24',count=nval1).astype('|U24')
-
-        if dictout["type"] in ['BDSYMV0_','BDFULLV0','BDSYMVN_','BDFULLVN']:
-            dictout["blockind"]=np.fromfile(fid,dtype=endianness+'I',count=nblocks)
-            #also add coordinates in the full matrix
-            dictout["coords"]=getBDcoords(dictout)
-
-
-        #possibly read second side description
-        if dictout['type'] in ['BDFULLV0','BDFULLVN','FULLSQV0','FULLSQVN']:
-            if vnum <= 2.2:
-                dictout["side2_d"]=dictout["side1_d"]
-            else:
-                dictout["side2_d"]=np.fromfile(fid,dtype='|S24',count=nval1).astype('|U24')
+            ivals=np.fromfile(fid,dtype=endianness+'u8',count=nints)
+        vals.extend(ivals)
+    if ndbls >0:
+        dnames=np.fromfile(fid,dtype='|S24',count=ndbls).astype('|U24')
+        names.extend(list(dnames))
+        dvals=np.fromfile(fid,dtype=endianness+'d',count=ndbls)
+        vals.extend(dvals)
+
+    if names:
+        dictout["meta"]={ky.strip():val for ky,val in zip(names,vals)}
 
-        elif dictout["type"] == "FULL2DVN":
-            dictout["side2_d"]=np.fromfile(fid,dtype='|S24',count=nval2).astype('|U24')
+    #read side description data
+    dictout["side1_d"]=np.fromfile(fid,dtype='|S24',count=nval1).astype('|U24')
 
+    if dictout["type"] in ['BDSYMV0_','BDFULLV0','BDSYMVN_','BDFULLVN']:
+        dictout["blockind"]=np.fromfile(fid,dtype=endianness+'I',count=nblocks)
+
+
+    #possibly read second side description
+    if dictout['type'] in ['BDFULLV0','BDFULLVN','FULLSQV0','FULLSQVN']:
+        if vnum <= 2.2:
+            dictout["side2_d"]=dictout["side1_d"]
+        else:
+            dictout["side2_d"]=np.fromfile(fid,dtype='|S24',count=nval1).astype('|U24')
+
+    elif dictout["type"] == "FULL2DVN":
+        dictout["side2_d"]=np.fromfile(fid,dtype='|S24',count=nval2).astype('|U24')
+
+    #byte offsets of the vectors and the packed matrix
+    dictout["endianness"]=endianness
+    dictout["nvec"]=nvec
+    dictout["offset_vec"]=fid.tell()
+    dictout["offset_pack"]=fid.tell()+8*nvec*nval1
+    return dictout
+
+
+def readBINVheader(filename):
+    """Reads the header, meta data and side descriptions of a BINV file, without reading the vectors and the packed matrix
+    returns: dictionary as returned by readBINV, but without 'vec' and 'pack', and with the byte offsets 'offset_vec' and 'offset_pack' of the data"""
+    with open(filename,'rb') as fid:
+        return _readBINVheader(fid)
+
+
+def readBINV(filename,unpack=False,mmap=False):
+    """Reads in a binary file written using the fortran RLFTlbx.
+    Pretty slow currenlty so a cpp version is foreseen
+    parameters:
+        filename: name of the BINV file
+        unpack: unpack the matrix (see unpackBINV): True for dense matrices and blocks, 'packed' to keep symmetric matrices packed
+        mmap: expose the packed matrix and vectors as read-only memory maps of the file, so that the data is only read when it is used
+    """
+    #open filename in binary mode
+    with open(filename,'rb') as fid:
+        dictout=_readBINVheader(fid)
+        endianness=dictout["endianness"]
+        nvec=dictout["nvec"]
+        nval1=dictout["nval1"]
+        pval1=dictout["pval1"]
+        pval2=dictout["pval2"]
 
         # read vectors
         if nvec >0:
-            dictout["vec"]=np.fromfile(fid,dtype=endianness+"d",count=nvec*nval1).reshape((nval1,nvec),'F')
+            if mmap:
+                dictout["vec"]=np.memmap(filename,dtype=endianness+"d",mode='r',offset=fid.tell(),shape=(nval1,nvec),order='F')
+                fid.seek(8*nvec*nval1,1)
+            else:
+                dictout["vec"]=np.fromfile(fid,dtype=endianness+"d",count=nvec*nval1).reshape((nval1,nvec),order='F')
 
         # read packed matrix
-        pack=np.fromfile(fid,dtype=endianness+'d',count=pval1*pval2)
+        if mmap and pval1*pval2 > 0:
+            pack=np.memmap(filename,dtype=endianness+'d',mode='r',offset=fid.tell(),shape=(pval1*pval2,))
+        else:
+            pack=np.fromfile(fid,dtype=endianness+'d',count=pval1*pval2)
 
 
-    if not unpack:
-        dictout["pack"]=pack
-    else:
+    dictout["pack"]=pack
+    if unpack:
+        dictout.update(unpackBINV(dictout,packed=(unpack == "packed")))
+
+    return dictout
 
-        if dictout["type"] in ['BDSYMV0_','BDFULLV0','BDSYMVN_','BDFULLVN']:
-            #unpack in sparse matrix
-            dictout['mat'] = sparse.COO(dictout['coords'], pack, shape=(dictout['nval1'], dictout['nval1']))
-        else: 
-            raise Exception("Unpacking of this type not yet supported")
 
+def sidedescription(index):
+    """Returns BINV side descriptions (of 24 characters) of an index, spherical harmonic indices get the tags of the RLFTlbx (e.g. 'GCN   2   0')"""
+    if isinstance(index,pd.MultiIndex) and {"n","m","t"}.issubset(index.names):
+        return np.array([f"G{'CS'[t]}N {n:3d}{m:4d}".ljust(24) for n,m,t in zip(index.get_level_values("n"),index.get_level_values("m"),index.get_level_values("t"))])
+    return np.array([str(val)[0:24].ljust(24) for val in index])
 
 
+def _colblock(mat,j0,j1):
+    """Returns the columns j0:j1 of a (sparse, dask or numpy) matrix as a dense numpy array"""
+    blk=mat[:,j0:j1]
+    if isinstance(blk,sparse.SparseArray):
+        return blk.todense()
+    elif scipy.sparse.issparse(blk):
+        return blk.toarray()
+    return np.asarray(blk)
 
 
+def iterpackfull(mat,blocksize):
+    """Yields the column major packed data of a full matrix in blocks of columns"""
+    for j0 in range(0,mat.shape[1],blocksize):
+        yield _colblock(mat,j0,min(j0+blocksize,mat.shape[1])).ravel(order='F')
+
+
+def iterpacksym(mat,blocksize):
+    """Yields the upper triangular packed data of a symmetric matrix in blocks of columns"""
+    for j0 in range(0,mat.shape[1],blocksize):
+        j1=min(j0+blocksize,mat.shape[1])
+        blk=_colblock(mat,j0,j1)[0:j1]
+        #select the upper triangle in column major order
+        mask=np.arange(j1)[:,np.newaxis] <= np.arange(j0,j1)
+        yield blk.T[mask.T]
+
+
+def iterpackblocks(blocks,symmetric=False):
+    """Yields the packed data of the diagonal blocks of a block diagonal matrix"""
+    for blk in blocks:
+        blk=np.asarray(blk)
+        if symmetric:
+            yield blk.T[np.tril(np.ones(blk.shape,dtype=bool))]
+        else:
+            yield blk.ravel(order='F')
+
+
+def toBINVdict(mat,btype,side1_d=None,side2_d=None,blockind=None,vec=None,description="",meta=None,readme=None,blocksize=None):
+    """Creates a dictionary for writeBINV, of which the packed data is generated block by block when it is written
+    parameters:
+        mat: matrix as a xr.DataArray (of which the coordinates provide the side descriptions), numpy/dask array, sparse.COO or scipy.sparse matrix,
+             block diagonal types also accept a list of dense blocks
+        btype: BINV type of the output (e.g. 'SYMV0___','FULLSQVN','FULL2DVN','BDFULLVN','BDSYMVN_')
+        side1_d,side2_d: side descriptions of the rows and columns (default: derived from the coordinates of mat)
+        blockind: ends of the diagonal blocks (block diagonal types, optional when mat is a list of blocks)
+        vec: optional right hand side vectors of shape [nval1,nvec]
+        description: description of the file (max 80 characters)
+        meta: dictionary with integer and float meta data
+        readme: optional readme text
+        blocksize: number of columns which are packed at once
+    returns: dictionary as used by writeBINV
+    """
+    if isinstance(mat,xr.DataArray):
+        if side1_d is None and mat.dims[0] in mat.indexes:
+            side1_d=sidedescription(mat.get_index(mat.dims[0]))
+        if side2_d is None and mat.dims[1] in mat.indexes:
+            side2_d=sidedescription(mat.get_index(mat.dims[1]))
+        mat=mat.data
+    if side1_d is None:
+        side1_d=side2_d
+    if side1_d is None:
+        raise ValueError("Side descriptions are required to write a BINV file")
+    nval1=len(side1_d)
+    if blocksize is None:
+        blocksize=max(1,2**22//max(nval1,1))
+    ddict={"type":btype,"description":description,"side1_d":np.asarray(side1_d),"nval1":nval1}
+    if btype in BDFULLTYPES+BDSYMTYPES:
+        if isinstance(mat,(list,tuple)):
+            blocks=mat
+            if blockind is None:
+                blockind=np.cumsum([len(blk) for blk in blocks])
+        else:
+            #extract the diagonal blocks from the (sparse) matrix
+            bnd=np.concatenate(([0],blockind))
+            blocks=(_colblock(mat[b0:b1],b0,b1) for b0,b1 in zip(bnd[:-1],bnd[1:]))
+        ddict["blockind"]=np.asarray(blockind)
+        ddict["pack"]=iterpackblocks(blocks,symmetric=btype in BDSYMTYPES)
+    elif btype in SYMTYPES:
+        ddict["pack"]=iterpacksym(mat,blocksize)
+    elif btype in FULLTYPES:
+        ddict["pack"]=iterpackfull(mat,blocksize)
+        ddict["nval2"]=mat.shape[1]
+    else:
+        raise RuntimeError(f"Writing of type {btype} is not supported")
+    if side2_d is not None:
+        ddict["side2_d"]=np.asarray(side2_d)
+    if vec is not None:
+        ddict["vec"]=np.asarray(vec).reshape([nval1,-1],order='F')
+    if meta is not None:
+        ddict["meta"]=meta
+    if readme is not None:
+        ddict["readme"]=readme
+    return ddict
+
+
+def _packsize(ddict,nval1,nval2):
+    """Returns pval1 and pval2 of a BINV dictionary"""
+    btype=ddict['type']
+    if btype in BDFULLTYPES+BDSYMTYPES:
+        blklen=np.diff(np.concatenate(([0],np.asarray(ddict['blockind'],dtype=np.int64))))
+        return int(np.sum(npacked(blklen) if btype in BDSYMTYPES else blklen**2)),1
+    elif btype in SYMTYPES:
+        return npacked(nval1),1
+    else:
+        return nval1,nval2
+
+
+def writeBINV(filename,ddict,version=None,endianness='<',chunksize=2**20):
+    """Writes a BINV file which can be read by the fortran RLFTlbx (and readBINV)
+    The packed data is written as it streams in, so the full matrix does not need to be in memory, the file only appears once it is complete
+    parameters:
+        filename: name of the output file
+        ddict: dictionary with the same entries as returned by readBINV (see also toBINVdict), its 'pack' entry is either an array
+               (e.g. a np.memmap, which is written in chunks) or an iterable which yields the packed data in consecutive pieces
+        version: BINV version to write (default: the version in ddict or 'BINV2.4 ')
+        endianness: byte order of the output ('<' or '>')
+        chunksize: number of elements which are converted at once when writing arrays
+    """
+    if version is None:
+        version=ddict.get('version','BINV2.4 ')
+    version=version.ljust(8)[0:8]
+    vnum=float(version[4:7])
+    btype=ddict['type']
+    side1_d=ddict['side1_d']
+    nval1=len(side1_d)
+    side2_d=ddict.get('side2_d')
+    if vnum <= 2.1:
+        nval2=nval1
+    elif side2_d is not None:
+        nval2=len(side2_d)
+    else:
+        nval2=ddict.get('nval2',nval1)
+    pval1,pval2=_packsize(ddict,nval1,nval2)
+    npack=pval1*pval2
+    if vnum <= 2.1:
+        #version 2.1 files derive pval2 from the type
+        pval2=1
+    vec=ddict.get('vec')
+    nvec=0 if vec is None else vec.shape[1]
+    meta=ddict.get('meta',{})
+    imeta={ky:val for ky,val in meta.items() if isinstance(val,(int,np.integer))}
+    dmeta={ky:val for ky,val in meta.items() if ky not in imeta}
+    readme=ddict.get('readme',"") if vnum > 2.1 else ""
+    nread=-(-len(readme)//80)
+
+    def strarr(descr):
+        return "".join(str(val).ljust(24)[0:24] for val in descr).encode()
+
+    #write to a temporary file first, so that a failed write doesn't leave a truncated file behind
+    tmpname=f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmpname,'wb') as fid:
+            #the magic number in the byte order of the file, followed by the remainder of the version
+            fid.write(struct.pack(endianness+'H',18754))
+            fid.write(version[2:8].encode())
+            fid.write(btype.ljust(8)[0:8].encode())
+            fid.write(ddict.get('description',"").ljust(80)[0:80].encode())
+            fid.write(struct.pack(endianness+'IIII',len(imeta),len(dmeta),nval1,nval2))
+            if vnum < 2.4:
+                fid.write(struct.pack(endianness+'II',pval1,pval2))
+            else:
+                fid.write(struct.pack(endianness+'QQ',pval1,pval2))
+            if vnum > 2.1:
+                fid.write(struct.pack(endianness+'II',nvec,nread))
+            if btype in BDFULLTYPES+BDSYMTYPES:
+                fid.write(struct.pack(endianness+'I',len(ddict['blockind'])))
+            if nread > 0:
+                fid.write(readme.ljust(nread*80).encode())
+            if imeta:
+                fid.write(strarr(imeta.keys()))
+                fid.write(np.asarray(list(imeta.values()),dtype=endianness+('u4' if vnum <= 2.4 else 'u8')).tobytes())
+            if dmeta:
+                fid.write(strarr(dmeta.keys()))
+                fid.write(np.asarray(list(dmeta.values()),dtype=endianness+'d').tobytes())
+            fid.write(strarr(side1_d))
+            if btype in BDFULLTYPES+BDSYMTYPES:
+                fid.write(np.asarray(ddict['blockind'],dtype=endianness+'u4').tobytes())
+            if (btype in ['BDFULLV0','BDFULLVN','FULLSQV0','FULLSQVN'] and vnum > 2.2) or btype == "FULL2DVN":
+                fid.write(strarr(side1_d if side2_d is None else side2_d))
+            if nvec > 0:
+                fid.write(np.asarray(vec,dtype=endianness+'d').tobytes(order='F'))
+
+            #stream the packed data
+            pack=ddict['pack']
+            if hasattr(pack,'shape'):
+                flat=pack.reshape(-1,order='F')
+                pack=(flat[i:i+chunksize] for i in range(0,len(flat),chunksize))
+            nwritten=0
+            for chunk in pack:
+                chunk=np.asarray(chunk,dtype=endianness+'d')
+                if nwritten+chunk.size > npack:
+                    raise ValueError(f"The packed data exceeds the {npack} elements which the header of the {btype} matrix requires")
+                fid.write(chunk.tobytes(order='F'))
+                nwritten+=chunk.size
+        if nwritten != npack:
+            raise ValueError(f"Wrote {nwritten} packed elements, but the header of the {btype} matrix requires {npack}")
+        os.replace(tmpname,filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
 
-    return dictout
@@ -0,0 +1,113 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Symmetric matrices in (column major) upper triangular packed storage, as used in BINV files and LAPACK"""
+
+import numpy as np
+from scipy.linalg import lapack
+
+
+def npacked(n):
+    """Returns the number of elements of a packed symmetric matrix of size n"""
+    return n*(n+1)//2
+
+
+def packsize2n(npack):
+    """Returns the size of a symmetric matrix from the number of packed elements"""
+    n=int((np.sqrt(8*npack+1)-1)//2)
+    if npacked(n) != npack:
+        raise ValueError(f"{npack} is not a valid length of a packed symmetric matrix")
+    return n
+
+
+class SymPacked:
+    """Symmetric matrix which keeps its upper triangle packed per column: element (i,j) with i <= j is stored at i+j*(j+1)/2"""
+    def __init__(self,pack,blocksize=None):
+        """
+        parameters:
+            pack: packed upper triangle (1D arraylike, may be a np.memmap)
+            blocksize: number of columns which are converted at once (default: bounds the work arrays to about 32 MB)
+        """
+        self.pack=pack
+        self.n=packsize2n(len(pack))
+        self.shape=(self.n,self.n)
+        self.blocksize=max(1,2**22//max(self.n,1)) if blocksize is None else blocksize
+        self._chol=None
+
+    @staticmethod
+    def fromdense(mat):
+        """Returns the packed upper triangle of a dense symmetric matrix"""
+        mat=np.asarray(mat)
+        irow,icol=np.triu_indices(mat.shape[0])
+        order=np.lexsort((irow,icol))
+        return SymPacked(mat[irow[order],icol[order]])
+
+    def iterblocks(self):
+        """Iterates over blocks of columns and yields (j0,j1,blk), with blk the dense matrix section [0:j1,j0:j1].
+        Every block only reads a contiguous section of the packed data"""
+        for j0 in range(0,self.n,self.blocksize):
+            j1=min(j0+self.blocksize,self.n)
+            cols=np.arange(j0,j1)
+            icol=np.repeat(cols,cols+1)
+            irow=np.arange(npacked(j0),npacked(j1))-npacked(icol)
+            blk=np.zeros([j1,j1-j0])
+            blk[irow,icol-j0]=self.pack[npacked(j0):npacked(j1)]
+            #complete the diagonal block with its lower triangle
+            dblk=blk[j0:j1]
+            blk[j0:j1]=dblk+np.triu(dblk,1).T
+            yield j0,j1,blk
+
+    def diagonal(self):
+        cols=np.arange(self.n)
+        return np.asarray(self.pack[npacked(cols)+cols])
+
+    def todense(self):
+        """Returns the full symmetric matrix as a dense array"""
+        mat=np.empty(self.shape)
+        for j0,j1,blk in self.iterblocks():
+            mat[0:j1,j0:j1]=blk
+            mat[j0:j1,0:j0]=blk[0:j0].T
+        return mat
+
+    def matvec(self,x):
+        """Multiplies the matrix with x (of shape [n] or [n,nrhs]) without unpacking the full matrix"""
+        x=np.asarray(x)
+        y=np.zeros(x.shape,dtype=np.result_type(x.dtype,np.float64))
+        for j0,j1,blk in self.iterblocks():
+            y[0:j1]+=blk@x[j0:j1]
+            y[j0:j1]+=blk[0:j0].T@x[0:j0]
+        return y
+
+    def __matmul__(self,x):
+        return self.matvec(x)
+
+    def cholesky(self):
+        """Computes (and keeps) the packed Cholesky factor of the matrix"""
+        if self._chol is None:
+            chol,info=lapack.dpptrf(self.n,np.ascontiguousarray(self.pack,dtype=np.float64))
+            if info != 0:
+                raise np.linalg.LinAlgError(f"Packed Cholesky decomposition failed (info={info})")
+            self._chol=chol
+        return self._chol
+
+    def solve(self,b):
+        """Solves the (positive definite) system with right hand side(s) b (of shape [n] or [n,nrhs]) using a packed Cholesky factor"""
+        b=np.asarray(b,dtype=np.float64)
+        x,info=lapack.dpptrs(self.n,self.cholesky(),b.reshape([self.n,-1]))
+        if info != 0:
+            raise np.linalg.LinAlgError(f"Packed Cholesky solve failed (info={info})")
+        return x.reshape(b.shape)
@@ -0,0 +1,326 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+from frommle2.core import BaseFwd
+from frommle2.sh.pnmcache import PnmCache,iter_pnm_cached
+from frommle2.sh.pnm import dpn_dlat
+import frommle2.sh.xarraysh
+import xarray as xr
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from warnings import warn
+
+
+class SHFunctional:
+    """Linear functional which is applied to the spherical harmonic coefficients during the synthesis"""
+    def __init__(self,weights=1.0,deriv=None,attrs=None):
+        """
+        parameters:
+            weights: degree dependent factors as a scalar, an array indexed by degree, or a function of the degree array
+            deriv: None, 'lat' for the derivative to latitude or 'lon' for the derivative to longitude divided by cos(lat) (both per radian)
+            attrs: attributes of the synthesized output (e.g. units)
+        """
+        if deriv not in (None,"lat","lon"):
+            raise ValueError(f"Unknown derivative {deriv}")
+        self.weights=weights
+        self.deriv=deriv
+        self.attrs={} if attrs is None else attrs
+
+    def degweights(self,nmax):
+        """Returns the factors for the degrees 0..nmax"""
+        n=np.arange(nmax+1)
+        if callable(self.weights):
+            return np.asarray(self.weights(n),dtype=np.float64)*np.ones(nmax+1)
+        elif np.isscalar(self.weights):
+            return np.full(nmax+1,float(self.weights))
+        else:
+            return np.asarray(self.weights,dtype=np.float64)[0:nmax+1]
+
+
+class YnmFwd(BaseFwd):
+    """Forward operator class which computes a spherical harmonic analysis on a set of geographical coordinates or grid"""
+    isLinear=True
+    def __init__(self,shg,lon=np.arange(-180.0,180.0),lat=np.arange(-90.0,90.0),force2d=False,cache=None):
+        """Initialize the output coordinates
+        parameters:
+        shg: spherical harmonic index as a list of (n,m,t) tuples,multindex or as xr.DataArray, or the maximum degree
+        lon: longitude in degrees as arraylike, or xarray.DataArray
+        lat: latitude in degrees as arraylikem or xarray.DataArray
+        force2d: always map to a grid, also when lon and lat have the same length
+        cache: frommle2.sh.pnmcache.PnmCache (or True for the default cache) to store and reuse the Legendre functions on disk
+        output: Linear operator mapping spherical harmonics to spatial locations (DataArray)
+        """
+
+        #setup the output and input coordinates
+        lon=np.asarray(lon,dtype=np.float64)
+        lat=np.asarray(lat,dtype=np.float64)
+        if not force2d and len(lon) == len(lat):
+            coords={"lon":("npoints",lon),"lat":("npoints",lat)}
+        else:
+            coords={"lon":("lon",lon),"lat":("lat",lat)}
+        if isinstance(shg,(int,np.integer)):
+            shg=xr.DataArray.sh.nmt_mi(shg)
+        elif isinstance(shg,xr.DataArray):
+            shg=shg.get_index("shg")
+        elif not isinstance(shg,pd.MultiIndex):
+            shg=xr.DataArray.sh.mi_fromtuples(shg)
+        coords.update(xr.Coordinates.from_pandas_multiindex(shg,"shg"))
+
+        self.dsout=xr.Dataset(coords=coords)
+        #add some CF attributes to the longitude and latitude so it will be understood by plotting software etc
+        self.dsout.lon.attrs={"units":"degree_east","standard_name":"longitude","axis":"X"}
+        self.dsout.lat.attrs={"units":"degree_north","standard_name":"latitude","axis":"Y"}
+        self.nmax=int(shg.get_level_values("n").max())
+        self.cache=PnmCache() if cache is True else cache
+
+
+    def __call__(self,shxar):
+        """Apply the spherical harmonic analysis"""
+
+        if "npoints" in self.dsout.dims:
+            #map to a set of points
+            return self.analysis1d(shxar)
+        else:
+            #2d map to a grid
+            return self.analysis2d(shxar)
+
+    def functionals(self,shxar,functionals,**kwargs):
+        """Synthesize several functionals of the same coefficients in one pass, which shares the Legendre functions (and their derivatives)
+        parameters:
+            shxar: spherical harmonic coefficients (xr.DataArray), possibly with additional dimensions such as time
+            functionals: dictionary with names and SHFunctional's
+            kwargs: additional arguments for analysis1d or analysis2d
+        returns: xr.Dataset with a variable per functional"""
+        if "npoints" in self.dsout.dims:
+            return self.analysis1d(shxar,functionals=functionals,**kwargs)
+        else:
+            return self.analysis2d(shxar,functionals=functionals,**kwargs)
+
+    def analysis1d(self,shxar,blocksize=1000,nworkers=None,functionals=None):
+        """Map the input to a set of scattered points
+        The points are split in blocks which are evaluated on a thread pool. Per degree, the Legendre functions of a block are
+        multiplied with the coefficients of all epochs at once, so the full Ynm matrix is never formed
+        parameters:
+            shxar: spherical harmonic coefficients (xr.DataArray or xr.Dataset), possibly with additional dimensions such as time
+            blocksize: number of points per block (limits the memory per worker to roughly 3*(nmax+1)*blocksize doubles)
+            nworkers: number of threads (default as chosen by concurrent.futures.ThreadPoolExecutor)
+            functionals: dictionary of SHFunctional's to synthesize in one pass (see functionals)
+        returns: xr.DataArray with dimensions (...,npoints), or a xr.Dataset when functionals are provided"""
+        if isinstance(shxar,xr.Dataset):
+            return self._mapdataset(shxar,lambda da:self.analysis1d(da,blocksize,nworkers,functionals),functionals)
+
+        cnm,auxdims,auxshape=self._cnm(shxar)
+        #stack the additional dimensions: [aux,2,n,m]
+        cnm=cnm.reshape((-1,)+cnm.shape[-3:])
+        lon=self.dsout.lon.values
+        lat=self.dsout.lat.values
+        funcs=[SHFunctional()] if functionals is None else list(functionals.values())
+        outs=[np.empty([cnm.shape[0],len(lon)]) for _ in funcs]
+        if self.cache and self.cache.fits(self.nmax,lat):
+            #make sure the table exists before the threads start reading from it
+            self.cache(self.nmax,lat)
+
+        def evalblock(slc):
+            res=_synthpoints(cnm,lon[slc],lat[slc],iter_pnm_cached(self.nmax,lat,self.cache,rows=slc),funcs)
+            for out,outblk in zip(outs,res):
+                out[:,slc]=outblk
+
+        blocks=[slice(i,min(i+blocksize,len(lon))) for i in range(0,len(lon),blocksize)]
+        if len(blocks) > 1 and nworkers != 1:
+            with ThreadPoolExecutor(max_workers=nworkers) as executor:
+                #consume the results so that exceptions are raised
+                list(executor.map(evalblock,blocks))
+        else:
+            for slc in blocks:
+                evalblock(slc)
+
+        outs=[out.reshape(auxshape+(len(lon),)) for out in outs]
+        return self._output(shxar,outs,functionals,auxdims+("npoints",))
+
+    def _mapdataset(self,ds,synth,functionals):
+        """Synthesize the spherical harmonic variables of a Dataset, variables without a shg dimension are kept
+        With functionals, the output variables are named after the functionals when the Dataset holds a single spherical harmonic variable
+        and '<variable>_<functional>' otherwise"""
+        if functionals is None:
+            return ds.map(lambda da:synth(da) if "shg" in da.dims else da)
+        shvars=[name for name,da in ds.data_vars.items() if "shg" in da.dims]
+        out=[]
+        for name in shvars:
+            dsfunc=synth(ds[name])
+            if len(shvars) > 1:
+                dsfunc=dsfunc.rename({func:f"{name}_{func}" for func in functionals})
+            out.append(dsfunc)
+        out.append(ds[[name for name,da in ds.data_vars.items() if "shg" not in da.dims]].drop_dims("shg",errors="ignore"))
+        return xr.merge(out,combine_attrs="override")
+
+    def _cnm(self,shxar):
+        """Returns the input as a cnm array [...,2,nmax+1,nmax+1], together with the names and shape of the leading dimensions"""
+        if shxar.sh.nmax > self.nmax:
+            warn(f"maximum degree of input dataset will be cut off to {self.nmax}")
+        cnm=shxar.sh.to_cnm(nmax=self.nmax)
+        auxdims=tuple(dim for dim in shxar.transpose(...,"shg").dims if dim != "shg")
+        return cnm,auxdims,cnm.shape[:-3]
+
+    def _output(self,shxar,outs,functionals,dims):
+        """Wrap the synthesized arrays as a xr.DataArray (no functionals) or xr.Dataset"""
+        coords={ky:val for ky,val in shxar.coords.items() if "shg" not in val.dims}
+        coords.update({"lon":self.dsout.lon,"lat":self.dsout.lat})
+        if functionals is None:
+            return xr.DataArray(outs[0],coords=coords,dims=dims,name=shxar.name,attrs=shxar.attrs)
+        return xr.Dataset({name:(dims,out,func.attrs) for (name,func),out in zip(functionals.items(),outs)},coords=coords)
+
+    def analysis2d(self,shxar,method="auto",chunksize=None,functionals=None):
+        """Map the input to a 2d grid
+        The Legendre sums are computed for all latitude rings at once, after which every ring is synthesized along longitude with a real FFT
+        parameters:
+            shxar: spherical harmonic coefficients (xr.DataArray or xr.Dataset), possibly with additional dimensions such as time
+            method: 'fft' (requires equidistant longitudes which divide the circle), 'dft' (direct summation for arbitrary longitudes) or 'auto'
+            chunksize: number of latitude rings which are processed at once (default chooses a block of roughly 64 MiB)
+            functionals: dictionary of SHFunctional's to synthesize in one pass (see functionals)
+        returns: xr.DataArray with dimensions (...,lon,lat), or a xr.Dataset when functionals are provided"""
+        if isinstance(shxar,xr.Dataset):
+            return self._mapdataset(shxar,lambda da:self.analysis2d(da,method,chunksize,functionals),functionals)
+
+        cnm,auxdims,auxshape=self._cnm(shxar)
+        nmax=self.nmax
+        #complex coefficients cnm -i snm stored as [n,aux,m]
+        zcnm=np.moveaxis((cnm[...,0,:,:]-1j*cnm[...,1,:,:]).reshape((-1,nmax+1,nmax+1)),0,1)
+        naux=zcnm.shape[1]
+
+        funcs=[SHFunctional()] if functionals is None else list(functionals.values())
+        weights=[func.degweights(nmax) for func in funcs]
+        needdlat=any(func.deriv == "lat" for func in funcs)
+        lon=self.dsout.lon.values
+        lat=self.dsout.lat.values
+        lonsynth=_LonSynthesis(lon,nmax,method)
+        if chunksize is None:
+            chunksize=max(1,2**26//(16*naux*max(lonsynth.nfft,nmax+1)*len(funcs)))
+
+        outs=[np.empty([len(lat),naux,len(lon)]) for _ in funcs]
+        for ilat in range(0,len(lat),chunksize):
+            latblock=slice(ilat,min(ilat+chunksize,len(lat)))
+            #Legendre sums per latitude ring and order
+            ams=[np.zeros([latblock.stop-latblock.start,naux,nmax+1],dtype=np.complex128) for _ in funcs]
+            for n,pn in iter_pnm_cached(nmax,lat,self.cache,rows=latblock):
+                zpn=pn.T[:,np.newaxis,:]*zcnm[n,:,0:n+1]
+                if needdlat:
+                    zdpn=dpn_dlat(n,pn).T[:,np.newaxis,:]*zcnm[n,:,0:n+1]
+                for func,am,w in zip(funcs,ams,weights):
+                    if w[n] != 0.0:
+                        am[:,:,0:n+1]+=w[n]*(zdpn if func.deriv == "lat" else zpn)
+            for func,am,out in zip(funcs,ams,outs):
+                if func.deriv == "lon":
+                    am*=1j*np.arange(nmax+1)/np.cos(np.deg2rad(lat[latblock]))[:,np.newaxis,np.newaxis]
+                out[latblock]=lonsynth(am)
+
+        #reorder to (...,lon,lat)
+        outs=[np.moveaxis(out,0,-1).reshape(auxshape+(len(lon),len(lat))) for out in outs]
+        return self._output(shxar,outs,functionals,auxdims+("lon","lat"))
+
+
+def _synthpoints(cnm,lon,lat,pniter,funcs):
+    """Synthesize functionals of the coefficients cnm [naux,2,nmax+1,nmax+1] at the points lon,lat, with pniter yielding the Legendre functions of the points per degree
+    returns a list with an array of shape [naux,npoints] per functional"""
+    nmax=cnm.shape[-1]-1
+    m=np.arange(nmax+1)[:,np.newaxis]
+    mlon=m*np.deg2rad(lon)
+    cosml=np.cos(mlon)
+    sinml=np.sin(mlon)
+    weights=[func.degweights(nmax) for func in funcs]
+    derivs=set(func.deriv for func in funcs)
+    outs=[np.zeros([cnm.shape[0],len(lon)]) for _ in funcs]
+    for n,pn in pniter:
+        cn=cnm[:,0,n,0:n+1]
+        sn=cnm[:,1,n,0:n+1]
+        #evaluate every kind of functional once per degree
+        res={}
+        if None in derivs or "lon" in derivs:
+            pcos=pn*cosml[0:n+1]
+            psin=pn*sinml[0:n+1]
+            if None in derivs:
+                res[None]=cn@pcos+sn@psin
+            if "lon" in derivs:
+                res["lon"]=(sn@(m[0:n+1]*pcos)-cn@(m[0:n+1]*psin))/np.cos(np.deg2rad(lat))
+        if "lat" in derivs:
+            dpn=dpn_dlat(n,pn)
+            res["lat"]=cn@(dpn*cosml[0:n+1])+sn@(dpn*sinml[0:n+1])
+        for func,out,w in zip(funcs,outs,weights):
+            if w[n] != 0.0:
+                out+=w[n]*res[func.deriv]
+    return outs
+
+
+class _LonSynthesis:
+    """Synthesizes Fourier coefficients am (cos(m lon) -i sin(m lon)) along a (latitude) ring at the requested longitudes"""
+    def __init__(self,lon,nmax,method="auto"):
+        self.nfft=0
+        dlon=np.diff(lon)
+        uniform=len(lon) > 1 and np.allclose(dlon,dlon[0],rtol=0,atol=1e-9)
+        if uniform:
+            #number of points of the full circle with the grid spacing (must be integer)
+            nglob=360.0/abs(dlon[0])
+            uniform=abs(nglob-round(nglob)) < 1e-6
+        if method == "auto":
+            method="fft" if uniform and _fftcost(round(nglob),nmax) < (nmax+1)*len(lon) else "dft"
+        elif method == "fft" and not uniform:
+            raise ValueError("FFT synthesis requires equidistant longitudes with a spacing which divides 360 degrees")
+
+        if method == "fft":
+            nglob=round(nglob)
+            #refine the FFT grid so that all orders are resolved (nfft > 2 nmax)
+            refine=(2*nmax)//nglob+1
+            self.nfft=nglob*refine
+            #positions of the requested longitudes in the refined grid
+            self.idx=(np.rint((lon-lon[0])/(abs(dlon[0])/refine)).astype(np.int64))%self.nfft
+            #phase shift to the first longitude and the scaling of irfft
+            m=np.arange(nmax+1)
+            self.scale=np.exp(1j*m*np.deg2rad(lon[0]))*self.nfft/2
+            self.scale[0]=self.nfft
+        elif method == "dft":
+            mlon=np.outer(np.arange(nmax+1),np.deg2rad(lon))
+            self.cosml=np.cos(mlon)
+            self.sinml=np.sin(mlon)
+        else:
+            raise ValueError(f"Unknown longitude synthesis method {method}")
+        self.method=method
+
+    def __call__(self,am):
+        """Synthesize am of shape [...,nmax+1] to an array of shape [...,nlon]"""
+        if self.method == "fft":
+            spec=np.zeros(am.shape[:-1]+(self.nfft//2+1,),dtype=np.complex128)
+            spec[...,0:am.shape[-1]]=am*self.scale
+            return np.fft.irfft(spec,n=self.nfft,axis=-1)[...,self.idx]
+        else:
+            return am.real@self.cosml-am.imag@self.sinml
+
+
+def _fftcost(nglob,nmax):
+    nfft=nglob*((2*nmax)//nglob+1)
+    return nfft*np.log2(nfft)
+
+
+class Analysis(YnmFwd):
+    """Spherical harmonic synthesis on a lon/lat grid"""
+    def __init__(self,nmax,lon=np.arange(-180.0,180.0,1.0),lat=np.arange(-90.0,90.0,1.0),cache=None):
+        super().__init__(nmax,lon,lat,force2d=True,cache=cache)
+        self.dskel=self.dsout
+
+    def __call__(self,xarin):
+        """Perform the spherical harmonic analysis
+        returns: xr.Dataset with the gridded values in the variable 'out' and dimensions (...,lon,lat)"""
+        return self.analysis2d(xarin).rename("out").to_dataset()
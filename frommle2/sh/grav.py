@@ -16,43 +16,57 @@
 
 # Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
 
-from frommle2.core import LinearSparseFwd
+import numpy as np
 import xarray as xr
 import frommle2.sh.xarraysh
-from frommle2.constants.earth import a_earth,rho_water,rho_earth
-from sparse import diagonalize
+from frommle2.constants.earth import a_earth,rho_water,rho_earth,GM_earth
+from frommle2.sh.analysis import SHFunctional
+from frommle2.sh.isotropic import IsotropicFwd
 
-class EquivalentWater(LinearSparseFwd):
+class EquivalentWater(IsotropicFwd):
     """Forward operator which computes equivalent water heights (sh coefficients in meter) from Stokes coefficients"""
     def __init__(self,knlove:xr.DataArray,nmax):
         if not isinstance(knlove,xr.DataArray):
             raise TypeError("Expecting Kn load Love numbers as a xarray Datarray")
-        #extract the maximum degree from the input
-        self.nmax=nmax
-        #create a spherical harmonic multindex (which is the same for both re in and output coordinats)
-        incoords=xr.DataArray.sh.nmt_mi(self.nmax)
-        degrees=incoords.get_level_values(level='n').astype(int)
-        #create a sparse diagonal array with the conversion factors from Stokes to eqh in meter
+        #conversion factors from Stokes to eqh in meter per degree
+        degrees=np.arange(nmax+1)
         kn=knlove.interp(degree=degrees).values
-        diagdat=(degrees*2+1)*a_earth*rho_earth/(3*rho_water*(kn+1))
-        dia=diagonalize(diagdat.values)
+        super().__init__((degrees*2+1)*a_earth*rho_earth/(3*rho_water*(kn+1)),"shg")
 
-        super().__init__(xr.DataArray(dia,coords={"shg":("shg",incoords)},dims=["shg_t","shg"],name='eqhconv'),"shg")
 
-        
-    def __call__(self,shxar):
-        
-        nmin=shxar.sh.nmin
-        nmax=shxar.sh.nmax
-
-        nminf=self.dasparse.sh.nmin
-        nmaxf=self.dasparse.sh.nmax
-
-        
-        #compute the dot product 
-        daout=super().__call__(shxar) 
-    
-        #fix the multindex coordinate so that the original SHG index is linked to the output coordinates (they are the same after the dot product)
-        daout=daout.rename({"shg_t":"shg"}).assign_coords(shg=("shg",self.dasparse.get_index('shg')))
-        return daout
 
+def gravity_functionals(names=("geoid","gravity_anomaly"),knlove:xr.DataArray=None,a=a_earth,GM=GM_earth):
+    """Returns gravity functionals which can be synthesized in one pass from (dimensionless) Stokes coefficients with YnmFwd.functionals
+    The functionals are evaluated in spherical approximation on the sphere with radius a
+    parameters:
+        names: names of the functionals, choose from: geoid, potential, gravity_anomaly, gravity_disturbance, radial_derivative,
+               radial_gradient, deflection_north, deflection_east, ewh (which requires the load Love numbers knlove)
+        knlove: Kn load Love numbers as a xarray Datarray with a degree coordinate
+        a: reference radius in meter
+        GM: gravitational constant times the mass of the Earth in m^3/s^2
+    returns: dictionary with names and SHFunctional's"""
+    functionals={}
+    for name in names:
+        if name == "geoid":
+            functionals[name]=SHFunctional(a,attrs={"units":"m","long_name":"geoid height"})
+        elif name == "potential":
+            functionals[name]=SHFunctional(GM/a,attrs={"units":"m^2/s^2","long_name":"disturbing potential"})
+        elif name == "gravity_anomaly":
+            functionals[name]=SHFunctional(lambda n:GM/a**2*(n-1),attrs={"units":"m/s^2","long_name":"gravity anomaly"})
+        elif name == "gravity_disturbance":
+            functionals[name]=SHFunctional(lambda n:GM/a**2*(n+1),attrs={"units":"m/s^2","long_name":"gravity disturbance"})
+        elif name == "radial_derivative":
+            functionals[name]=SHFunctional(lambda n:-GM/a**2*(n+1),attrs={"units":"m/s^2","long_name":"radial derivative of the disturbing potential"})
+        elif name == "radial_gradient":
+            functionals[name]=SHFunctional(lambda n:GM/a**3*(n+1)*(n+2),attrs={"units":"1/s^2","long_name":"second radial derivative of the disturbing potential"})
+        elif name == "deflection_north":
+            functionals[name]=SHFunctional(-1.0,deriv="lat",attrs={"units":"rad","long_name":"north-south deflection of the vertical"})
+        elif name == "deflection_east":
+            functionals[name]=SHFunctional(-1.0,deriv="lon",attrs={"units":"rad","long_name":"east-west deflection of the vertical"})
+        elif name == "ewh":
+            if not isinstance(knlove,xr.DataArray):
+                raise TypeError("Expecting Kn load Love numbers as a xarray Datarray")
+            functionals[name]=SHFunctional(lambda n:(2*n+1)*a*rho_earth/(3*rho_water*(knlove.interp(degree=n).values+1)),attrs={"units":"m","long_name":"equivalent water height"})
+        else:
+            raise ValueError(f"Unknown gravity functional {name}")
+    return functionals
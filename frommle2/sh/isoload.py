@@ -14,20 +14,46 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 # Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
-from frommle2.sh.ynm import Ynm
+from frommle2.sh.ynmbatch import YnmBatch
+from frommle2.sh import shindex
 import xarray as xr
 import numpy as np
+import dask
+import dask.array
 from frommle2.sh.xarraysh import *
 
-def unit(nmax,lon,lat):
-    """Create a unit load in spherical harmonics up to degree nmax, at the specified location"""
-    ynm=Ynm(nmax)
+def unit_nmt(nmax):
+    """Returns the (n,m,t) arrays of the unit load coefficients: ordered by order, then degree with alternating cosine and sine coefficients"""
+    n,m,t=shindex.nmt_arrays(nmax)
+    isort=np.lexsort((t,n,m))
+    return n[isort],m[isort],t[isort]
+
+def unit(nmax,lon,lat,chunksize=1000,lazy=False,cache=None):
+    """Create a unit load in spherical harmonics up to degree nmax, at the specified location
+    parameters:
+        nmax: maximum degree
+        lon,lat: longitudes and latitudes of the points in degrees
+        chunksize: number of points which are evaluated at once (None evaluates all points at once)
+        lazy: return a dask backed DataArray which evaluates the chunks on demand (keeps memory bounded)
+        cache: frommle2.sh.pnmcache.PnmCache (or True for the default cache) to store and reuse the Legendre functions of each chunk on disk"""
+    lon=np.atleast_1d(np.asarray(lon,dtype=np.float64))
+    lat=np.atleast_1d(np.asarray(lat,dtype=np.float64))
     npoints=len(lon)
     if npoints != len(lat):
         raise RuntimeError("Number of longitude points is not consistent with latitude points")
-    uload=np.zeros([len(ynm),npoints])
-    for i,lonlat in enumerate(zip(lon,lat)):
-        uload[:,i]=ynm(lonlat[0],lonlat[1])
-    da=xr.DataArray(uload,coords={"lon":("np",lon),"lat":("np",lat),"shg":("shg",xr.DataArray.sh.mi_fromarrays(ynm.nmt().T))},dims=("shg","np"))
-    return da.sh.build_MultiIndex()
-
+    nmt=unit_nmt(nmax)
+    ynm=YnmBatch(nmax,nmt=nmt,cache=cache)
+    if chunksize is None or chunksize > npoints:
+        chunksize=max(npoints,1)
+    if lazy:
+        blocks=[]
+        for istart in range(0,npoints,chunksize):
+            slc=slice(istart,min(istart+chunksize,npoints))
+            blocks.append(dask.array.from_delayed(dask.delayed(ynm)(lon[slc],lat[slc]),shape=(len(ynm),slc.stop-slc.start),dtype=np.float64))
+        uload=dask.array.concatenate(blocks,axis=1)
+    else:
+        uload=np.empty([len(ynm),npoints])
+        for _ in ynm.chunks(lon,lat,chunksize,out=uload):
+            pass
+    da=xr.DataArray(uload,coords={"lon":("np",lon),"lat":("np",lat)},dims=("shg","np"))
+    return da.assign_coords(xr.Coordinates.from_pandas_multiindex(shindex.mi_fromnmt(*nmt),"shg"))
@@ -0,0 +1,57 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+import numpy as np
+import xarray as xr
+from frommle2.core import DiagonalFwd
+from frommle2.core.alignment import PlanCache
+import frommle2.sh.xarraysh
+
+
+class IsotropicFwd(DiagonalFwd):
+    """Forward operator which scales spherical harmonic coefficients with a factor per degree"""
+    def __init__(self,degfactors,dim="shg"):
+        """
+        parameters:
+            degfactors: factors for the degrees 0..nmax (arraylike)
+            dim: name of the spherical harmonic dimension
+        """
+        self.degfactors=np.asarray(degfactors,dtype=np.float64)
+        self.nmax=len(self.degfactors)-1
+        self.dim=dim
+        self._plans=PlanCache()
+
+    def index(self):
+        return xr.DataArray.sh.nmt_mi(self.nmax)
+
+    def __call__(self,rhs:xr.DataArray):
+        """Executes the forward operator, coefficients with degrees above the maximum degree of the operator are dropped from the output"""
+        if rhs.sh.nmax > self.nmax:
+            rhs=rhs.sh.truncate(nmax=self.nmax)
+        return super().__call__(rhs)
+
+    def diagonal(self,index):
+        """Returns the factors for the entries of a spherical harmonic index (zero for degrees above nmax)"""
+        n=np.asarray(index.get_level_values("n"),dtype=np.int64)
+        return np.where(n <= self.nmax,self.degfactors[np.minimum(n,self.nmax)],0.0)
+
+    def dot(self,otherfwd):
+        """Chain another operator as the right hand side and return a new forward operator (isotropic when otherfwd is isotropic too)"""
+        if isinstance(otherfwd,IsotropicFwd):
+            nmax=min(self.nmax,otherfwd.nmax)
+            return IsotropicFwd(self.degfactors[0:nmax+1]*otherfwd.degfactors[0:nmax+1],self.dim)
+        return super().dot(otherfwd)
@@ -0,0 +1,115 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+import numpy as np
+import xarray as xr
+from scipy.linalg import cho_factor,cho_solve
+from frommle2.sh import shindex
+from frommle2.sh.ynmbatch import YnmBatch
+import frommle2.sh.xarraysh
+
+
+class LSQAnalysis:
+    """Spherical harmonic analysis of samples at arbitrary locations, by least squares or by quadrature with cell areas
+    The normal matrix is set up once per sampling and its Cholesky factorization is kept, so that the coefficients of
+    (many) epochs only require the right hand side and the triangular solves"""
+    def __init__(self,nmax,lon,lat,weights=None,method="lsq",squeeze=True,regularization=0.0,blocksize=2000,designcache=2**29,cache=None):
+        """
+        parameters:
+            nmax: maximum degree of the analysis
+            lon,lat: longitudes and latitudes of the samples in degrees
+            weights: weights of the samples, e.g. cell areas (default equal weights, required for the quadrature method)
+            method: 'lsq' for a weighted least squares fit, or 'quadrature' for a direct integration with weights as cell areas in steradian
+            squeeze: omit the sine coefficients of order zero
+            regularization: factor of a Tikhonov (identity) regularization which is added to the normal matrix
+            blocksize: number of samples for which the spherical harmonics are evaluated at once
+            designcache: maximum size in bytes of the design matrix which is kept in memory for the right hand sides
+            cache: frommle2.sh.pnmcache.PnmCache (or True for the default cache) to store and reuse the Legendre functions on disk
+        """
+        self.lon=np.atleast_1d(np.asarray(lon,dtype=np.float64))
+        self.lat=np.atleast_1d(np.asarray(lat,dtype=np.float64))
+        if self.lon.shape != self.lat.shape:
+            raise ValueError("Number of longitude points is not consistent with latitude points")
+        if method not in ("lsq","quadrature"):
+            raise ValueError(f"Unknown analysis method {method}")
+        if weights is None:
+            if method == "quadrature":
+                raise ValueError("The quadrature method requires the cell areas as weights")
+            weights=np.ones(self.lon.size)
+        self.weights=np.asarray(weights,dtype=np.float64)
+        self.method=method
+        self.nmax=nmax
+        self.squeeze=squeeze
+        self.blocksize=blocksize
+        self.ynm=YnmBatch(nmax,nmt=shindex.nmt_arrays(nmax,0,squeeze),cache=cache)
+
+        nsh=len(self.ynm)
+        #keep the design matrix when it fits in the budget, otherwise it is recomputed blockwise for every call
+        self._design=None
+        if nsh*self.lon.size*8 <= designcache:
+            self._design=np.empty([nsh,self.lon.size])
+            for _ in self.ynm.chunks(self.lon,self.lat,chunksize=blocksize,out=self._design):
+                pass
+
+        self.factor=None
+        if method == "lsq":
+            nmat=np.zeros([nsh,nsh])
+            for slc,ynm in self._iterynm():
+                nmat+=(ynm*self.weights[slc])@ynm.T
+            if regularization > 0:
+                nmat[np.diag_indices(nsh)]+=regularization
+            self.factor=cho_factor(nmat,lower=False,overwrite_a=True)
+
+    def _iterynm(self):
+        """Generator which returns the spherical harmonics of the sample blocks as (slice,array of shape [nsh,nblock])"""
+        if self._design is not None:
+            for istart in range(0,self.lon.size,self.blocksize):
+                slc=slice(istart,min(istart+self.blocksize,self.lon.size))
+                yield slc,self._design[:,slc]
+        else:
+            yield from self.ynm.chunks(self.lon,self.lat,chunksize=self.blocksize)
+
+    def shg(self):
+        """Returns the spherical harmonic coordinates of the output"""
+        return xr.Coordinates.from_pandas_multiindex(shindex.nmt_mi(self.nmax,0,self.squeeze),"shg")
+
+    def __call__(self,data,dim="npoints"):
+        """Estimate spherical harmonic coefficients
+        parameters:
+            data: samples as a xr.DataArray with dimension dim (other dimensions such as time are solved at once), or as numpy array [npoints,...]
+            dim: name of the sample dimension
+        returns: xr.DataArray with dimensions (shg,...)"""
+        if isinstance(data,xr.DataArray):
+            daobs=data.transpose(dim,...)
+        else:
+            daobs=xr.DataArray(data,dims=(dim,)+tuple(f"dim_{i}" for i in range(1,np.ndim(data))))
+        obs=daobs.values.reshape((self.lon.size,-1))
+        wobs=obs*self.weights[:,np.newaxis]
+
+        rhs=np.zeros([len(self.ynm),obs.shape[1]])
+        for slc,ynm in self._iterynm():
+            rhs+=ynm@wobs[slc]
+
+        if self.method == "lsq":
+            coef=cho_solve(self.factor,rhs)
+        else:
+            coef=rhs/(4*np.pi)
+
+        auxdims=daobs.dims[1:]
+        coords={ky:val for ky,val in daobs.coords.items() if dim not in val.dims}
+        daout=xr.DataArray(coef.reshape((len(self.ynm),)+daobs.shape[1:]),coords=coords,dims=("shg",)+auxdims,name=data.name if isinstance(data,xr.DataArray) else None)
+        return daout.assign_coords(self.shg())
@@ -0,0 +1,153 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Vectorized 4-pi normalized associated Legendre functions for arrays of latitudes
+The recursion is carried out in extended range arithmetic (Fukushima 2012, J Geod 86:271-285): every order keeps an
+integer exponent per latitude, so that the sectorial terms do not underflow near the poles for very high degrees"""
+
+import numpy as np
+
+#exponent step of the extended range numbers: value = mantissa * 2**(IND*exponent)
+IND=960
+BIG=2.0**IND
+BIGI=2.0**-IND
+BIGS=2.0**(IND//2)
+BIGSI=2.0**-(IND//2)
+
+
+def iter_pnm(nmax,lat,dtype=np.float64):
+    """Generator which streams the associated Legendre functions degree by degree
+    parameters:
+        nmax: maximum degree
+        lat: latitudes in degrees (arraylike)
+        dtype: floating point type of the yielded arrays (the recursion itself is always carried out in float64)
+    yields: (n,pn) with pn an array of shape [n+1,nlat] holding the orders 0..n
+    Note: the yielded array is reused in the next iteration, so copy it when it needs to be kept"""
+    latr=np.deg2rad(np.atleast_1d(np.asarray(lat,dtype=np.float64)))
+    costheta=np.sin(latr)
+    sintheta=np.cos(latr)
+    nlat=latr.size
+    #mantissas of degree n, n-1 and n-2
+    pnmin1=np.zeros([nmax+1,nlat])
+    pnmin2=np.zeros([nmax+1,nlat])
+    pn=np.zeros([nmax+1,nlat])
+    #exponents per order and latitude
+    ex=np.zeros([nmax+1,nlat],dtype=np.int64)
+    #first order from which extended range numbers are in use
+    mscaled=nmax+1
+    #output buffer for the conversion to ordinary floating point numbers
+    pnout=np.empty([nmax+1,nlat],dtype=dtype)
+
+    pn[0]=1.0
+    pnout[0]=pn[0]
+    yield 0,pnout[0:1]
+    for n in range(1,nmax+1):
+        pnmin2,pnmin1,pn=pnmin1,pn,pnmin2
+        m=np.arange(n-1)
+        #non-sectorial orders (m < n-1) from the two previous degrees
+        if n > 1:
+            anm=np.sqrt((2*n+1.0)*(2*n-1.0)/((n-m)*(n+m)))[:,np.newaxis]
+            bnm=np.sqrt((2*n+1.0)*(n+m-1.0)*(n-m-1.0)/((2*n-3.0)*(n+m)*(n-m)))[:,np.newaxis]
+            np.multiply(anm*costheta,pnmin1[0:n-1],out=pn[0:n-1])
+            pn[0:n-1]-=bnm*pnmin2[0:n-1]
+        #sub-diagonal and sectorial terms
+        pn[n-1]=np.sqrt(2*n+1.0)*costheta*pnmin1[n-1]
+        if n == 1:
+            pn[n]=np.sqrt(3.0)*sintheta
+        else:
+            pn[n]=np.sqrt((2*n+1.0)/(2*n))*sintheta*pnmin1[n-1]
+        #the new sectorial order inherits the exponent of its predecessor, and is scaled up when it becomes too small
+        ex[n]=ex[n-1]
+        small=(np.abs(pn[n]) < BIGSI) & (pn[n] != 0.0)
+        if small.any():
+            pn[n,small]*=BIG
+            ex[n,small]-=1
+            mscaled=min(mscaled,n)
+
+        if mscaled > n:
+            #no extended range numbers in use (yet)
+            pnout[0:n+1]=pn[0:n+1]
+        else:
+            #return scaled orders to the ordinary range when their mantissa becomes large
+            scl=ex[mscaled:n+1]
+            large=(scl < 0) & (np.abs(pn[mscaled:n+1]) >= BIGS)
+            if large.any():
+                pn[mscaled:n+1][large]*=BIGI
+                pnmin1[mscaled:n+1][large]*=BIGI
+                scl[large]+=1
+            pnout[0:mscaled]=pn[0:mscaled]
+            pnout[mscaled:n+1]=_xnorm(pn[mscaled:n+1],scl)
+        yield n,pnout[0:n+1]
+
+
+def _xnorm(mantissa,ex):
+    """Converts extended range numbers to ordinary floating point numbers (values below the range underflow to zero)"""
+    return np.where(ex == 0,mantissa,np.ldexp(mantissa,np.maximum(ex,-2)*IND))
+
+
+def pnm_nm(nmax):
+    """Returns the degree and order arrays of the Legendre table (sorted by degree, then order)"""
+    n=np.repeat(np.arange(nmax+1),np.arange(1,nmax+2))
+    m=np.arange(len(n))-n*(n+1)//2
+    return n,m
+
+
+def pnm_index(n,m):
+    """Returns the position of the degree and order in the Legendre table"""
+    return n*(n+1)//2+m
+
+
+def pnm(nmax,lat,dtype=np.float64,out=None):
+    """Computes a full table of 4-pi normalized associated Legendre functions
+    parameters:
+        nmax: maximum degree
+        lat: latitudes in degrees (arraylike)
+        dtype: floating point type of the output
+        out: optional preallocated output of shape [nlat,nsh]
+    returns: array of shape [nlat,nsh] with the degree and order positions given by pnm_index"""
+    lat=np.atleast_1d(lat)
+    if out is None:
+        out=np.empty([lat.size,(nmax+1)*(nmax+2)//2],dtype=dtype)
+    for n,pn in iter_pnm(nmax,lat,dtype=out.dtype):
+        out[:,pnm_index(n,0):pnm_index(n+1,0)]=pn.T
+    return out
+
+
+def dpn_dlat(n,pn,out=None):
+    """Computes the derivative to latitude of the Legendre functions of degree n from the orders of the same degree
+    The relation is free of singularities at the poles, so it can be applied to the output of iter_pnm directly
+    parameters:
+        n: degree
+        pn: array of shape [n+1,nlat] with the Legendre functions of degree n
+        out: optional output array of the same shape
+    returns: array of shape [n+1,nlat] with the derivatives (per radian)"""
+    if out is None:
+        out=np.empty(pn.shape,dtype=pn.dtype)
+    if n == 0:
+        out[...]=0.0
+        return out
+    m=np.arange(n+1)
+    #dPnm/dlat = -dPnm/dtheta = 1/2 (cup P_n,m+1 - cdown P_n,m-1)
+    cup=0.5*np.sqrt((n-m[0:n])*(n+m[0:n]+1.0))[:,np.newaxis]
+    cdown=0.5*np.sqrt((n+m[1:])*(n-m[1:]+1.0))[:,np.newaxis]
+    #corrections for the 4-pi normalization of order 0
+    cup[0]*=np.sqrt(2.0)
+    cdown[0]*=np.sqrt(2.0)
+    np.multiply(cup,pn[1:],out=out[0:n])
+    out[n]=0.0
+    out[1:]-=cdown*pn[0:n]
+    return out
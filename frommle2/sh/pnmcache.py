@@ -0,0 +1,144 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Persistent on-disk cache of Legendre tables, which are shared between processes as read-only memory maps"""
+
+import os
+import hashlib
+import threading
+import numpy as np
+from frommle2.core.logger import logger
+from frommle2.sh.pnm import iter_pnm,pnm,pnm_index
+
+#normalization of the Legendre functions which are computed by frommle2.sh.pnm
+NORMALIZATION="4pi"
+
+
+class PnmCache:
+    """Directory of precomputed Legendre tables (.npy files) with least recently used eviction against a disk budget"""
+    def __init__(self,cachedir=None,budget=2**32):
+        """
+        parameters:
+            cachedir: directory to store the tables (defaults to $FROMMLE2_CACHE or ~/.cache/frommle2, with a subdirectory pnm)
+            budget: maximum size of the cache in bytes
+        """
+        if cachedir is None:
+            cachedir=os.path.join(os.environ.get("FROMMLE2_CACHE",os.path.join(os.path.expanduser('~'),'.cache','frommle2')),'pnm')
+        self.cachedir=cachedir
+        self.budget=budget
+        os.makedirs(self.cachedir,exist_ok=True)
+
+    @staticmethod
+    def key(nmax,lat,dtype=np.float64):
+        """Returns the hash which identifies a table of (lat,nmax,normalization,dtype)"""
+        hsh=hashlib.sha1(np.ascontiguousarray(lat,dtype=np.float64).tobytes())
+        hsh.update(f"{nmax}:{NORMALIZATION}:{np.dtype(dtype).str}".encode())
+        return hsh.hexdigest()
+
+    def path(self,nmax,lat,dtype=np.float64):
+        return os.path.join(self.cachedir,self.key(nmax,lat,dtype)+".npy")
+
+    @staticmethod
+    def nbytes(nmax,lat,dtype=np.float64):
+        """Returns the size of a table in bytes"""
+        return np.atleast_1d(lat).size*pnm_index(nmax+1,0)*np.dtype(dtype).itemsize
+
+    def fits(self,nmax,lat,dtype=np.float64):
+        """Returns whether a table fits in the budget of the cache"""
+        return self.nbytes(nmax,lat,dtype) <= self.budget
+
+    def __call__(self,nmax,lat,dtype=np.float64):
+        """Returns the Legendre table [nlat,nsh] (see frommle2.sh.pnm.pnm) as a read-only memory map, computes and stores it when needed
+        Tables which are larger than the budget are computed in memory and not stored"""
+        lat=np.atleast_1d(np.asarray(lat,dtype=np.float64))
+        fname=self.path(nmax,lat,dtype)
+        try:
+            table=np.load(fname,mmap_mode='r')
+            #mark as recently used
+            os.utime(fname)
+            return table
+        except FileNotFoundError:
+            pass
+        nbytes=self.nbytes(nmax,lat,dtype)
+        if nbytes > self.budget:
+            logger.warning(f"Legendre table of {nbytes} bytes exceeds the cache budget of {self.budget} bytes, computing it in memory")
+            return pnm(nmax,lat,dtype=dtype)
+        self.evict(self.budget-nbytes)
+        logger.info(f"Storing Legendre table for nmax={nmax} and {lat.size} latitudes in {fname}")
+        #write to a temporary file first, so that other processes never see a partial table
+        tmpname=f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            out=np.lib.format.open_memmap(tmpname,mode='w+',dtype=dtype,shape=(lat.size,pnm_index(nmax+1,0)))
+            pnm(nmax,lat,out=out)
+            out.flush()
+            del out
+            os.replace(tmpname,fname)
+        finally:
+            #don't leave a partial table behind when the computation failed
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+        return np.load(fname,mmap_mode='r')
+
+    def entries(self):
+        """Returns a list of (path,size,last used time) of the cached tables, sorted from least to most recently used"""
+        entries=[]
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith(".npy"):
+                try:
+                    st=entry.stat()
+                except FileNotFoundError:
+                    #removed by another process
+                    continue
+                entries.append((entry.path,st.st_size,st.st_mtime))
+        return sorted(entries,key=lambda x:x[2])
+
+    def size(self):
+        return sum(sz for _,sz,_ in self.entries())
+
+    def evict(self,budget=None):
+        """Removes the least recently used tables until the cache fits in the budget (defaults to the budget of the cache)"""
+        if budget is None:
+            budget=self.budget
+        entries=self.entries()
+        total=sum(sz for _,sz,_ in entries)
+        for fname,sz,_ in entries:
+            if total <= budget:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            total-=sz
+
+    def clear(self):
+        self.evict(0)
+
+
+def iter_pnm_cached(nmax,lat,cache=None,dtype=np.float64,rows=slice(None)):
+    """Same as frommle2.sh.pnm.iter_pnm, but takes the Legendre functions from a PnmCache when provided
+    parameters:
+        cache: PnmCache, True for the default cache, or None/False to compute the functions on the fly
+        rows: subset of the latitudes which is yielded (the cached table is always stored for the complete latitude vector)"""
+    if cache is True:
+        cache=PnmCache()
+    if not cache or not cache.fits(nmax,lat,dtype):
+        #tables larger than the budget of the cache are not stored
+        yield from iter_pnm(nmax,np.atleast_1d(lat)[rows],dtype=dtype)
+        return
+    table=cache(nmax,lat,dtype)[rows]
+    for n in range(nmax+1):
+        yield n,table[:,pnm_index(n,0):pnm_index(n+1,0)].T
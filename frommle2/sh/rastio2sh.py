@@ -19,12 +19,140 @@
 from pyshtools.expand import SHExpandDH
 import numpy as np
 import xarray as xr
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
+from contextlib import nullcontext
+import threading
 
 import frommle2.sh.xarraysh
+from frommle2.sh.pnm import iter_pnm
 
 def rastio2shDH(rio,nmax=100,squeeze=True):
     """Converts an equidistant (sub) grid to spherical harmonic 4-pi normalized coefficients, using the Driscoll Healy approach using shtools"""
 
+    window,roll=_globalwindow(rio)
+    globrast=rio.read(1,window=window,boundless=True)
+    if roll:
+        #shift the array to 0 360 (which is what SHExpandDH expects)
+        globrast=np.roll(globrast,roll,axis=1)
+
+
+    clm=_expandDH(globrast,nmax)
+
+    return xr.DataArray.sh.from_cnm(clm,squeeze=squeeze)
+
+
+def rastio2shDH_stack(rio,nmax=100,squeeze=True,bands=None,dim="band",coords=None,chunksize=16,nworkers=None,processes=False):
+    """Converts a multi-band equidistant (sub) grid to spherical harmonic 4-pi normalized coefficients (Driscoll Healy approach using shtools)
+    parameters:
+        rio: opened rasterio dataset
+        nmax: maximum degree of the expansion
+        squeeze: omit the sine coefficients of order zero
+        bands: list of (1-based) bands to expand (default all bands)
+        dim: name of the stacking dimension
+        coords: coordinate values of the stacking dimension (e.g. times, defaults to the band numbers)
+        chunksize: number of bands which are read at once
+        nworkers: number of processes which run the expansions (only used with processes)
+        processes: expand the bands of a chunk in parallel on a pool of processes. The shtools expansions are not thread safe,
+                   so without processes they run one at a time in the calling thread, while a reader thread fetches the next chunk
+    returns: xr.DataArray with dimensions (dim,shg)"""
+    if bands is None:
+        bands=list(range(1,rio.count+1))
+    if coords is None:
+        coords=bands
+    #the window geometry is the same for all bands
+    window,roll=_globalwindow(rio)
+
+    def readchunk(istart):
+        globrast=rio.read(bands[istart:istart+chunksize],window=window,boundless=True)
+        if roll:
+            globrast=np.roll(globrast,roll,axis=2)
+        return globrast
+
+    cnm=np.zeros([len(bands),2,nmax+1,nmax+1])
+    starts=list(range(0,len(bands),chunksize))
+    with ThreadPoolExecutor(max_workers=1) as reader,(ProcessPoolExecutor(max_workers=nworkers) if processes else nullcontext()) as executor:
+        nextchunk=reader.submit(readchunk,starts[0]) if starts else None
+        for k,istart in enumerate(starts):
+            globrast=nextchunk.result()
+            #read the next chunk while the current one is expanded
+            if k+1 < len(starts):
+                nextchunk=reader.submit(readchunk,starts[k+1])
+            if executor is None:
+                clms=(_expandDH(rast,nmax) for rast in globrast)
+            else:
+                clms=executor.map(_expandDH,globrast,[nmax]*len(globrast))
+            for i,clm in enumerate(clms):
+                cnm[istart+i]=clm
+
+    return xr.DataArray.sh.from_cnm(cnm,squeeze=squeeze,dim=dim,coords=coords)
+
+
+def rastio2shDH_stream(rio,nmax=100,squeeze=True,bands=1,nrows=256,dim="band",coords=None):
+    """Converts an equidistant (sub) grid to spherical harmonic 4-pi normalized coefficients (same quadrature as rastio2shDH),
+    while streaming the raster in latitude bands. Regions outside the raster are treated as zero without reading them,
+    so the peak memory scales with one latitude band of the raster instead of the global grid
+    parameters:
+        rio: opened rasterio dataset
+        nmax: maximum degree of the expansion
+        squeeze: omit the sine coefficients of order zero
+        bands: (1-based) band or list of bands to expand
+        nrows: number of raster rows which are read and processed at once
+        dim: name of the stacking dimension (when a list of bands is provided)
+        coords: coordinate values of the stacking dimension (defaults to the band numbers)
+    returns: xr.DataArray with dimensions shg or (dim,shg)"""
+    stacked=not np.isscalar(bands)
+    bandlist=list(bands) if stacked else [bands]
+    window,roll=_globalwindow(rio)
+    gheight=window[0][1]-window[0][0]
+    gwidth=window[1][1]-window[1][0]
+    if nmax > gheight//2-1:
+        raise ValueError(f"The maximum degree of the raster is {gheight//2-1}")
+    ddist=180.0/gheight
+    #offsets of the raster in the global Driscoll Healy grid (which starts at 90N and 0E)
+    rowoff=-window[0][0]
+    coloff=(-window[1][0]+roll)%gwidth
+    ncols=min(rio.width,window[1][1])
+    m=np.arange(nmax+1)
+    #phase shift of the first raster column
+    phase=np.exp(-2j*np.pi*m*coloff/gwidth)
+
+    cnm=np.zeros([len(bandlist),2,nmax+1,nmax+1])
+    for r0 in range(max(0,-rowoff),min(rio.height,gheight-rowoff),nrows):
+        r1=min(r0+nrows,rio.height,gheight-rowoff)
+        block=rio.read(bandlist,window=((r0,r1),(0,ncols))).astype(np.float64)
+        #Fourier coefficients per row (zero padded to the full circle)
+        fm=np.fft.rfft(block,n=gwidth,axis=-1)[...,0:nmax+1]*phase
+        grow=np.arange(r0,r1)+rowoff
+        wfm=fm*_dhweights(grow,gheight)[:,np.newaxis]
+        for n,pn in iter_pnm(nmax,90.0-grow*ddist):
+            cs=np.einsum("mi,bim->bm",pn,wfm[...,0:n+1])
+            cnm[:,0,n,0:n+1]+=cs.real
+            cnm[:,1,n,0:n+1]-=cs.imag
+
+    if not stacked:
+        return xr.DataArray.sh.from_cnm(cnm[0],squeeze=squeeze)
+    if coords is None:
+        coords=bandlist
+    return xr.DataArray.sh.from_cnm(cnm,squeeze=squeeze,dim=dim,coords=coords)
+
+
+def _dhweights(rows,gheight):
+    """Returns the Driscoll Healy quadrature weights (including the normalization of the 4-pi normalized coefficients) of the global rows"""
+    theta=np.pi*np.asarray(rows)/gheight
+    k=np.arange(gheight//2)
+    return np.sin(theta)*np.sum(np.sin(np.outer(theta,2*k+1))/(2*k+1),axis=1)/gheight**2
+
+
+#shtools (and its FFTW plans) may not be called from several threads at once
+_shtoolslock=threading.Lock()
+
+def _expandDH(globrast,nmax):
+    with _shtoolslock:
+        return SHExpandDH(globrast,sampling=2,lmax_calc=nmax)
+
+
+def _globalwindow(rio):
+    """Returns the boundless window which extends the raster to a global grid (0..360 or -180..180), and the shift needed to start at 0 degrees"""
     if rio.crs.to_epsg() != 4326:
         raise NotImplementedError("Cannot yet handle non crs-4326 projections")
 
@@ -54,14 +182,6 @@ def rastio2shDH(rio,nmax=100,squeeze=True):
     gheight=int(180/ddist)
     gwidth=2*gheight
     #construct a global numpy grid (extend the grid to 0,360 and -90,90)
-    globrast=rio.read(1,window=((-ithPixFrom90N,gheight-ithPixFrom90N),(-ithPixFromLeft,gwidth-ithPixFromLeft)),boundless=True)
-    if shft  == -180.0:
-        #shift the array to 0 360 (which is what SHExpandDH expects)
-        globrast=np.roll(globrast,int(gwidth/2),axis=1)
-
-
-    clm=SHExpandDH(globrast,sampling=2,lmax_calc=nmax)
-
-    return xr.DataArray.sh.from_cnm(clm,squeeze=squeeze)
-    
-
+    window=((-ithPixFrom90N,gheight-ithPixFrom90N),(-ithPixFromLeft,gwidth-ithPixFromLeft))
+    roll=int(gwidth/2) if shft == -180.0 else 0
+    return window,roll
@@ -15,45 +15,90 @@
 
 # Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2021
 
-from frommle2.io.binv_legacy import readBINV
-from frommle2.core import LinearSparseFwd
+from frommle2.io.binv_legacy import readBINV,getBDblocks,getBDsparse
+from frommle2.core import LinearSparseFwd,BlockDiagonalFwd
+from frommle2.core.alignment import AlignmentPlan,PlanCache,apply_aligned,dim_index
+from frommle2.core.sparse_backends import make_backend
+from dask.array.core import einsum_lookup
+from functools import cached_property
+import numpy as np
 import xarray as xr
+import sparse
 from copy import copy
 from frommle2.core.logger import logger
-import sparse
 
 class SHfilter(LinearSparseFwd):
-    def __init__(self,ffile,transpose=False):
-        ddkdict=readBINV(ffile,unpack=True)
+    def __init__(self,ffile,transpose=False,blockdiag=True,nworkers=None,backend="auto"):
+        """Spherical harmonic filter (e.g. DDK) read from a block diagonal BINV file
+        parameters:
+            ffile: filename of the filter
+            transpose: apply the transpose of the filter
+            blockdiag: apply the filter with batched dense products of its diagonal blocks instead of a generic sparse product
+            nworkers: number of threads which apply the blocks (only used with blockdiag)
+            backend: sparse storage backend which is used when blockdiag is False (see frommle2.core.sparse_backends)"""
+        ddkdict=readBINV(ffile)
         #create a multindex from the side description
         nmt=[(int(tag[4:7]),int(tag[7:11]),int(tag[1:2] == 'S')) for tag in ddkdict['side1_d']]
         shmi=xr.DataArray.sh.mi_fromtuples(nmt)
-        dim="shg"
-        if transpose:
-            # create an xarray object with a  multindex for the spherical hamronics
-            dasparse=xr.DataArray(ddkdict['mat'],coords={"shg":("shg",shmi)},dims=["shg","shg_t"],name="ddk")
+        #LinearSparseFwd.__init__ is not called: its sparse matrix (dasparse, mat and backend) is provided by the cached properties below
+        self.dim="shg"
+        self.outindex=None
+        self._plans=PlanCache()
+        self._ddkdict=ddkdict
+        self._shmi=shmi
+        self._transpose=transpose
+        self._backendname=backend
+        if blockdiag:
+            #keep the dense blocks for a faster application, the sparse representation is only built when it is needed (e.g. by dot)
+            self.bdfwd=BlockDiagonalFwd(getBDblocks(ddkdict),shmi,self.dim,transpose=transpose,nworkers=nworkers)
         else:
-            # create an xarray object with a  multindex for the spherical hamronics
-            dasparse=xr.DataArray(ddkdict['mat'],coords={"shg":("shg",shmi)},dims=["shg_t","shg"],name="ddk")
-        
-        super().__init__(dasparse,dim)
+            self.bdfwd=None
+            #the sparse product needs the matrix and its backend right away
+            self.backend
 
-    def __call__(self,shxar):
-            
-            nmin=shxar.sh.nmin
-            nmax=shxar.sh.nmax
+    @cached_property
+    def _dacoo(self):
+        """Sparse (COO) matrix of the filter as xr.DataArray"""
+        # create an xarray object with a  multindex for the spherical hamronics
+        dims=["shg","shg_t"] if self._transpose else ["shg_t","shg"]
+        return xr.DataArray(getBDsparse(self._ddkdict),coords={"shg":("shg",self._shmi)},dims=dims,name="ddk")
 
-            nminf=self.dasparse.sh.nmin
-            nmaxf=self.dasparse.sh.nmax
+    @cached_property
+    def dasparse(self):
+        """Sparse matrix of the filter as a single chunk dask array"""
+        einsum_lookup.register(sparse.COO,LinearSparseFwd.einsumReplace)
+        return self._dacoo.chunk({dim:-1 for dim in self._dacoo.dims})
 
-            #compute the dot product 
-            dsfiltered=super().__call__(shxar) 
+    @cached_property
+    def mat(self):
+        """Sparse matrix of the filter oriented as (output,input)"""
+        return self._dacoo.transpose("shg_t","shg").data
 
-            #fix the multindex coordinate so that the original SHG index is linked to the output coordinates (they are the same after the dot product)
-            dsfiltered=dsfiltered.rename({"shg_t":"shg"}).assign_coords(shg=("shg",self.dasparse.get_index('shg')))
-            #add back in non-filtered elements and take out coefficients with degrees higher than nmax input
-            if nmin < nminf:
-                logger.info(f"Restoring original coefficients below {nminf}")
-                dsfiltered=xr.concat([shxar.where(shxar.shg.n < nminf,drop=True),dsfiltered],dim="shg")
-            return dsfiltered.where(dsfiltered.shg.n <= nmax,drop=True)
+    @cached_property
+    def backend(self):
+        """Sparse storage backend of the filter matrix"""
+        return make_backend(self.mat,self._backendname)
+
+    def __call__(self,shxar):
+        """Filters spherical harmonic coefficients, coefficients below the minimum degree of the filter are passed through unchanged,
+        and the output is truncated to the maximum degree of the input"""
+        #the alignment with the filter is computed once per distinct input index
+        plan=self._plans(dim_index(shxar,"shg"),self._buildplan)
+        matmul=self._matmul if self.bdfwd is None else self.bdfwd._applyblocks
+        return apply_aligned(shxar,"shg",plan,matmul,len(self._shmi),outindex=plan.outindex)
 
+    def _buildplan(self,inindex):
+        """Returns the AlignmentPlan of an input index"""
+        shmi=self._shmi
+        nminf=shmi.get_level_values("n").min()
+        nin=inindex.get_level_values("n")
+        #take out coefficients with degrees higher than nmax input
+        keep=np.nonzero(shmi.get_level_values("n") <= nin.max())[0]
+        passthrough=None
+        outindex=shmi[keep]
+        if nin.min() < nminf:
+            #add back in non-filtered elements
+            logger.info(f"Restoring original coefficients below {nminf}")
+            passthrough=np.nonzero(nin < nminf)[0]
+            outindex=inindex[passthrough].append(outindex)
+        return AlignmentPlan(shmi,inindex,keep=keep,passthrough=passthrough,outindex=outindex)
@@ -15,6 +15,8 @@
 
 # Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2021
 from frommle2.core.guide import FrGuide
+from frommle2.sh import shindex
+import pandas as pd
 from enum import Enum
 from functools import total_ordering
 
@@ -37,9 +39,10 @@ class ShGuide(FrGuide):
 
     @staticmethod
     def nmt(nmax,nmin=0,squeeze=False):
-        """ create a multindex guide which varies with n, then m, and than trigonometric sign"""
-        if squeeze:
-            nmt=[(n,m,t) for t in [trig.c,trig.s] for n in range(nmin,nmax+1) for m in range(n+1) if not (m == 0 and t == trig.s) ]
-        else:
-            nmt=[(n,m,t) for t in [trig.c,trig.s] for n in range(nmin,nmax+1) for m in range(n+1)]
-        return ShGuide(nmt)
+        """ create a multindex guide which varies with n, then m, and than trigonometric sign (stored as integers)"""
+        mi=shindex.nmt_mi(nmax,nmin,squeeze)
+        #construct directly from the (cached) levels and codes, bypassing the tuple based constructor
+        guide=pd.MultiIndex.__new__(ShGuide,levels=mi.levels,codes=mi.codes,names=mi.names,verify_integrity=False)
+        guide.nmax=nmax
+        guide.nmin=nmin
+        return guide
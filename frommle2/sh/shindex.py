@@ -0,0 +1,434 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+"""Closed form layout of spherical harmonic (n,m,t) indices
+
+The default frommle2 ordering varies with n, then m and then the trigonometric sign t,
+so that all cosine coefficients precede the sine coefficients:
+
+    for t in (c,s): for n in range(nmin,nmax+1): for m in range(n+1)
+
+When squeezed, the (always zero) sine coefficients with m=0 are left out.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.core.indexes import Index
+from xarray.core.indexing import IndexSelResult
+from functools import lru_cache
+
+
+def ncos(nmax,nmin=0):
+    """Number of cosine coefficients with nmin <= n <= nmax"""
+    if nmax < nmin:
+        return 0
+    return ((nmax+1)*(nmax+2)-nmin*(nmin+1))//2
+
+def nsin(nmax,nmin=0,squeeze=False):
+    """Number of sine coefficients with nmin <= n <= nmax"""
+    if not squeeze:
+        return ncos(nmax,nmin)
+    if nmax < nmin:
+        return 0
+    return (nmax*(nmax+1)-nmin*(nmin-1))//2
+
+
+def nm_arrays(nmax,nmin=0,mstart=0):
+    """Returns degree and order arrays of a single trigonometric block (n varying slowest), with orders starting from mstart"""
+    degrees=np.arange(nmin,nmax+1,dtype=np.int64)
+    nord=np.maximum(degrees+1-mstart,0)
+    n=np.repeat(degrees,nord)
+    #the order is the position relative to the start of each degree
+    m=np.arange(n.size,dtype=np.int64)-np.repeat(np.cumsum(nord)-nord,nord)+mstart
+    return n,m
+
+
+def nmt_arrays(nmax,nmin=0,squeeze=False):
+    """Returns integer arrays of degree, order and trigonometric type in the default frommle2 ordering"""
+    nc,mc=nm_arrays(nmax,nmin)
+    if squeeze:
+        ns,ms=nm_arrays(nmax,nmin,mstart=1)
+    else:
+        ns,ms=nc,mc
+    n=np.concatenate([nc,ns])
+    m=np.concatenate([mc,ms])
+    t=np.repeat(np.array([0,1],dtype=np.int64),[nc.size,ns.size])
+    return n,m,t
+
+
+def mi_fromnmt(n,m,t):
+    """Creates a (n,m,t) pandas MultiIndex from integer arrays without factorizing the values"""
+    n=np.asarray(n,dtype=np.int64)
+    m=np.asarray(m,dtype=np.int64)
+    t=np.asarray(t,dtype=np.int64)
+    if n.size == 0:
+        return pd.MultiIndex.from_arrays([n,m,t],names=["n","m","t"])
+    nmin=n.min()
+    nmax=n.max()
+    #the codes follow directly from the integer values so no hashing is needed
+    levels=[np.arange(nmin,nmax+1,dtype=np.int64),np.arange(0,nmax+1,dtype=np.int64),np.array([0,1],dtype=np.int64)]
+    codes=[n-nmin,m,t]
+    return pd.MultiIndex(levels=levels,codes=codes,names=["n","m","t"],verify_integrity=False)
+
+
+@lru_cache(maxsize=32)
+def _nmt_mi_cached(nmax,nmin,squeeze):
+    return mi_fromnmt(*nmt_arrays(nmax,nmin,squeeze))
+
+def nmt_mi(nmax,nmin=0,squeeze=False):
+    """Returns a (cached) MultiIndex which varies with n, then m, and then the trigonometric sign
+    Note: the returned index is shared between callers with the same arguments (pandas indices are immutable)"""
+    if nmax < nmin:
+        raise ValueError(f"nmax ({nmax}) should be larger or equal than nmin ({nmin})")
+    return _nmt_mi_cached(int(nmax),int(nmin),bool(squeeze))
+
+def clear_cache():
+    """Empties the process wide cache of spherical harmonic indices and cnm conversion plans"""
+    _nmt_mi_cached.cache_clear()
+    _cnm_plan_cached.cache_clear()
+
+
+def pack_nmt(n,m,t):
+    """Packs degree, order and trigonometric type in a single int64 key (n*2**32+m*2+t)"""
+    return (np.asarray(n,dtype=np.int64) << 32) | (np.asarray(m,dtype=np.int64) << 1) | np.asarray(t,dtype=np.int64)
+
+def unpack_nmt(key):
+    """Unpacks int64 keys created with pack_nmt into degree, order and trigonometric type arrays"""
+    key=np.asarray(key,dtype=np.int64)
+    return key >> 32,(key >> 1) & 0x7FFFFFFF,key & 1
+
+
+@lru_cache(maxsize=32)
+def _cnm_plan_cached(nmax,nmin,squeeze,ncnm):
+    plan=cnm_flatindex(*nmt_arrays(nmax,nmin,squeeze),ncnm)
+    plan.flags.writeable=False
+    return plan
+
+def cnm_plan(nmax,nmin=0,squeeze=False,ncnm=None):
+    """Returns the (cached) positions of the default ordering in a flattened shtools style [2,ncnm,ncnm] array
+    ncnm defaults to nmax+1"""
+    if ncnm is None:
+        ncnm=nmax+1
+    if ncnm <= nmax:
+        raise ValueError(f"cnm array with {ncnm} degrees is too small to hold degree {nmax}")
+    return _cnm_plan_cached(int(nmax),int(nmin),bool(squeeze),int(ncnm))
+
+def cnm_flatindex(n,m,t,ncnm):
+    """Computes the position of (n,m,t) in a flattened shtools style [2,ncnm,ncnm] array"""
+    return (np.asarray(t,dtype=np.int64)*ncnm+np.asarray(n,dtype=np.int64))*ncnm+np.asarray(m,dtype=np.int64)
+
+
+def nmt_position(n,m,t,nmax,nmin=0,squeeze=False):
+    """Computes the (vectorized) position of (n,m,t) in the default ordering, invalid entries are set to -1"""
+    n=np.asarray(n,dtype=np.int64)
+    m=np.asarray(m,dtype=np.int64)
+    t=np.asarray(t,dtype=np.int64)
+    poscos=(n*(n+1)-nmin*(nmin+1))//2+m
+    if squeeze:
+        possin=ncos(nmax,nmin)+(n*(n-1)-nmin*(nmin-1))//2+m-1
+    else:
+        possin=ncos(nmax,nmin)+poscos
+    valid=(n >= nmin) & (n <= nmax) & (m >= 0) & (m <= n) & ((t == 0) | ((t == 1) & ((m > 0) | (not squeeze))))
+    return np.where(valid,np.where(t == 0,poscos,possin),-1)
+
+
+def degree_slices(layout,nmax=None,nmin=None,trigs=(0,1)):
+    """Returns the contiguous slices (one per trigonometric type) which hold the degrees nmin <= n <= nmax of a layout (nmax,nmin,squeeze)"""
+    lnmax,lnmin,squeeze=layout
+    nmax=lnmax if nmax is None else min(nmax,lnmax)
+    nmin=lnmin if nmin is None else max(nmin,lnmin)
+    slcs=[]
+    if nmax < nmin:
+        return slcs
+    if 0 in trigs:
+        slcs.append(slice(ncos(nmin-1,lnmin),ncos(nmax,lnmin)))
+    if 1 in trigs:
+        shift=ncos(lnmax,lnmin)
+        slcs.append(slice(shift+nsin(nmin-1,lnmin,squeeze),shift+nsin(nmax,lnmin,squeeze)))
+    return [slc for slc in slcs if slc.stop > slc.start]
+
+
+def relayout_plan(src,dst):
+    """Returns a list of (dst slice, src slice) segments which map the coefficients of the src layout to the dst layout
+    The src slice is None for segments which are not present in src (and need to be filled). Both layouts need to share the same squeeze option"""
+    if src[2] != dst[2]:
+        raise ValueError("Cannot map between squeezed and non-squeezed layouts")
+    lo=max(src[1],dst[1])
+    hi=min(src[0],dst[0])
+    segs=[]
+    for tr in (0,1):
+        for nlo,nhi,copy in [(dst[1],min(lo-1,dst[0]),False),(lo,hi,True),(max(hi+1,dst[1]),dst[0],False)]:
+            if nhi < nlo:
+                continue
+            dslc=degree_slices(dst,nhi,nlo,trigs=(tr,))
+            if len(dslc) == 0:
+                continue
+            sslc=degree_slices(src,nhi,nlo,trigs=(tr,))[0] if copy else None
+            segs.append((dslc[0],sslc))
+    return segs
+
+
+class SHIndex(Index):
+    """Xarray index for spherical harmonic coordinates
+    The degree, order and trigonometric type are stored as compact integer arrays (n,m,t). When the coefficients
+    follow the default ordering, the layout (nmax,nmin,squeeze) is kept so that degree and order selections reduce to offset arithmetic"""
+    names=("n","m","t")
+    def __init__(self,n,m,t,dim="shg",layout=None,names=None):
+        nint=np.int32 if len(n) == 0 or np.max(n) < 2**31-1 else np.int64
+        self.n=np.asarray(n,dtype=nint)
+        self.m=np.asarray(m,dtype=nint)
+        self.t=np.asarray(t,dtype=np.int8)
+        self.dim=dim
+        self.layout=layout
+        if names is not None:
+            self.names=tuple(names)
+
+    @classmethod
+    def from_layout(cls,nmax,nmin=0,squeeze=False,dim="shg"):
+        """Create an index with the default ordering"""
+        return cls(*nmt_arrays(nmax,nmin,squeeze),dim=dim,layout=(int(nmax),int(nmin),bool(squeeze)))
+
+    @classmethod
+    def from_pandas(cls,mi,dim="shg"):
+        """Create an index from a (n,m,t) pandas MultiIndex"""
+        return cls.from_nmt(*[mi.get_level_values(lvl).values.astype(np.int64) for lvl in ("n","m","t")],dim=dim)
+
+    @classmethod
+    def from_nmt(cls,n,m,t,dim="shg"):
+        """Create an index from integer arrays, and detect whether the default ordering is followed"""
+        return cls(n,m,t,dim=dim,layout=detect_layout(n,m,t))
+
+    @classmethod
+    def from_variables(cls,variables,*,options):
+        if len(variables) != 3:
+            raise ValueError("SHIndex expects exactly three coordinate variables (degree,order,trigonometric type)")
+        dims=set(var.dims for var in variables.values())
+        if len(dims) != 1 or len(next(iter(dims))) != 1:
+            raise ValueError("SHIndex coordinates must be one dimensional and share the same dimension")
+        dim=next(iter(dims))[0]
+        names=list(variables.keys())
+        n,m,t=[variables[name].values for name in names]
+        index=cls.from_nmt(n,m,t,dim=dim)
+        index.names=tuple(names)
+        return index
+
+    def create_variables(self,variables=None):
+        if variables is None:
+            variables={}
+        idxvars={}
+        for name,arr in zip(self.names,(self.n,self.m,self.t)):
+            var=variables.get(name,None)
+            attrs=var.attrs if var is not None else {}
+            encoding=var.encoding if var is not None else {}
+            idxvars[name]=xr.Variable(self.dim,arr,attrs=attrs,encoding=encoding)
+        return idxvars
+
+    def coords(self):
+        """Returns an xarray Coordinates object holding this index"""
+        return xr.Coordinates(self.create_variables(),indexes={name:self for name in self.names})
+
+    def to_pandas_index(self):
+        """Convert to a (n,m,t) pandas MultiIndex"""
+        if self.layout is not None:
+            return nmt_mi(*self.layout)
+        return mi_fromnmt(self.n,self.m,self.t)
+
+    def __len__(self):
+        return len(self.n)
+
+    @property
+    def nmax(self):
+        if self.layout is not None:
+            return self.layout[0]
+        return int(self.n.max())
+
+    @property
+    def nmin(self):
+        if self.layout is not None:
+            return self.layout[1]
+        return int(self.n.min())
+
+    def _replace(self,n,m,t,layout=None,dim=None):
+        return type(self)(n,m,t,dim=self.dim if dim is None else dim,layout=layout,names=self.names)
+
+    def isel(self,indexers):
+        indxr=indexers[self.dim]
+        if isinstance(indxr,xr.Variable):
+            if indxr.ndim != 1 or indxr.dims[0] != self.dim:
+                return None
+            indxr=indxr.values
+        if np.ndim(indxr) == 0 and not isinstance(indxr,slice):
+            #scalar selection drops the dimension
+            return None
+        n,m,t=self.n[indxr],self.m[indxr],self.t[indxr]
+        if isinstance(indxr,slice) and self.layout is not None and indxr.indices(len(self.n))[2] == 1:
+            #a contiguous slice of the default ordering only needs checks at the block boundaries
+            layout=self.layout if indxr.indices(len(self.n)) == (0,len(self.n),1) else _match_layout(n,m,t)
+        else:
+            layout=detect_layout(n,m,t)
+        return self._replace(n,m,t,layout=layout)
+
+    def sel(self,labels,method=None,tolerance=None):
+        if method is not None or tolerance is not None:
+            raise NotImplementedError("SHIndex only supports exact selection")
+        keys=dict(zip(self.names,("n","m","t")))
+        sellabels={}
+        for name,lbl in labels.items():
+            if name not in keys:
+                raise KeyError(f"{name} is not a coordinate of this spherical harmonic index")
+            sellabels[keys[name]]=lbl
+        return IndexSelResult({self.dim:self.positions(**sellabels)})
+
+    def positions(self,n=None,m=None,t=None):
+        """Returns the positions (as slice when possible, otherwise as integer array) of the coefficients matching the degree, order and trigonometric constraints.
+        Constraints can be scalars, (inclusive) slices or None. When all three are scalars the integer position is returned"""
+        if all(x is not None and not isinstance(x,slice) and np.ndim(x) == 0 for x in (n,m,t)):
+            if self.layout is not None:
+                pos=int(nmt_position(n,m,t,*self.layout))
+            else:
+                hits=np.nonzero((self.n == int(n)) & (self.m == int(m)) & (self.t == int(t)))[0]
+                pos=int(hits[0]) if len(hits) > 0 else -1
+            if pos < 0:
+                raise KeyError(f"Coefficient ({n},{m},{t}) is not part of this spherical harmonic index")
+            return pos
+        if self.layout is None or not all(_isrange(x) for x in (n,m,t)):
+            return np.nonzero(_match(self.n,n) & _match(self.m,m) & _match(self.t,t))[0]
+
+        nmax,nmin,squeeze=self.layout
+        n0,n1=_bounds(n,nmin,nmax)
+        t0,t1=_bounds(t,0,1)
+        trigs=tuple(range(t0,t1+1))
+        if m is None:
+            slcs=degree_slices(self.layout,n1,n0,trigs=trigs)
+            if len(slcs) == 0:
+                return slice(0,0)
+            elif len(slcs) == 1:
+                return slcs[0]
+            return np.concatenate([np.arange(slc.start,slc.stop) for slc in slcs])
+
+        m0,m1=_bounds(m,0,n1)
+        pos=[]
+        for tr in trigs:
+            for mm in range(m0,m1+1):
+                if squeeze and tr == 1 and mm == 0:
+                    continue
+                nn=np.arange(max(mm,n0),n1+1)
+                pos.append(nmt_position(nn,mm,tr,nmax,nmin,squeeze))
+        if len(pos) == 0:
+            return np.array([],dtype=np.int64)
+        return np.sort(np.concatenate(pos))
+
+    def equals(self,other,*,exclude=None):
+        if not isinstance(other,SHIndex):
+            return False
+        if self.layout is not None and other.layout is not None:
+            return self.layout == other.layout
+        return np.array_equal(self.n,other.n) and np.array_equal(self.m,other.m) and np.array_equal(self.t,other.t)
+
+    def join(self,other,how="inner"):
+        mi=self.to_pandas_index().join(other.to_pandas_index(),how=how)
+        return type(self).from_pandas(mi,dim=self.dim)
+
+    def reindex_like(self,other):
+        return {self.dim:self.to_pandas_index().get_indexer(other.to_pandas_index())}
+
+    @classmethod
+    def concat(cls,indexes,dim,positions=None):
+        n=np.concatenate([idx.n for idx in indexes])
+        m=np.concatenate([idx.m for idx in indexes])
+        t=np.concatenate([idx.t for idx in indexes])
+        if positions is not None:
+            order=np.argsort(np.concatenate([np.asarray(pos) for pos in positions]))
+            n,m,t=n[order],m[order],t[order]
+        index=cls.from_nmt(n,m,t,dim=dim)
+        index.names=indexes[0].names
+        return index
+
+    def rename(self,name_dict,dims_dict):
+        if not set(self.names) & set(name_dict) and self.dim not in dims_dict:
+            return self
+        index=type(self)(self.n,self.m,self.t,dim=dims_dict.get(self.dim,self.dim),layout=self.layout,names=[name_dict.get(nm,nm) for nm in self.names])
+        return index
+
+    def _repr_inline_(self,max_width):
+        if self.layout is not None:
+            return f"SHIndex (nmax={self.layout[0]}, nmin={self.layout[1]}, squeeze={self.layout[2]})"
+        return "SHIndex (custom order)"
+
+    def __repr__(self):
+        return self._repr_inline_(80)
+
+
+def detect_layout(n,m,t):
+    """Returns the layout (nmax,nmin,squeeze) when the n,m,t arrays follow the default ordering or None otherwise"""
+    layout=_match_layout(n,m,t)
+    if layout is None:
+        return None
+    #do a full check
+    nref,mref,tref=nmt_arrays(*layout)
+    if np.array_equal(n,nref) and np.array_equal(m,mref) and np.array_equal(t,tref):
+        return layout
+    return None
+
+def _match_layout(n,m,t):
+    """Guess the layout from the size and the start and end of both trigonometric blocks
+    (only conclusive for contiguous slices of an existing layout, use detect_layout otherwise)"""
+    if len(n) == 0:
+        return None
+    nmin=int(n[0])
+    nmax=int(n[-1])
+    if nmax < nmin or m[0] != 0 or t[0] != 0 or m[-1] != nmax:
+        return None
+    nc=ncos(nmax,nmin)
+    if n[nc-1] != nmax or m[nc-1] != nmax or t[nc-1] != 0:
+        return None
+    for squeeze in (False,True):
+        ns=nsin(nmax,nmin,squeeze)
+        if len(n) != nc+ns:
+            continue
+        if ns == 0:
+            #only happens for a squeezed degree 0 index
+            return (nmax,nmin,squeeze) if t[-1] == 0 else None
+        #first sine coefficient of the block
+        nsstart,msstart=(max(nmin,1),1) if squeeze else (nmin,0)
+        if t[nc] == 1 and n[nc] == nsstart and m[nc] == msstart and t[-1] == 1:
+            return (nmax,nmin,squeeze)
+    return None
+
+def _isrange(lbl):
+    return lbl is None or np.ndim(lbl) == 0 or (isinstance(lbl,slice) and lbl.step in (None,1))
+
+def _bounds(lbl,lower,upper):
+    """Returns inclusive integer bounds of a scalar or slice label"""
+    if lbl is None:
+        return lower,upper
+    if isinstance(lbl,slice):
+        start=lower if lbl.start is None else max(int(lbl.start),lower)
+        stop=upper if lbl.stop is None else min(int(lbl.stop),upper)
+        return start,stop
+    return max(int(lbl),lower),min(int(lbl),upper)
+
+def _match(arr,lbl):
+    if lbl is None:
+        return np.ones(arr.shape,dtype=bool)
+    if isinstance(lbl,slice):
+        start,stop=_bounds(lbl,arr.min(),arr.max())
+        return (arr >= start) & (arr <= stop)
+    if np.ndim(lbl) == 0:
+        return arr == int(lbl)
+    return np.isin(arr,np.asarray(lbl))
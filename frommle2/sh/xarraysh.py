@@ -23,6 +23,7 @@ import numpy as np
 import pandas as pd
 from enum import IntEnum
 from functools import total_ordering
+from frommle2.sh import shindex
 
 
 @total_ordering
@@ -42,21 +43,33 @@ class SHAccessor:
     def nmin(self):
         """ returns the maximum spherical harmonic degree associated with the shg coordinate"""
         if not self._nmin:
-            self._obj=self.build_MultiIndex()
-            self._nmin=self._obj.get_index("shg").unique(level='n').min()      
+            shidx=SHAccessor._shindex(self._obj)
+            if shidx is not None:
+                self._nmin=shidx.nmin
+            else:
+                self._obj=self.build_MultiIndex()
+                self._nmin=self._obj.get_index("shg").unique(level='n').min()      
         return self._nmin
     
     @property
     def nmax(self):
         """ returns the maximum spherical harmonic degree associated with the shg coordinate"""
         if not self._nmax:
-            self._obj=self.build_MultiIndex()
-            self._nmax=self._obj.get_index("shg").unique(level='n').max()      
+            shidx=SHAccessor._shindex(self._obj)
+            if shidx is not None:
+                self._nmax=shidx.nmax
+            else:
+                self._obj=self.build_MultiIndex()
+                self._nmax=self._obj.get_index("shg").unique(level='n').max()      
         return self._nmax
    
     def truncate(self,nmax=None,nmin=None):
         return SHAccessor._truncate(self._obj,nmax,nmin)
 
+    def extend(self,nmax=None,nmin=None,fillvalue=0):
+        """Extend minimum and /or maximum degree"""
+        return SHAccessor._extend(self._obj,nmax,nmin,fillvalue)
+
     @staticmethod
     def nsh(nmax,nmin=0,squeeze=False):
         assert nmax>=nmin
@@ -105,34 +118,84 @@ class SHAccessor:
 
     
     @staticmethod
-    def from_cnm(cnm,squeeze=True):
-        """Create a xarray from a cnm array from shtools"""
-        nmax=cnm.shape[1]-1
-        #create a multiindex
-        shgmi=SHAccessor.nmt_mi(nmax,squeeze=squeeze)
-        #indexing vectors so the sh coeffients match the index
-        i_n=shgmi.get_level_values(level='n').astype(int)
-        i_m=shgmi.get_level_values(level='m').astype(int)
-        i_t=shgmi.get_level_values(level='t').astype(int)
-        coords={"shg":shgmi}
-        dims=["shg"]
-        return xr.DataArray(data=cnm[i_t,i_n,i_m],dims=dims,name="cnm",coords=coords)
+    def from_cnm(cnm,squeeze=True,nmax=None,dim="time",coords=None,out=None,name="cnm"):
+        """Create a xarray from a cnm array from shtools
+        parameters:
+            cnm: array with shtools layout [2,n+1,n+1], or a stack of them [ntime,2,n+1,n+1]
+            squeeze: leave out the sine coefficients of order 0
+            nmax: maximum degree to extract (defaults to the maximum degree of cnm)
+            dim: name of the leading dimension of a stacked cnm array
+            coords: coordinate values of the leading dimension (optional)
+            out: preallocated output buffer of shape [nsh] or [ntime,nsh] (optional)
+        Note: the gather plan is cached per (nmax,squeeze) so stacks of epochs can be converted in one call"""
+        cnm=np.asarray(cnm)
+        if cnm.ndim not in (3,4) or cnm.shape[-3] != 2 or cnm.shape[-2] != cnm.shape[-1]:
+            raise ValueError("Expecting a cnm array with shape [2,n+1,n+1] or [ntime,2,n+1,n+1]")
+        ncnm=cnm.shape[-1]
+        if nmax is None:
+            nmax=ncnm-1
+        plan=shindex.cnm_plan(nmax,squeeze=squeeze,ncnm=ncnm)
+        #gather directly from the flattened (view when contiguous) input into the output
+        data=np.take(cnm.reshape(cnm.shape[:-3]+(-1,)),plan,axis=-1,out=out,mode='clip')
+        dims=["shg"] if cnm.ndim == 3 else [dim,"shg"]
+        da=xr.DataArray(data=data,dims=dims,name=name,coords=xr.Coordinates.from_pandas_multiindex(shindex.nmt_mi(nmax,squeeze=squeeze),"shg"))
+        if coords is not None and cnm.ndim == 4:
+            da=da.assign_coords({dim:coords})
+        return da
+
+    def to_cnm(self,nmax=None,out=None):
+        """Convert to a shtools style cnm array
+        parameters:
+            nmax: maximum degree of the output (defaults to the maximum degree of the input)
+            out: preallocated (C-contiguous) output buffer of shape [...,2,nmax+1,nmax+1] (optional)
+        returns: numpy array of shape [2,nmax+1,nmax+1], with the remaining dimensions of the input (if any) leading"""
+        return SHAccessor._to_cnm(self._obj,nmax,out)
+
+    @staticmethod
+    def _to_cnm(obj,nmax=None,out=None):
+        if SHAccessor._shindex(obj) is None:
+            obj=SHAccessor._build_multindex_obj(obj)
+        if nmax is None:
+            nmax=obj.sh.nmax
+        elif nmax < obj.sh.nmax:
+            obj=SHAccessor._truncate(obj,nmax,None)
+
+        layout=SHAccessor._layout(obj)
+        ncnm=nmax+1
+        if layout is not None:
+            plan=shindex.cnm_plan(*layout,ncnm=ncnm)
+        else:
+            plan=shindex.cnm_flatindex(obj.n.values,obj.m.values,obj.t.values,ncnm)
+
+        data=obj.transpose(...,"shg").data
+        shp=data.shape[:-1]+(2,ncnm,ncnm)
+        if out is None:
+            out=np.zeros(shp,dtype=data.dtype)
+        else:
+            if out.shape != shp or not out.flags['C_CONTIGUOUS']:
+                raise ValueError(f"Output buffer should be C-contiguous with shape {shp}")
+            out[...]=0
+        #scatter into a flattened view of the output
+        out.reshape(data.shape[:-1]+(-1,))[...,plan]=data
+        return out
 
 
     @staticmethod
     def nmt_mi(nmax,nmin=0,squeeze=False):
-        """ create a multindex guide which varies with n, then m, and than trigonometric sign"""
-        if squeeze:
-            nmt=[(n,m,t) for t in [trig.c,trig.s] for n in range(nmin,nmax+1) for m in range(n+1) if not (m == 0 and t == trig.s) ]
-        else:
-            nmt=[(n,m,t) for t in [trig.c,trig.s] for n in range(nmin,nmax+1) for m in range(n+1)]
-        return SHAccessor.mi_fromtuples(nmt)
+        """ create a multindex guide which varies with n, then m, and than trigonometric sign
+        Note: the index is build from integer arrays and cached, so repeated calls return the same (immutable) object"""
+        return shindex.nmt_mi(nmax,nmin,squeeze)
 
     @staticmethod
     def shg(nmax,nmin,squeeze=False,dim="shg"):
         """Convenience function which returns a dictionary which can be used as input for xarray constructors"""
-        return {dim:(dim,SHAcessor.nmt_mi(nmax,nmin,squeeze))}
+        return {dim:(dim,SHAccessor.nmt_mi(nmax,nmin,squeeze))}
+
 
+    @staticmethod
+    def shindex_coords(nmax,nmin=0,squeeze=False,dim="shg"):
+        """Returns xarray coordinates (n,m,t) along dim which are indexed by a SHIndex"""
+        return shindex.SHIndex.from_layout(nmax,nmin,squeeze,dim=dim).coords()
 
     @staticmethod
     def mi_fromtuples(nmt):
@@ -142,55 +205,227 @@ class SHAccessor:
     def mi_fromarrays(nmt):
         return pd.MultiIndex.from_arrays(nmt,names=["n","m","t"])
     
-    def flatten_shg(self):
-        """Serialize n,m,t multindex so it can be written to a file"""
+    def flatten_shg(self,packed=False):
+        """Serialize n,m,t multindex so it can be written to a file
+        When packed is True a single int64 coordinate (nmt) is written instead of separate n,m,t coordinates"""
        
-        return SHAccessor._flatten_shg_obj(self._obj)
+        return SHAccessor._flatten_shg_obj(self._obj,packed)
    
     def build_MultiIndex(self):
         return SHAccessor._build_multindex_obj(self._obj)
 
+    def build_SHIndex(self):
+        """Replace the shg (n,m,t) MultiIndex by a SHIndex"""
+        return SHAccessor._build_shindex_obj(self._obj)
+
     @staticmethod
-    def _flatten_shg_obj(obj):
-        #temporaily not working see https://github.com/Ouranosinc/xscen/pull/67
-        # ds=obj.reset_index("shg")
-        nd=obj.get_index("shg").get_level_values("n")
-        md=obj.get_index("shg").get_level_values("m")
-        td=obj.get_index("shg").get_level_values("t")
-        
-        #reset index if n,m,t coordinates are existing already
-        if "n" in obj.coords and "m" in obj.coords and "t" in obj.coords:
-            return obj.reset_index("shg")
+    def _shindex(obj):
+        """Returns the SHIndex of the object or None if it doesn't have one"""
+        shidx=obj.xindexes.get("n")
+        if isinstance(shidx,shindex.SHIndex):
+            return shidx
+        return None
+
+    @staticmethod
+    def _build_shindex_obj(obj):
+        if SHAccessor._shindex(obj) is not None:
+            return obj
+        if "shg" in obj.indexes:
+            shidx=shindex.SHIndex.from_pandas(obj.get_index("shg"),dim="shg")
+            return obj.drop_vars(["shg","n","m","t"]).assign_coords(shidx.coords())
+        nmt=SHAccessor._flat_nmt(obj)
+        if nmt is None:
+            return SHAccessor._build_shindex_obj(SHAccessor._build_multindex_obj(obj))
+        shidx=shindex.SHIndex.from_nmt(*nmt,dim="shg")
+        return obj.drop_vars([crd for crd in ("n","m","t","nmt") if crd in obj.coords]).assign_coords(shidx.coords())
+
+    @staticmethod
+    def _flatten_shg_obj(obj,packed=False):
+        shidx=SHAccessor._shindex(obj)
+        if shidx is None:
+            obj=SHAccessor._build_multindex_obj(obj)
+            mi=obj.get_index("shg")
+            #level values are gathered in one go from the codes
+            nd,md,td=[mi.levels[i].values[mi.codes[i]] for i in range(3)]
+            obj=obj.drop_vars(["shg","n","m","t"])
+        else:
+            nd,md,td=shidx.n,shidx.m,shidx.t
+            obj=obj.drop_vars(list(shidx.names))
+
+        if packed:
+            return obj.assign_coords(nmt=("shg",shindex.pack_nmt(nd,md,td),{"long_name":"packed spherical harmonic degree, order and trigonometric type","comment":"nmt=n*2**32+m*2+t"}))
         else:
-            #assign new n,m,t 
-            return obj.assign_coords(n=("shg",nd),m=("shg",md),t=("shg",td)).drop_vars("shg")
-       # return ds.assign_coords(t=(["shg"],[t for t in ds.t.values]))
-     
+            return obj.assign_coords(n=("shg",nd),m=("shg",md),t=("shg",td))
+
+    @staticmethod
+    def _flat_nmt(obj):
+        """Returns integer arrays of degree, order and trigonometric type from flattened (or packed) coordinates, or None if not present"""
+        if "n" in obj.coords and "m" in obj.coords and "t" in obj.coords:
+            return obj.n.values,obj.m.values,obj.t.values
+        elif "nmt" in obj.coords:
+            return shindex.unpack_nmt(obj.nmt.values)
+        return None
+
     @staticmethod
     def _build_multindex_obj(obj):
         if "shg" in obj.indexes:
             #already build, so don't bother
             return obj
-        #either build from separate coordinate variables (n,m,t)
-        if "n" in obj.coords and "m" in obj.coords and "t" in obj.coords:
-            shgmi=pd.MultiIndex.from_tuples([(n,m,trig(t)) for n,m,t in zip(obj.n.values,obj.m.values,obj.t.values)],names=["n","m","t"])
-            return obj.drop_vars(["n","m","t"]).assign_coords(shg=shgmi)
+        shidx=SHAccessor._shindex(obj)
+        if shidx is not None:
+            #convert the SHIndex back to a MultiIndex
+            return obj.drop_vars(list(shidx.names)).assign_coords(xr.Coordinates.from_pandas_multiindex(shidx.to_pandas_index(),shidx.dim))
+        #either build from separate (or packed) integer coordinate variables (n,m,t)
+        nmt=SHAccessor._flat_nmt(obj)
+        if nmt is not None:
+            layout=shindex.detect_layout(*nmt)
+            if layout is not None:
+                #reuse the cached index
+                shgmi=shindex.nmt_mi(*layout)
+            else:
+                shgmi=shindex.mi_fromnmt(*nmt)
+            return obj.drop_vars([crd for crd in ("n","m","t","nmt") if crd in obj.coords]).assign_coords(xr.Coordinates.from_pandas_multiindex(shgmi,"shg"))
         elif "shg" in obj.coords:
             #rebuild multiindex from an array of "left-over" tuples
             shgmi=pd.MultiIndex.from_tuples(obj.shg.values,names=["n","m","t"])
-            return obj.drop_vars(["shg"]).assign_coords(shg=shgmi)
+            return obj.drop_vars(["shg"]).assign_coords(xr.Coordinates.from_pandas_multiindex(shgmi,"shg"))
     
+    @staticmethod
+    def _layout(obj):
+        """Returns the (nmax,nmin,squeeze) layout of the shg dimension or None when the coefficients are not in the default order"""
+        shidx=SHAccessor._shindex(obj)
+        if shidx is not None:
+            return shidx.layout
+        mi=obj.get_index("shg")
+        return shindex.detect_layout(*[mi.get_level_values(lvl).values for lvl in ("n","m","t")])
+
     @staticmethod
     def _truncate(obj,nmax,nmin):
-        if nmax is not None:
-            indx=(obj.shg.n <= nmax)
-        if nmin is not None:
-            if indx:
-                indx=indx*(obj.shg.n >= nmin)
+        if SHAccessor._shindex(obj) is None:
+            obj=SHAccessor._build_multindex_obj(obj)
+        layout=SHAccessor._layout(obj)
+        if layout is None:
+            #arbitrary order: fall back to a selection mask
+            nd=obj.n.values
+            indx=np.ones(nd.shape,dtype=bool)
+            if nmax is not None:
+                indx&=(nd <= nmax)
+            if nmin is not None:
+                indx&=(nd >= nmin)
+            return obj.isel(shg=indx)
+
+        lnmax,lnmin,squeeze=layout
+        nmax=lnmax if nmax is None else min(nmax,lnmax)
+        nmin=lnmin if nmin is None else max(nmin,lnmin)
+        return SHAccessor._relayout(obj,layout,(nmax,nmin,squeeze))
+
+    @staticmethod
+    def _extend(obj,nmax,nmin,fillvalue=0):
+        if SHAccessor._shindex(obj) is None:
+            obj=SHAccessor._build_multindex_obj(obj)
+        layout=SHAccessor._layout(obj)
+        shidx=SHAccessor._shindex(obj)
+        if layout is None:
+            #arbitrary order: reindex to the default order
+            mi=obj.get_index("shg") if shidx is None else shidx.to_pandas_index()
+            lnmax=mi.get_level_values("n").max()
+            lnmin=mi.get_level_values("n").min()
+            squeeze=not ((mi.get_level_values("m") == 0) & (mi.get_level_values("t") == 1)).any()
+            nmax=lnmax if nmax is None else max(nmax,lnmax)
+            nmin=lnmin if nmin is None else min(nmin,lnmin)
+            target=(nmax,nmin,squeeze)
+            gather=mi.get_indexer(shindex.nmt_mi(*target))
+            return SHAccessor._replace_shg(obj,target,lambda var:SHAccessor._gather_variable(var,gather,fillvalue))
+
+        lnmax,lnmin,squeeze=layout
+        nmax=lnmax if nmax is None else max(nmax,lnmax)
+        nmin=lnmin if nmin is None else min(nmin,lnmin)
+        return SHAccessor._relayout(obj,layout,(nmax,nmin,squeeze),fillvalue)
+
+    @staticmethod
+    def _relayout(obj,src,dst,fillvalue=0):
+        """Map all shg dependent variables from the src to the dst layout using contiguous slices"""
+        if src == dst:
+            return obj
+        segs=shindex.relayout_plan(src,dst)
+        nsh=shindex.ncos(dst[0],dst[1])+shindex.nsin(dst[0],dst[1],dst[2])
+        return SHAccessor._replace_shg(obj,dst,lambda var:SHAccessor._segment_variable(var,segs,nsh,fillvalue))
+
+    @staticmethod
+    def _segment_variable(var,segs,nsh,fillvalue=0):
+        """Copy the (dst,src) slice segments of a variable along the shg dimension into a single new array"""
+        axis=var.get_axis_num("shg")
+        pre=(slice(None),)*axis
+        if all(src is not None for _,src in segs):
+            #no filling needed: concatenate the slices (views) into one output buffer (also works for dask arrays)
+            data=np.concatenate([var.data[pre+(src,)] for _,src in segs],axis=axis)
+        elif isinstance(var.data,np.ndarray):
+            shp=list(var.shape)
+            shp[axis]=nsh
+            data=np.full(shp,fillvalue,dtype=np.result_type(var.dtype,np.min_scalar_type(fillvalue)))
+            for dst,src in segs:
+                if src is not None:
+                    data[pre+(dst,)]=var.data[pre+(src,)]
+        else:
+            #duck arrays which don't support item assignment
+            pieces=[]
+            for dst,src in segs:
+                if src is None:
+                    shp=list(var.shape)
+                    shp[axis]=dst.stop-dst.start
+                    pieces.append(np.full_like(var.data,fillvalue,shape=shp))
+                else:
+                    pieces.append(var.data[pre+(src,)])
+            data=np.concatenate(pieces,axis=axis)
+
+        return xr.Variable(var.dims,data,attrs=var.attrs,encoding=var.encoding)
+
+    @staticmethod
+    def _gather_variable(var,gather,fillvalue=0):
+        """Gather a variable along the shg dimension with an index array (where entries equal to -1 are filled)"""
+        axis=var.get_axis_num("shg")
+        valid=gather >= 0
+        data=np.take(var.data,np.where(valid,gather,0),axis=axis)
+        if not valid.all():
+            shp=[1]*var.ndim
+            shp[axis]=len(gather)
+            data=np.where(valid.reshape(shp),data,fillvalue)
+        return xr.Variable(var.dims,data,attrs=var.attrs,encoding=var.encoding)
+
+    @staticmethod
+    def _replace_shg(obj,layout,func):
+        """Returns a new object with the shg index replaced by the one of the layout, and func applied to all remaining variables which depend on shg"""
+        shidx=SHAccessor._shindex(obj)
+        if shidx is not None:
+            shgcoords=shindex.SHIndex.from_layout(*layout,dim="shg").coords()
+            idxnames=set(shidx.names)
+        else:
+            shgcoords=xr.Coordinates.from_pandas_multiindex(shindex.nmt_mi(*layout),"shg")
+            idxnames={"shg","n","m","t"}
+
+        if isinstance(obj,xr.DataArray):
+            ds=obj.to_dataset(name="__shdata__")
+        else:
+            ds=obj
+
+        datavars={}
+        coords={}
+        for name,var in ds.variables.items():
+            if name in idxnames:
+                continue
+            if "shg" in var.dims:
+                var=func(var)
+            if name in ds.coords:
+                coords[name]=var
             else:
-                indx=(obj.shg.n >= nmin)
-        
-        return obj.isel(shg=indx) 
+                datavars[name]=var
+
+        dsout=xr.Dataset(datavars,coords=shgcoords,attrs=ds.attrs).assign_coords(coords)
+        if isinstance(obj,xr.DataArray):
+            daout=dsout["__shdata__"]
+            daout.name=obj.name
+            return daout
+        return dsout
 
 @xr.register_dataset_accessor("sh")
 class SHDSAccessor:
@@ -202,8 +437,7 @@ class SHDSAccessor:
     
     def extend(self,nmax=None,nmin=None,fillvalue=0):
         """Extend minimum and /or maximum degree"""
-        
-        pass
+        return SHAccessor._extend(self._obj,nmax,nmin,fillvalue)
 
     def truncate(self,nmax=None,nmin=None):
         return SHAccessor._truncate(self._obj,nmax,nmin)
@@ -216,27 +450,40 @@ class SHDSAccessor:
     def nmin(self):
         """ returns the maximum spherical harmonic degree associated with the shg coordinate"""
         if not self._nmin:
-            self._obj=self.build_MultiIndex()
-            self._nmin=self._obj.get_index("shg").unique(level='n').min()      
+            shidx=SHAccessor._shindex(self._obj)
+            if shidx is not None:
+                self._nmin=shidx.nmin
+            else:
+                self._obj=self.build_MultiIndex()
+                self._nmin=self._obj.get_index("shg").unique(level='n').min()      
         return self._nmin
     
     @property
     def nmax(self):
         """ returns the maximum spherical harmonic degree associated with the shg coordinate"""
         if not self._nmax:
-            self._obj=self.build_MultiIndex()
-            self._nmax=self._obj.get_index("shg").unique(level='n').max()      
+            shidx=SHAccessor._shindex(self._obj)
+            if shidx is not None:
+                self._nmax=shidx.nmax
+            else:
+                self._obj=self.build_MultiIndex()
+                self._nmax=self._obj.get_index("shg").unique(level='n').max()      
         return self._nmax
 
     @staticmethod
-    def from_cnm(cnm):
+    def from_cnm(cnm,squeeze=True,nmax=None,dim="time",coords=None,out=None):
         """Create a xarray dataset from a cnm array from shtools"""
-        return SHAccessor.from_cnm(cnm).to_dataset()
+        return SHAccessor.from_cnm(cnm,squeeze,nmax,dim,coords,out).to_dataset()
 
-    def flatten_shg(self):
-        """Serialize n,m,t multindex so it can be written to a file"""
-        return SHAccessor._flatten_shg_obj(self._obj)
+    def flatten_shg(self,packed=False):
+        """Serialize n,m,t multindex so it can be written to a file
+        When packed is True a single int64 coordinate (nmt) is written instead of separate n,m,t coordinates"""
+        return SHAccessor._flatten_shg_obj(self._obj,packed)
    
     def build_MultiIndex(self):
         return SHAccessor._build_multindex_obj(self._obj)
 
+    def build_SHIndex(self):
+        """Replace the shg (n,m,t) MultiIndex by a SHIndex"""
+        return SHAccessor._build_shindex_obj(self._obj)
+
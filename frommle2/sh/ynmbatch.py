@@ -0,0 +1,104 @@
+# This file is part of frommle2.
+# frommle2 is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# frommle2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with Frommle; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
+
+import numpy as np
+from frommle2.sh import shindex
+from frommle2.sh.pnmcache import iter_pnm_cached
+
+
+class YnmBatch:
+    """Evaluates real 4-pi normalized spherical harmonics for many points at once
+    The Legendre recursion runs over degree, while all points (and orders) of a degree are handled as arrays"""
+    def __init__(self,nmax,nmt=None,cache=None):
+        """
+        parameters:
+            nmax: maximum degree
+            nmt: tuple of (n,m,t) integer arrays prescribing the order of the output rows (defaults to the frommle2 ordering, non-squeezed)
+            cache: frommle2.sh.pnmcache.PnmCache (or True for the default cache) to store and reuse the Legendre functions on disk
+        """
+        self.nmax=nmax
+        self.cache=cache
+        if nmt is None:
+            nmt=shindex.nmt_arrays(nmax)
+        self.n,self.m,self.t=[np.asarray(x,dtype=np.int64) for x in nmt]
+        if self.n.max() > nmax:
+            raise ValueError("Requested output index contains degrees larger than nmax")
+        #lookup table of output rows (-1 means not requested)
+        rows=np.full([2,nmax+1,nmax+1],-1,dtype=np.int64)
+        rows[self.t,self.n,self.m]=np.arange(len(self.n))
+        #per degree and trigonometric type: (output rows, requested orders), rows are slices when contiguous
+        self._plan=[[_rowplan(rows[t,n,0:n+1]) for t in (0,1)] for n in range(nmax+1)]
+
+    def __len__(self):
+        return len(self.n)
+
+    def nmt(self):
+        """Returns the degree, order and trigonometric type of the output rows as an array of shape [nsh,3]"""
+        return np.stack([self.n,self.m,self.t],axis=1)
+
+    def __call__(self,lon,lat,out=None):
+        """Evaluate the spherical harmonics
+        parameters:
+            lon: longitudes in degrees (arraylike)
+            lat: latitudes in degrees (arraylike)
+            out: optional preallocated output of shape [nsh,npoints]
+        returns: array of shape [nsh,npoints]"""
+        lon=np.atleast_1d(np.asarray(lon,dtype=np.float64))
+        lat=np.atleast_1d(np.asarray(lat,dtype=np.float64))
+        if lon.shape != lat.shape:
+            raise ValueError("Number of longitude points is not consistent with latitude points")
+        if out is None:
+            out=np.empty([len(self),lon.size])
+
+        lonr=np.deg2rad(lon)
+        mlon=np.outer(np.arange(self.nmax+1),lonr)
+        cosml=np.cos(mlon)
+        sinml=np.sin(mlon)
+        for n,pn in iter_pnm_cached(self.nmax,lat,self.cache):
+            for trigml,(rows,morders) in zip((cosml,sinml),self._plan[n]):
+                if isinstance(rows,slice):
+                    #write directly in the output
+                    np.multiply(pn[morders],trigml[morders],out=out[rows])
+                elif len(rows) > 0:
+                    out[rows]=pn[morders]*trigml[morders]
+        return out
+
+    def chunks(self,lon,lat,chunksize=10000,out=None):
+        """Generator which evaluates the spherical harmonics in blocks of points so that memory stays bounded
+        parameters:
+            out: optional array of shape [nsh,npoints] in which the blocks are written
+        yields: (slice of the points,array of shape [nsh,nchunk])"""
+        lon=np.atleast_1d(lon)
+        lat=np.atleast_1d(lat)
+        for istart in range(0,len(lon),chunksize):
+            slc=slice(istart,min(istart+chunksize,len(lon)))
+            if out is not None:
+                #write directly in the corresponding block of the output
+                yield slc,self(lon[slc],lat[slc],out=out[:,slc])
+            else:
+                yield slc,self(lon[slc],lat[slc])
+
+
+def _rowplan(rows):
+    """Returns (rows,orders) for the requested orders of a degree, where rows is a slice when the output rows are contiguous"""
+    morders=np.nonzero(rows >= 0)[0]
+    rows=rows[morders]
+    if len(rows) > 0 and np.all(np.diff(rows) == 1):
+        rows=slice(rows[0],rows[-1]+1)
+        if len(morders) == morders[-1]+1-morders[0]:
+            morders=slice(morders[0],morders[-1]+1)
+    return rows,morders
@@ -35,7 +35,7 @@ else:
 
 
 def listexts():
-    names=["sh/legendre","sh/ynm","sh/analysis"]
+    names=["sh/legendre","sh/ynm"]
     exts=[]
     for nm in names:
         exts.append(Extension("frommle2."+nm.replace("/","."),["frommle2/"+nm+ext],include_dirs=[np.get_include()]))
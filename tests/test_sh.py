@@ -14,14 +14,38 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 # Author Roelof Rietbroek (r.rietbroek@utwente.nl), 2022
-from frommle2.sh.analysis import Analysis
+from frommle2.sh.analysis import Analysis,YnmFwd
 from frommle2.sh.isoload import unit as shunit
+from frommle2.sh.pnm import pnm,pnm_nm,iter_pnm
+from frommle2.sh.pnmcache import PnmCache
+from frommle2.sh.grav import gravity_functionals,EquivalentWater
+from frommle2.sh.lsqanalysis import LSQAnalysis
+from frommle2.constants.earth import a_earth,GM_earth
 from frommle2.io.shascii import readSHAscii
+from frommle2.core import LinearSparseFwd,BlockDiagonalFwd
+from frommle2.sh.shfilter import SHfilter
+from frommle2.io.binv_legacy import readBINV,writeBINV,toBINVdict,getBDcoords,getBDsparse
+from frommle2.neqs.sympacked import SymPacked
+from frommle2.io.binv_catalog import BINVcatalog,catalogsides
+import struct
+import os
+import sparse
 from io import StringIO
+import xarray as xr
 import xarray.testing as xrtest
 import numpy as np
+import scipy.linalg
+import tempfile
 import unittest
+from unittest import mock
 import logging
+try:
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_origin
+    from frommle2.sh.rastio2sh import rastio2shDH,rastio2shDH_stack,rastio2shDH_stream
+    haveRasterio=True
+except ImportError:
+    haveRasterio=False
 
 # Independent validation data for unit load (lon 0.5,lat=53.0)
 unitvaldata=""" META    5    0.000000    0.000000    0.000000
@@ -48,6 +72,27 @@ unitvaldata=""" META    5    0.000000    0.000000    0.000000
      5    5  0.18351146735867E+00  0.80122836994040E-02
      """
 
+
+def writeBINVfile(ffile,btype,tags,pack,blockind=None,vec=None):
+    """Writes a minimal (version 2.1) BINV file"""
+    pval1=len(tags) if btype == "FULLSQV0" else len(pack)
+    with open(ffile,'wb') as fid:
+        fid.write(b"BINV2.1 "+btype.encode()+b"test matrix".ljust(80))
+        fid.write(struct.pack('<IIIIII',0,0,len(tags),len(tags),pval1,1))
+        if blockind is not None:
+            fid.write(struct.pack('<I',len(blockind)))
+        fid.write("".join(tag.ljust(24) for tag in tags).encode())
+        if blockind is not None:
+            fid.write(np.asarray(blockind).astype('<u4').tobytes())
+        if vec is not None:
+            fid.write(np.asarray(vec).astype('<f8').tobytes())
+        fid.write(np.asarray(pack).astype('<f8').tobytes())
+
+def writeBDfile(ffile,tags,blocks):
+    """Writes a minimal (version 2.1) block diagonal BINV file"""
+    blockind=np.cumsum([blk.shape[0] for blk in blocks])
+    writeBINVfile(ffile,"BDFULLV0",tags,np.concatenate([blk.ravel(order='F') for blk in blocks]),blockind)
+
 class TestSH(unittest.TestCase):
     logger = logging.getLogger("TestSH")
     logging.basicConfig(format = '%(asctime)s %(funcName)s %(levelname)s: %(message)s', 
@@ -71,6 +116,139 @@ class TestSH(unittest.TestCase):
           
         self.assertTrue(unitSHisClose)
 
+    def test_ynm_batch(self):
+        self.logger.info("Testing batched evaluation of unit loads for many points")
+        nmax=30
+        rng=np.random.default_rng(3)
+        lon=rng.uniform(-180,180,25)
+        lat=rng.uniform(-90,90,25)
+        daunit=shunit(nmax,lon,lat,chunksize=7)
+        for i in [0,11,24]:
+            xrtest.assert_allclose(daunit.isel(np=i),shunit(nmax,lon[i:i+1],lat[i:i+1]).isel(np=0))
+        #lazy evaluation per chunk
+        xrtest.assert_allclose(shunit(nmax,lon,lat,chunksize=10,lazy=True).compute(),daunit)
+
+    def test_pnm(self):
+        self.logger.info("Testing associated Legendre functions up to high degree")
+        nmax=5
+        daunitval=readSHAscii(StringIO(unitvaldata)).cnm
+        n,m=pnm_nm(nmax)
+        pnmtab=pnm(nmax,[53.0])[0]
+        for t,trig in enumerate([np.cos,np.sin]):
+            ynm=pnmtab*trig(np.deg2rad(0.5*m))
+            np.testing.assert_allclose(ynm,daunitval.sel(shg=list(zip(n,m,[t]*len(n)))).values,atol=1e-13)
+
+        #addition theorem sum_m Pnm^2 = 2n+1, which requires the extended range near the poles
+        nmax=2700
+        lat=[89.9,80.0,-60.0]
+        for dtype,rtol in [(np.float64,1e-9),(np.float32,1e-6)]:
+            sumsq=np.zeros([nmax+1,len(lat)])
+            for n,pn in iter_pnm(nmax,lat,dtype=dtype):
+                self.assertEqual(pn.dtype,dtype)
+                sumsq[n]=np.sum(pn.astype(np.float64)**2,axis=0)
+            np.testing.assert_allclose(sumsq,np.repeat(2*np.arange(nmax+1)+1.0,len(lat)).reshape(sumsq.shape),rtol=rtol)
+
+    def test_nmt_mi(self):
+        self.logger.info("Testing vectorized construction of the spherical harmonic index")
+        for nmax,nmin,squeeze in [(10,0,False),(10,0,True),(12,3,True),(0,0,False)]:
+            nmt=[(n,m,t) for t in [0,1] for n in range(nmin,nmax+1) for m in range(n+1) if not (squeeze and m == 0 and t == 1)]
+            shmi=xr.DataArray.sh.nmt_mi(nmax,nmin,squeeze=squeeze)
+            self.assertTrue(shmi.equals(xr.DataArray.sh.mi_fromtuples(nmt)))
+            self.assertEqual(len(shmi),xr.DataArray.sh.nsh(nmax,nmin,squeeze=squeeze))
+        #identical requests should share the same index
+        self.assertIs(xr.DataArray.sh.nmt_mi(10,squeeze=True),xr.DataArray.sh.nmt_mi(10,0,True))
+
+    def test_shindex(self):
+        self.logger.info("Testing the SHIndex for spherical harmonic coordinates")
+        nmax=8
+        da=xr.DataArray.sh.zeros(nmax,squeeze=True,auxcoords={"time":np.arange(2)})
+        da[:]=np.arange(da.size).reshape(da.shape)
+        dash=da.sh.build_SHIndex()
+        self.assertEqual(dash.sh.nmax,nmax)
+        self.assertEqual(dash.sh.nmin,0)
+
+        #degree range selection
+        dasel=dash.sel(n=slice(2,5))
+        self.assertEqual(dasel.sh.nmin,2)
+        self.assertEqual(dasel.sh.nmax,5)
+        np.testing.assert_array_equal(dasel.values,da.where((da.n >= 2) & (da.n <= 5),drop=True).values)
+
+        #a single trigonometric block is returned as a view
+        dacos=dash.sel(n=slice(None,5),t=0)
+        self.assertTrue(np.shares_memory(dacos.values,dash.values))
+
+        #order selection
+        np.testing.assert_array_equal(dash.sel(m=3).values,da.where(da.m == 3,drop=True).values)
+
+        #selecting a single coefficient drops the dimension
+        dacoef=dash.sel(n=2,m=1,t=1)
+        self.assertNotIn("shg",dacoef.dims)
+        np.testing.assert_array_equal(dacoef.values,da.sel(shg=(2,1,1)).values)
+
+        #round trip to the MultiIndex
+        self.assertTrue(dash.sh.build_MultiIndex().get_index("shg").equals(da.get_index("shg")))
+
+        #slices which don't follow the default ordering keep their coefficients
+        dasl=xr.DataArray.sh.zeros(2,squeeze=True).sh.build_SHIndex().isel(shg=slice(3,None))
+        self.assertIsNone(dasl.xindexes["n"].layout)
+        self.assertFalse(dasl.xindexes["n"].equals(xr.DataArray.sh.zeros(2,2).sh.build_SHIndex().xindexes["n"]))
+        self.assertEqual(dasl.sh.build_MultiIndex().get_index("shg").tolist(),[(2,0,0),(2,1,0),(2,2,0),(1,1,1),(2,1,1),(2,2,1)])
+        #reversed and strided slices don't keep the layout either
+        dash=xr.DataArray.sh.zeros(3).sh.build_SHIndex()
+        dash[:]=np.arange(dash.sizes["shg"],dtype=float)
+        darev=dash.isel(shg=slice(None,None,-1))
+        self.assertIsNone(darev.xindexes["n"].layout)
+        self.assertEqual(float(darev.sel(n=3,m=3,t=0)),9.0)
+        np.testing.assert_array_equal(np.sort(darev.sh.truncate(nmax=1).values),dash.sh.truncate(nmax=1).values)
+        dastr=dash.isel(shg=slice(0,None,2))
+        self.assertEqual(dastr.sh.build_MultiIndex().get_index("shg").tolist(),dash.sh.build_MultiIndex().get_index("shg")[::2].tolist())
+        for n,m,t in dastr.sh.build_MultiIndex().get_index("shg"):
+            self.assertEqual(float(dastr.sel(n=n,m=m,t=t)),float(dash.sel(n=n,m=m,t=t)))
+
+    def test_truncate_extend(self):
+        self.logger.info("Testing truncation and extension of spherical harmonic data")
+        da=xr.DataArray.sh.zeros(12,2,auxcoords={"time":np.arange(3)})
+        da[:]=np.random.default_rng(1).random(da.shape)
+        daref=da.where((da.n >= 4) & (da.n <= 9),drop=True)
+        cnm=lambda obj:obj["cnm"] if isinstance(obj,xr.Dataset) else obj
+        for daobj in [da,da.sh.build_SHIndex(),da.to_dataset()]:
+            datrunc=daobj.sh.truncate(nmax=9,nmin=4)
+            self.assertEqual((datrunc.sh.nmin,datrunc.sh.nmax),(4,9))
+            np.testing.assert_array_equal(cnm(datrunc).values,daref.values)
+
+            daext=datrunc.sh.extend(nmax=15,nmin=0,fillvalue=-1)
+            self.assertEqual((daext.sh.nmin,daext.sh.nmax),(0,15))
+            #original coefficients are restored and the padded ones filled
+            np.testing.assert_array_equal(cnm(daext.sh.truncate(nmax=9,nmin=4)).values,daref.values)
+            self.assertTrue((cnm(daext).where(daext.n > 9,drop=True) == -1).all())
+
+    def test_cnm(self):
+        self.logger.info("Testing conversion between shtools cnm arrays and xarray")
+        nmax=20
+        cnm=np.random.default_rng(2).random([5,2,nmax+1,nmax+1])
+        #zero the entries which are not used by shtools
+        cnm*=np.tril(np.ones([nmax+1,nmax+1]))
+        cnm[:,1,:,0]=0.0
+        dacnm=xr.DataArray.sh.from_cnm(cnm,coords=np.arange(5))
+        self.assertEqual(dacnm.dims,("time","shg"))
+        self.assertEqual(dacnm.sel(shg=(4,2,1),time=3).item(),cnm[3,1,4,2])
+        np.testing.assert_array_equal(dacnm.sh.to_cnm(),cnm)
+
+        #write into preallocated buffers
+        out=np.empty_like(cnm)
+        self.assertIs(dacnm.sh.to_cnm(out=out),out)
+        np.testing.assert_array_equal(out,cnm)
+        np.testing.assert_array_equal(dacnm.sh.truncate(nmax=10).sh.to_cnm(),cnm[:,:,0:11,0:11])
+
+    def test_flatten_shg(self):
+        self.logger.info("Testing serialization of the spherical harmonic index")
+        da=xr.DataArray.sh.zeros(10,2,squeeze=True,auxcoords={"time":np.arange(3)})
+        for packed in [False,True]:
+            daflat=da.sh.flatten_shg(packed=packed)
+            self.assertNotIn("shg",daflat.indexes)
+            self.assertTrue(daflat.sh.build_MultiIndex().get_index("shg").equals(da.get_index("shg")))
+            self.assertEqual(daflat.sh.build_SHIndex().xindexes["n"].layout,(10,2,True))
+
     def test_shanalysis(self):
         self.logger.info("Testing Spherical harmonic analysis of a unit load")
         nmax=120
@@ -90,6 +268,480 @@ class TestSH(unittest.TestCase):
         # cehck whether the max closely represents (nmax+1)^2
         self.assertAlmostEqual(damax.out.item(),(nmax+1)**2)
 
+    def test_analysis2d(self):
+        self.logger.info("Testing FFT based grid synthesis with a time dimension")
+        nmax=30
+        da=xr.DataArray.sh.zeros(nmax,auxcoords={"time":np.arange(2)})
+        da[:]=np.random.default_rng(4).standard_normal(da.shape)
+        lon=np.arange(-180.0,180.0,10.0)
+        lat=np.arange(-85.0,90.0,10.0)
+        shfwd=YnmFwd(nmax,lon,lat,force2d=True)
+        dagrd=shfwd(da)
+        self.assertEqual(dagrd.dims,("time","lon","lat"))
+        #compare with a direct evaluation of the spherical harmonics
+        lonv,latv=np.meshgrid(lon,lat,indexing="ij")
+        daunit=shunit(nmax,lonv.ravel(),latv.ravel())
+        grdref=da.sel(shg=daunit.indexes["shg"]).transpose("time","shg").values@daunit.values
+        np.testing.assert_allclose(dagrd.values,grdref.reshape(dagrd.shape),atol=1e-10)
+        np.testing.assert_allclose(shfwd.analysis2d(da,method="dft").values,dagrd.values,atol=1e-10)
+        #descending longitudes
+        londesc=np.arange(170.0,-180.0,-10.0)
+        shfwddesc=YnmFwd(nmax,londesc,lat,force2d=True)
+        dadesc=shfwddesc.analysis2d(da,method="fft")
+        np.testing.assert_allclose(dadesc.values,shfwddesc.analysis2d(da,method="dft").values,atol=1e-10)
+        np.testing.assert_allclose(dadesc.values,dagrd.sel(lon=londesc).values,atol=1e-10)
+
+    def test_analysis1d(self):
+        self.logger.info("Testing blocked synthesis on scattered points")
+        nmax=25
+        da=xr.DataArray.sh.zeros(nmax,auxcoords={"time":np.arange(3)})
+        da[:]=np.random.default_rng(5).standard_normal(da.shape)
+        rng=np.random.default_rng(6)
+        lon=rng.uniform(-180,180,50)
+        lat=rng.uniform(-90,90,50)
+        shfwd=YnmFwd(da,lon,lat)
+        dapoints=shfwd(da)
+        self.assertEqual(dapoints.dims,("time","npoints"))
+        daunit=shunit(nmax,lon,lat)
+        ptsref=da.sel(shg=daunit.indexes["shg"]).transpose("time","shg").values@daunit.values
+        np.testing.assert_allclose(dapoints.values,ptsref,atol=1e-10)
+        #multiple blocks on a thread pool
+        np.testing.assert_allclose(shfwd.analysis1d(da,blocksize=7,nworkers=3).values,ptsref,atol=1e-10)
+
+    def test_pnmcache(self):
+        self.logger.info("Testing the on-disk cache of Legendre tables")
+        nmax=20
+        lon=np.arange(-180.0,180.0,20.0)
+        lat=np.arange(-80.0,90.0,20.0)
+        da=xr.DataArray.sh.zeros(nmax)
+        da[:]=np.random.default_rng(7).standard_normal(da.shape)
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache=PnmCache(cachedir)
+            dagrd=YnmFwd(nmax,lon,lat,force2d=True,cache=cache)(da)
+            xrtest.assert_allclose(dagrd,YnmFwd(nmax,lon,lat,force2d=True)(da))
+            #hits are shared read-only memory maps
+            table=cache(nmax,lat)
+            self.assertIsInstance(table,np.memmap)
+            self.assertFalse(table.flags.writeable)
+            np.testing.assert_array_equal(table,pnm(nmax,lat))
+            self.assertEqual(len(cache.entries()),1)
+            xrtest.assert_allclose(shunit(nmax,lon[0:5],lat[0:5],cache=cache),shunit(nmax,lon[0:5],lat[0:5]))
+
+            #least recently used tables are evicted first
+            cache(nmax,lat)
+            cache.evict(cache.entries()[-1][1])
+            self.assertEqual([fname for fname,_,_ in cache.entries()],[cache.path(nmax,lat)])
+
+            #tables larger than the budget are computed in memory and don't evict the cached ones
+            cache.budget=cache.size()+1000
+            latpts=np.linspace(-89.0,89.0,50)
+            table=cache(nmax,latpts)
+            self.assertNotIsInstance(table,np.memmap)
+            np.testing.assert_array_equal(table,pnm(nmax,latpts))
+            self.assertEqual([fname for fname,_,_ in cache.entries()],[cache.path(nmax,lat)])
+            lonpts=np.linspace(-180.0,180.0,50)
+            np.testing.assert_allclose(YnmFwd(nmax,lonpts,latpts,cache=cache).analysis1d(da,blocksize=20).values,
+                    YnmFwd(nmax,lonpts,latpts).analysis1d(da).values,atol=1e-10)
+            self.assertEqual(len(cache.entries()),1)
+
+            #failed computations don't leave partial tables behind
+            with mock.patch("frommle2.sh.pnmcache.pnm",side_effect=RuntimeError("interrupted")):
+                with self.assertRaises(RuntimeError):
+                    cache(nmax-1,lat)
+            self.assertEqual([fname for fname in os.listdir(cachedir) if not fname.endswith(".npy")],[])
+
+    def test_gravfunctionals(self):
+        self.logger.info("Testing the synthesis of several gravity functionals in one pass")
+        nmax=30
+        da=xr.DataArray.sh.zeros(nmax,auxcoords={"time":np.arange(2)})
+        da[:]=1e-9*np.random.default_rng(8).standard_normal(da.shape)
+        lon=np.arange(-180.0,180.0,10.0)
+        lat=np.arange(-85.0,90.0,10.0)
+        names=["geoid","gravity_anomaly","deflection_north","deflection_east"]
+        dsgrd=YnmFwd(nmax,lon,lat,force2d=True).functionals(da,gravity_functionals(names))
+        self.assertEqual(list(dsgrd.data_vars),names)
+        xrtest.assert_allclose(dsgrd.geoid,a_earth*YnmFwd(nmax,lon,lat,force2d=True)(da))
+        xrtest.assert_allclose(dsgrd.gravity_anomaly,YnmFwd(nmax,lon,lat,force2d=True)(GM_earth/a_earth**2*(da.n-1)*da))
+
+        #deflections of the vertical from numerical derivatives of the geoid
+        h=1e-4
+        geoid=lambda dlon,dlat:YnmFwd(nmax,lon+dlon,lat+dlat,force2d=True)(da).values*a_earth
+        xi=-(geoid(0,h)-geoid(0,-h))/(2*np.deg2rad(h)*a_earth)
+        eta=-(geoid(h,0)-geoid(-h,0))/(2*np.deg2rad(h)*a_earth*np.cos(np.deg2rad(lat)))
+        np.testing.assert_allclose(dsgrd.deflection_north.values,xi,atol=1e-6*np.abs(xi).max())
+        np.testing.assert_allclose(dsgrd.deflection_east.values,eta,atol=1e-6*np.abs(eta).max())
+
+        #the same functionals on scattered points
+        lonv,latv=np.meshgrid(lon,lat,indexing="ij")
+        dspoints=YnmFwd(nmax,lonv.ravel(),latv.ravel()).functionals(da,gravity_functionals(names),blocksize=100)
+        for name in names:
+            np.testing.assert_allclose(dspoints[name].values.reshape(dsgrd[name].shape),dsgrd[name].values,atol=1e-10*np.abs(dsgrd[name]).max().item())
+
+        #Dataset input, a single coefficient variable maps to the functional names
+        dsin=xr.Dataset({"cnm":da,"sigma":("time",np.ones(2))})
+        dsds=YnmFwd(nmax,lon,lat,force2d=True).functionals(dsin,gravity_functionals(names[0:2]))
+        self.assertEqual(set(dsds.data_vars),{"geoid","gravity_anomaly","sigma"})
+        xrtest.assert_allclose(dsds.geoid,dsgrd.geoid)
+        dsds=YnmFwd(nmax,lonv.ravel(),latv.ravel()).functionals(dsin.assign(snm=2*da),gravity_functionals(names[0:1]))
+        self.assertEqual(set(dsds.data_vars),{"cnm_geoid","snm_geoid","sigma"})
+        xrtest.assert_allclose(dsds.snm_geoid,2*dspoints.geoid)
+
+    def test_lsqanalysis(self):
+        self.logger.info("Testing least squares and quadrature analysis of scattered samples")
+        nmax=10
+        da=xr.DataArray.sh.zeros(nmax,squeeze=True,auxcoords={"time":np.arange(3)})
+        da[:]=np.random.default_rng(3).standard_normal(da.shape)
+        rng=np.random.default_rng(4)
+        lon=rng.uniform(-180,180,2000)
+        lat=np.rad2deg(np.arcsin(rng.uniform(-1,1,2000)))
+        obs=YnmFwd(nmax,lon,lat)(da)
+        lsq=LSQAnalysis(nmax,lon,lat,blocksize=300)
+        xrtest.assert_allclose(lsq(obs).transpose(*da.dims),da,atol=1e-12)
+        #repeated epochs reuse the factorization, also without a cached design matrix
+        lsq=LSQAnalysis(nmax,lon,lat,blocksize=300,designcache=0)
+        xrtest.assert_allclose(lsq(obs.isel(time=1)),da.isel(time=1),atol=1e-12)
+
+        #quadrature with cell areas of an equiangular grid
+        d=2.0
+        lon,lat=np.meshgrid(np.arange(-180+d/2,180,d),np.arange(-90+d/2,90,d),indexing="ij")
+        lon,lat=lon.ravel(),lat.ravel()
+        area=np.deg2rad(d)*(np.sin(np.deg2rad(lat+d/2))-np.sin(np.deg2rad(lat-d/2)))
+        quad=LSQAnalysis(nmax,lon,lat,weights=area,method="quadrature")
+        xrtest.assert_allclose(quad(YnmFwd(nmax,lon,lat)(da)).transpose(*da.dims),da,atol=1e-2)
+
+    def test_sparsefwd_dot(self):
+        self.logger.info("Testing the fusion of sparse forward operators")
+        nmax=8
+        mi=xr.DataArray.sh.nmt_mi(nmax)
+        #the first operator works on a subset of degrees in a different order
+        mi2=xr.DataArray.sh.nmt_mi(nmax,2)[::-1]
+        op1=LinearSparseFwd(xr.DataArray(sparse.random((len(mi),len(mi)),density=0.1,random_state=1),coords={"shg":("shg",mi)},dims=["shg_t","shg"]),"shg")
+        op2=LinearSparseFwd(xr.DataArray(sparse.random((len(mi2),len(mi2)),density=0.1,random_state=2),coords={"shg":("shg",mi2)},dims=["shg_t","shg"]),"shg")
+        da=xr.DataArray.sh.zeros(nmax,2,auxcoords={"time":np.arange(5)})
+        da[:]=np.random.default_rng(5).standard_normal(da.shape)
+        chained=op1(op2(da).rename(shg_t="shg").assign_coords(shg=("shg",mi2)))
+        fused=op1.dot(op2)(da)
+        self.assertTrue(fused.indexes["shg"].equals(mi))
+        np.testing.assert_allclose(fused.values,chained.values,atol=1e-12)
+
+    def test_shfilter_blockdiag(self):
+        self.logger.info("Testing the block diagonal application of a spherical harmonic filter")
+        nmin=2
+        nmax=12
+        #blocks per order and trigonometric type (as in DDK filter files)
+        rng=np.random.default_rng(7)
+        tags=[]
+        blocks=[]
+        for m in range(nmax+1):
+            for t in ("C","S") if m > 0 else ("C",):
+                nblk=nmax+1-max(nmin,m)
+                tags.extend([f"G{t}N {n:3d}{m:4d}" for n in range(max(nmin,m),nmax+1)])
+                blocks.append(rng.standard_normal([nblk,nblk]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ffile=os.path.join(tmpdir,"ddk.bin")
+            writeBDfile(ffile,tags,blocks)
+            filt=SHfilter(ffile)
+            filtsp=SHfilter(ffile,blockdiag=False)
+            filttr=SHfilter(ffile,transpose=True,nworkers=3)
+            filttrsp=SHfilter(ffile,transpose=True,blockdiag=False)
+        da=xr.DataArray.sh.zeros(nmax-2,auxcoords={"time":np.arange(6)})
+        da[:]=rng.standard_normal(da.shape)
+        #reference: dense filter on the degrees 2..nmax of the input, with degrees 0 and 1 restored
+        dense=scipy.linalg.block_diag(*blocks)
+        #the sparse matrix of a block diagonal filter is only built on demand
+        filt(da)
+        for attr in ("_dacoo","dasparse","mat","backend"):
+            self.assertNotIn(attr,filt.__dict__)
+        self.assertIn("backend",filtsp.__dict__)
+        mi=filt.dasparse.get_index("shg")
+        self.assertEqual(filt.mat.shape,dense.shape)
+        np.testing.assert_allclose(filttr.dot(filt).mat.todense(),dense.T@dense,atol=1e-12)
+        self.assertEqual(len(filt._plans.plans),1)
+        keep=np.nonzero(mi.get_level_values("n") <= nmax-2)[0]
+        xin=da.sel(shg=mi[keep]).values
+        for fbd,fsp,mat in ((filt,filtsp,dense),(filttr,filttrsp,dense.T)):
+            dabd=fbd(da)
+            dasp=fsp(da).compute()
+            self.assertTrue(dabd.indexes["shg"].equals(dasp.indexes["shg"]))
+            np.testing.assert_allclose(dabd.transpose(*dasp.dims).values,dasp.values,atol=1e-12)
+            dalow=da.where(da.n < nmin,drop=True)
+            nlow=dalow.sizes["shg"]
+            self.assertTrue(dabd.indexes["shg"][0:nlow].equals(dalow.indexes["shg"]))
+            np.testing.assert_array_equal(dabd.values[0:nlow],dalow.values)
+            self.assertTrue(dabd.indexes["shg"][nlow:].equals(mi[keep]))
+            np.testing.assert_allclose(dabd.values[nlow:],mat[np.ix_(keep,keep)]@xin,atol=1e-12)
+        #inputs with a SHIndex are aligned in the same way
+        dash=filt(da.sh.build_SHIndex())
+        np.testing.assert_array_equal(dash.values,filt(da).values)
+        self.assertTrue(dash.indexes["shg"].equals(filt(da).indexes["shg"]))
+        #the alignment plan is reused for the same index, and a new one is made for a different index
+        filt(da.copy())
+        self.assertEqual(len(filt._plans.plans),1)
+        filt(da.sh.truncate(nmax-4))
+        self.assertEqual(len(filt._plans.plans),2)
+
+    def test_readbinv_mmap(self):
+        self.logger.info("Testing memory mapped reading and unpacking of BINV files")
+        rng=np.random.default_rng(11)
+        blocks=[rng.standard_normal([n,n]) for n in (3,1,4)]
+        tags=[f"T{i:03d}" for i in range(8)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ffile=os.path.join(tmpdir,"bd.bin")
+            writeBDfile(ffile,tags,blocks)
+            dref=readBINV(ffile)
+            dmm=readBINV(ffile,mmap=True)
+            self.assertIsInstance(dmm["pack"],np.memmap)
+            self.assertFalse(dmm["pack"].flags.writeable)
+            np.testing.assert_array_equal(dmm["pack"],dref["pack"])
+            np.testing.assert_array_equal(dmm["side1_d"],dref["side1_d"])
+            np.testing.assert_array_equal(dmm["blockind"],dref["blockind"])
+            del dmm
+            dunp=readBINV(ffile,unpack=True)
+        #block diagonal matrices unpack in dense blocks, sparse representations are made on demand
+        for blk,blkref in zip(dunp["blocks"],blocks):
+            np.testing.assert_array_equal(blk,blkref)
+        dense=scipy.linalg.block_diag(*blocks)
+        coords=getBDcoords(dref)
+        np.testing.assert_array_equal(dense[coords[0],coords[1]],dref["pack"])
+        np.testing.assert_array_equal(getBDsparse(dref).todense(),dense)
+        np.testing.assert_array_equal(getBDsparse(dref,format="csr").toarray(),dense)
+
+    def test_binv_unpack_symmetric(self):
+        self.logger.info("Testing unpacking of symmetric and full BINV matrices")
+        rng=np.random.default_rng(5)
+        n=9
+        tags=[f"T{i:03d}" for i in range(n)]
+        amat=rng.standard_normal([n,n])
+        amat=amat@amat.T+n*np.eye(n)
+        rhs=rng.standard_normal(n)
+        blocks=[amat[0:4,0:4],amat[4:,4:]]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ffile=os.path.join(tmpdir,"mat.bin")
+            writeBINVfile(ffile,"SYMV1___",tags,SymPacked.fromdense(amat).pack,vec=rhs)
+            dunp=readBINV(ffile,unpack=True)
+            np.testing.assert_array_equal(dunp["mat"],amat)
+            np.testing.assert_array_equal(dunp["vec"][:,0],rhs)
+            #packed matrices support products and solves (also on memory maps)
+            spmat=readBINV(ffile,unpack="packed",mmap=True)["mat"]
+            spmat.blocksize=4
+            np.testing.assert_allclose(spmat@rhs,amat@rhs,rtol=1e-13)
+            np.testing.assert_allclose(spmat.solve(rhs),np.linalg.solve(amat,rhs),rtol=1e-12)
+            del spmat
+
+            writeBINVfile(ffile,"FULLSQV0",tags,amat.ravel(order='F'))
+            np.testing.assert_array_equal(readBINV(ffile,unpack=True)["mat"],amat)
+
+            writeBINVfile(ffile,"BDSYMV0_",tags,np.concatenate([SymPacked.fromdense(blk).pack for blk in blocks]),blockind=[4,n])
+            dunp=readBINV(ffile,unpack=True)
+            for blk,blkref in zip(dunp["blocks"],blocks):
+                np.testing.assert_array_equal(blk,blkref)
+            np.testing.assert_array_equal(getBDsparse(dunp).todense(),scipy.linalg.block_diag(*blocks))
+            blk=readBINV(ffile,unpack="packed")["blocks"][1]
+            np.testing.assert_allclose(blk.solve(rhs[4:]),np.linalg.solve(blocks[1],rhs[4:]),rtol=1e-12)
+
+    def test_writebinv(self):
+        self.logger.info("Testing streaming writing of BINV files")
+        rng=np.random.default_rng(9)
+        n=9
+        tags=[f"T{i:03d}" for i in range(n)]
+        amat=rng.standard_normal([n,n])
+        amat=amat@amat.T
+        blocks=[amat[0:4,0:4],amat[4:,4:]]
+        files=[("SYMV1___",SymPacked.fromdense(amat).pack,None,rng.standard_normal(n)),
+                ("FULLSQV0",amat.ravel(order='F'),None,None),
+                ("BDFULLV0",np.concatenate([blk.ravel(order='F') for blk in blocks]),[4,n],None),
+                ("BDSYMV0_",np.concatenate([SymPacked.fromdense(blk).pack for blk in blocks]),[4,n],None)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ffile=os.path.join(tmpdir,"in.bin")
+            fout=os.path.join(tmpdir,"out.bin")
+            #files round trip byte for byte (also when streaming from a memory map in small chunks)
+            for btype,pack,blockind,vec in files:
+                writeBINVfile(ffile,btype,tags,pack,blockind=blockind,vec=vec)
+                for mmap in (False,True):
+                    writeBINV(fout,readBINV(ffile,mmap=mmap),chunksize=7)
+                    with open(ffile,'rb') as fid1,open(fout,'rb') as fid2:
+                        self.assertEqual(fid1.read(),fid2.read())
+
+            #write from a labelled (sparse) xarray object with a newer version, meta data and a readme
+            mi=xr.DataArray.sh.nmt_mi(3,2)
+            bmat=rng.standard_normal([len(mi),4])
+            for data in (bmat,sparse.COO.from_numpy(bmat)):
+                dabmat=xr.DataArray(data,coords={"shg":("shg",mi),"par":["a","b","c","d"]},dims=["shg","par"])
+                writeBINV(fout,toBINVdict(dabmat,"FULL2DVN",description="2D matrix",meta={"nobs":12,"sigma0":1.5},readme="test",blocksize=3),endianness='>')
+                dread=readBINV(fout,unpack=True)
+                np.testing.assert_array_equal(dread["mat"],bmat)
+                self.assertEqual(dread["side1_d"][0].strip(),"GCN   2   0")
+                self.assertEqual(dread["side2_d"][3].strip(),"d")
+                self.assertEqual(dread["meta"],{"nobs":12,"sigma0":1.5})
+                self.assertEqual(dread["readme"].strip(),"test")
+            writeBINV(ffile,readBINV(fout),endianness='>')
+            with open(ffile,'rb') as fid1,open(fout,'rb') as fid2:
+                self.assertEqual(fid1.read(),fid2.read())
+
+            #packed data of the wrong size is rejected without leaving a (truncated) file behind
+            dtrunc=readBINV(fout)
+            fbad=os.path.join(tmpdir,"bad.bin")
+            for pack in (dtrunc["pack"][:-1],(chunk for chunk in (dtrunc["pack"],dtrunc["pack"]))):
+                with self.assertRaises(ValueError):
+                    writeBINV(fbad,dict(dtrunc,pack=pack))
+                self.assertEqual([fname for fname in os.listdir(tmpdir) if fname.startswith("bad.bin")],[])
+
+            #symmetric and block diagonal matrices from sparse input
+            for btype,blockind in (("SYMVN___",None),("BDSYMVN_",[4,n]),("BDFULLVN",[4,n])):
+                writeBINV(fout,toBINVdict(sparse.COO.from_numpy(scipy.linalg.block_diag(*blocks)),btype,side1_d=tags,blockind=blockind,blocksize=2))
+                dread=readBINV(fout,unpack=True)
+                if blockind is None:
+                    np.testing.assert_array_equal(dread["mat"],scipy.linalg.block_diag(*blocks))
+                else:
+                    for blk,blkref in zip(dread["blocks"],blocks):
+                        np.testing.assert_array_equal(blk,blkref)
+
+    def test_binv_catalog(self):
+        self.logger.info("Testing header only scanning of a directory with BINV files")
+        rng=np.random.default_rng(13)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for month in range(1,5):
+                n=4+month%2
+                amat=rng.standard_normal([n,n])
+                writeBINV(os.path.join(tmpdir,f"neq{month:02d}.bin"),toBINVdict(amat@amat.T,"SYMVN___",side1_d=[f"P{i:03d}" for i in range(n)],
+                    vec=rng.standard_normal(n),meta={"nobs":100*month,"CTime":2020+(month-0.5)/12}))
+            with open(os.path.join(tmpdir,"README"),'w') as fid:
+                fid.write("not a BINV file")
+            index=os.path.join(tmpdir,"catalog.nc")
+            cat=BINVcatalog(tmpdir,index=index,nworkers=2)
+            self.assertEqual(cat.sizes["file"],4)
+            #identical side descriptions are stored once
+            self.assertEqual(cat.sizes["sideset"],2)
+            np.testing.assert_array_equal(catalogsides(cat,0),[f"P{i:03d}" for i in range(5)])
+            np.testing.assert_array_equal(catalogsides(cat,cat.file.values[1]),[f"P{i:03d}" for i in range(4)])
+            np.testing.assert_array_equal(cat.meta_nobs.values,[100,200,300,400])
+            sel=cat.where(cat.meta_CTime > 2020.2,drop=True)
+            self.assertEqual([os.path.basename(fname) for fname in sel.file.values],["neq03.bin","neq04.bin"])
+            #the byte offsets point to the data
+            fname=cat.file.values[2]
+            dref=readBINV(fname)
+            with open(fname,'rb') as fid:
+                fid.seek(int(cat.offset_pack.values[2]))
+                np.testing.assert_array_equal(np.fromfile(fid,dtype='<f8',count=int(cat.pval1.values[2])),dref["pack"])
+
+            #only modified files are rescanned when the index exists
+            writeBINV(fname,dict(dref,meta={"nobs":1,"CTime":2020.0}))
+            os.utime(fname,(0,1e9))
+            cat2=BINVcatalog(tmpdir,index=index)
+            np.testing.assert_array_equal(cat2.meta_nobs.values,[100,200,1,400])
+            xrtest.assert_equal(cat2.drop_vars(["meta_nobs","meta_CTime","mtime"]),cat.drop_vars(["meta_nobs","meta_CTime","mtime"]))
+
+        #an empty directory gives an empty catalog
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catempty=BINVcatalog(tmpdir)
+            self.assertEqual(catempty.sizes["file"],0)
+            self.assertEqual(catempty.sizes["sideset"],0)
+
+    def test_equivalentwater(self):
+        self.logger.info("Testing the isotropic conversion to equivalent water heights")
+        nmax=10
+        knlove=xr.DataArray(-0.3/(1+np.arange(0,nmax+5)),coords={"degree":np.arange(0,nmax+5)},dims=["degree"])
+        ewh=EquivalentWater(knlove,nmax)
+        da=xr.DataArray.sh.zeros(nmax,auxcoords={"time":np.arange(3)})
+        da[:]=np.random.default_rng(9).standard_normal(da.shape)
+        daewh=ewh(da)
+        self.assertTrue(daewh.indexes["shg"].equals(da.indexes["shg"]))
+        #same result as the sparse matrix product
+        dasp=ewh.tolinearsparse()(da).compute()
+        np.testing.assert_allclose(daewh.values,dasp.values,rtol=1e-14)
+
+        #composition with diagonal and sparse operators
+        np.testing.assert_allclose(ewh.dot(ewh)(da).values,ewh(ewh(da)).values,rtol=1e-14)
+        mi=da.indexes["shg"]
+        opsp=LinearSparseFwd(xr.DataArray(sparse.random((len(mi),len(mi)),density=0.1,random_state=3),coords={"shg":("shg",mi)},dims=["shg_t","shg"]),"shg")
+        chained=ewh(opsp(da).rename(shg_t="shg").assign_coords(shg=("shg",mi)))
+        np.testing.assert_allclose(ewh.dot(opsp)(da).transpose(*chained.dims).values,chained.values,atol=1e-12)
+
+        #inputs with a SHIndex
+        np.testing.assert_allclose(ewh(da.sh.build_SHIndex()).values,daewh.values,rtol=1e-14)
+        np.testing.assert_allclose(opsp(da.sh.build_SHIndex()).values,opsp(da).values,rtol=1e-14)
+        dashuffled=da.isel(shg=np.random.default_rng(11).permutation(da.sizes["shg"]))
+        np.testing.assert_allclose(opsp(dashuffled.sh.build_SHIndex()).values,opsp(da).values,atol=1e-12)
+
+        #input degrees above the maximum degree of the operator are dropped
+        dahigh=xr.DataArray.sh.zeros(nmax+6,auxcoords={"time":np.arange(3)})
+        dahigh[:]=np.random.default_rng(10).standard_normal(dahigh.shape)
+        daewh=ewh(dahigh)
+        self.assertEqual(daewh.sh.nmax,nmax)
+        np.testing.assert_allclose(daewh.values,ewh(dahigh.sh.truncate(nmax)).values,rtol=1e-14)
+
+    def test_fwd_to_store(self):
+        self.logger.info("Testing the chunked application of operators with incremental output")
+        nmax=8
+        mi=xr.DataArray.sh.nmt_mi(nmax)
+        opsp=LinearSparseFwd(xr.DataArray(sparse.random((len(mi),len(mi)),density=0.1,random_state=4),coords={"shg":("shg",mi)},dims=["shg_t","shg"]),"shg",outindex=mi)
+        opbd=BlockDiagonalFwd([np.random.default_rng(3).standard_normal([sz,sz]) for sz in (10,20,30,30)],mi,"shg")
+        da=xr.DataArray.sh.zeros(nmax,auxcoords={"time":np.arange(10),"ensemble":np.arange(3)})
+        da[:]=np.random.default_rng(4).standard_normal(da.shape)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for op in (opsp,opbd):
+                expected=op(da)
+                daout=op(da,chunks={"time":3,"ensemble":1})
+                self.assertEqual(daout.chunks[1:],((3,3,3,1),(1,1,1)))
+                np.testing.assert_allclose(daout.transpose(*expected.dims).values,expected.values,atol=1e-12)
+                ncfile=os.path.join(tmpdir,"out.nc")
+                op.to_store(da,ncfile,chunks={"time":4},scheduler="threads",name="filtered")
+                with xr.open_dataset(ncfile) as dsout:
+                    np.testing.assert_allclose(dsout.filtered.transpose(*expected.dims).values,expected.values,atol=1e-12)
+                    np.testing.assert_array_equal(dsout.n.values,mi.get_level_values("n"))
+
+    def test_sparse_backends(self):
+        self.logger.info("Testing the storage backends of sparse forward operators")
+        nmax=8
+        mi=xr.DataArray.sh.nmt_mi(nmax)
+        mat=sparse.random((len(mi),len(mi)),density=0.1,random_state=6)
+        da=xr.DataArray.sh.zeros(nmax,auxcoords={"time":np.arange(4),"ensemble":np.arange(2)})
+        da[:]=np.random.default_rng(6).standard_normal(da.shape)
+        expected=np.einsum("ij,jkl->ikl",mat.todense(),da.values)
+        for backend in ("auto","coo","csr","csc","bsr","dense"):
+            op=LinearSparseFwd(xr.DataArray(mat,coords={"shg":("shg",mi)},dims=["shg_t","shg"]),"shg",backend=backend)
+            np.testing.assert_allclose(op(da).values,expected,atol=1e-12)
+        #selection from the sparsity structure
+        dia=sparse.diagonalize(np.arange(1.0,len(mi)+1))
+        self.assertEqual(LinearSparseFwd(xr.DataArray(dia,dims=["shg_t","shg"]),"shg").backend.name,"diagonal")
+        self.assertEqual(LinearSparseFwd(xr.DataArray(np.ones([4,4]),dims=["shg_t","shg"]),"shg").backend.name,"dense")
+        #general einsum expressions on dask arrays
+        dasp=xr.DataArray(mat,coords={"shg":("shg",mi)},dims=["shg_t","shg"]).chunk({"shg":-1})
+        np.testing.assert_allclose(dasp.dot(da.chunk({"time":2}),dim="shg").transpose("shg_t","time","ensemble").values,expected,atol=1e-12)
+
+    @unittest.skipUnless(haveRasterio,"rasterio is not available")
+    def test_rastio2shDH_stack(self):
+        self.logger.info("Testing spherical harmonic analysis of multi-band rasters")
+        nmax=20
+        grd=np.random.default_rng(9).standard_normal([180,360])
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff",width=360,height=180,count=3,dtype="float64",crs="EPSG:4326",transform=from_origin(-180.5,90.5,1.0,1.0)) as dst:
+                dst.write(np.stack([grd,2*grd,3*grd]))
+            with memfile.open() as rio:
+                dash=rastio2shDH_stack(rio,nmax=nmax,chunksize=2,dim="time",coords=np.arange(3))
+                dash1=rastio2shDH(rio,nmax=nmax)
+                #parallel expansions on a process pool
+                xrtest.assert_allclose(rastio2shDH_stack(rio,nmax=nmax,chunksize=2,dim="time",coords=np.arange(3),nworkers=2,processes=True),dash)
+        self.assertEqual(dash.dims,("time","shg"))
+        xrtest.assert_allclose(dash.isel(time=0,drop=True),dash1)
+        xrtest.assert_allclose(dash.isel(time=2,drop=True),3*dash1)
+
+    @unittest.skipUnless(haveRasterio,"rasterio is not available")
+    def test_rastio2shDH_stream(self):
+        self.logger.info("Testing spherical harmonic analysis of a regional raster in latitude bands")
+        nmax=30
+        grd=np.random.default_rng(10).standard_normal([2,61,81])
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff",width=81,height=61,count=2,dtype="float64",crs="EPSG:4326",transform=from_origin(-40.5,30.5,1.0,1.0)) as dst:
+                dst.write(grd)
+            with memfile.open() as rio:
+                dash1=rastio2shDH(rio,nmax=nmax)
+                dastream=rastio2shDH_stream(rio,nmax=nmax,nrows=16)
+                dastack=rastio2shDH_stream(rio,nmax=nmax,bands=[1,2],nrows=25)
+        xrtest.assert_allclose(dastream,dash1,atol=1e-14)
+        xrtest.assert_allclose(dastack.sel(band=1,drop=True),dash1,atol=1e-14)
+        self.assertEqual(dastack.dims,("band","shg"))
+
 
 if __name__ == '__main__':
     unittest.main()